@@ -4,13 +4,18 @@ Holds the default configuration, the merge helper used to layer the user's
 config file on top of it, the helpers that translate between compact
 'repositories' entries and settings dicts, and the Config object that loads
 everything from the metagit config file.
+
+The merged configuration is kept pickled in the cache directory, keyed by the
+stat data of the config file: as long as the file is unchanged, loading the
+config neither parses YAML nor merges it with the defaults (and yaml is not
+even imported).
 """
 import os
 import copy
-import yaml
+import time
+import stat
 
-from .utils import UserMessage
-from .Repository import GitRepository, GitSvnRepository
+from .utils import UserMessage, cache_dir
 
 
 # the configuration used as a starting point; the user's config file is merged
@@ -21,6 +26,50 @@ DEFAULT_CONFIG = {
     # continue...' when it ran for fewer than this many seconds (long-running
     # commands such as an interactive shell don't need a manual confirmation)
     'run-fg-prompt-threshold': 5,
+    # the number of repositories evaluated (e.g. by 'st') at the same time;
+    # 0 picks one per CPU. The -j/--jobs option overrides it per command.
+    'jobs': 0,
+    # at most this many network operations (e.g. 'fetch') talk to the same
+    # remote host at a time, so a bulk fetch doesn't trip a server's rate
+    # limit; 0 disables the limit
+    'jobs-per-host': 4,
+    # let bulk network operations ('fetch', 'clone', the UI's commands) share
+    # one ssh connection per host instead of a handshake per repository
+    'ssh-multiplexing': True,
+    # remember the status of every repository (in $XDG_CACHE_HOME/metagit)
+    # and reuse it while the repository's git metadata and tracked files are
+    # unchanged, unless checking that costs more than asking git (measured
+    # again every few runs);
+    # 'st --no-cache' bypasses it once
+    'status-cache': True,
+    # how deep the interactive UI evaluates the status of a repository (like
+    # 'st --level'): 'exists', 'dirty' (uncommitted changes of tracked files,
+    # checked in-process: faster on huge working trees, but without file
+    # counts and untracked files), 'ahead-behind' (and the commits to push and
+    # merge) or 'full'
+    'ui-status-level': 'full',
+    # let the UI watch the repositories' git metadata (with inotify, on
+    # Linux) and update a row as soon as its repository changed
+    'watch': True,
+    # how 'detect' (and the UI's detect action) finds repositories: 'crawl'
+    # the directories in detect-roots, or query the 'locate' database
+    'detect-method': 'crawl',
+    'detect-roots': ['~'],
+    # glob patterns of directories the crawler does not descend into; a
+    # pattern with a '/' is matched against the whole path, others against
+    # the directory name
+    'detect-exclude': [
+        'node_modules',
+        '__pycache__',
+        '.cache',
+        '.venv',
+        '.tox',
+        '~/.local/share/Trash',
+    ],
+    # remember the directories crawled (in $XDG_CACHE_HOME/metagit), so the
+    # next crawl only reads those that changed, and the fingerprints 'clone'
+    # reads from the repositories found
+    'detect-cache': True,
     'keys': {
         '↓': 'down',
         'j': 'down',
@@ -52,6 +101,10 @@ DEFAULT_CONFIG = {
         'running': 'blue',         # a background command in progress
         'failed': 'red bold',      # a background command that failed
         'detected': 'dim',         # repositories found by the 'detect' action
+        'stale': 'dim',            # a status from the previous run, still
+                                   # being re-evaluated
+        'unchecked': 'dim',        # a status evaluated at a lower level
+                                   # (see ui-status-level), nothing pending
     },
 }
 
@@ -70,6 +123,80 @@ def deep_merge(base, override):
     return base
 
 
+def load_yaml(filehandle):
+    """parse the YAML document in `filehandle`, with libyaml's loader if
+    PyYAML was built with it"""
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(filehandle, Loader=loader)
+
+
+def dump_yaml(data, filehandle):
+    """write `data` as YAML to `filehandle` (block style, keys in their
+    order), with libyaml's dumper if PyYAML was built with it"""
+    import yaml
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    yaml.dump(data, filehandle, Dumper=dumper, sort_keys=False,
+              default_flow_style=False)
+
+
+# bump when the format of the compiled config cache changes
+COMPILED_VERSION = 1
+
+# a config file modified less than this many nanoseconds ago may be modified
+# again without its stat data changing, so it is not cached yet
+_RACY_NS = 2 * 1000000000
+
+
+def _file_stamp(path):
+    """the stat data of `path` that changes whenever the file is written"""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+
+
+def _compiled_path():
+    return os.path.join(cache_dir(), 'config.pickle')
+
+
+def _compiled_key(configfile):
+    """the key of the compiled config of `configfile`; the defaults are part
+    of the merged config, so a changed Config.py invalidates it too"""
+    return (COMPILED_VERSION, os.path.abspath(configfile),
+            _file_stamp(configfile), _file_stamp(__file__))
+
+
+def _load_compiled(key):
+    """the merged config stored under `key`, or None"""
+    import pickle
+    try:
+        with open(_compiled_path(), 'rb') as filehandle:
+            compiled = pickle.load(filehandle)
+    except Exception:
+        # no cache yet, or a truncated or otherwise unreadable one
+        return None
+    if not isinstance(compiled, dict) or compiled.get('key') != key:
+        return None
+    return compiled.get('data')
+
+
+def _store_compiled(key, data):
+    """store the merged config `data` under `key`, if it is safe to"""
+    import pickle
+    if time.time_ns() - key[2][0] < _RACY_NS:
+        return
+    path = _compiled_path()
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as filehandle:
+            pickle.dump({'key': key, 'data': data}, filehandle,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        # the cache is only an optimization, e.g. on a read-only home
+        pass
+
+
 def repo_entry_to_config(path, entry):
     """normalize a single 'repositories' entry into a settings dict
 
@@ -98,7 +225,7 @@ Collapses to a plain url string when no other options are set.
 class Config:
     def __init__(self):
         self.data = {}
-        self.repo_objects = {}
+        self._repo_objects = None
 
     @staticmethod
     def filepath():
@@ -110,15 +237,24 @@ class Config:
         # start from the default configuration and merge the user's config
         # file (if any) on top of it, so absent sections fall back to their
         # defaults (e.g. an empty repository list and the default key bindings)
-        self.data = copy.deepcopy(DEFAULT_CONFIG)
         configfile = Config.filepath()
-        if os.path.isfile(configfile):
-            with open(configfile) as filehandle:
-                user_data = yaml.safe_load(filehandle) or {}
-            if not isinstance(user_data, dict):
-                raise UserMessage('Config must be a mapping at the top level')
-            deep_merge(self.data, user_data)
-        self.build_repo_objects()
+        if not os.path.isfile(configfile):
+            self.data = copy.deepcopy(DEFAULT_CONFIG)
+        else:
+            key = _compiled_key(configfile)
+            data = _load_compiled(key)
+            if data is None:
+                data = copy.deepcopy(DEFAULT_CONFIG)
+                with open(configfile) as filehandle:
+                    user_data = load_yaml(filehandle) or {}
+                if not isinstance(user_data, dict):
+                    raise UserMessage('Config must be a mapping at the top '
+                                      'level')
+                deep_merge(data, user_data)
+                _store_compiled(key, data)
+            self.data = data
+        # the repository objects are built on first use (see repo_objects)
+        self._repo_objects = None
 
     def keys(self):
         """the mapping of key to action for the interactive UI"""
@@ -133,6 +269,67 @@ class Config:
         continue; commands running longer than this return to the UI directly"""
         return self.data.get('run-fg-prompt-threshold', 5)
 
+    def jobs(self):
+        """the number of repositories evaluated concurrently (0 for one per
+        CPU)"""
+        jobs = self.data.get('jobs', 0)
+        if not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 0:
+            raise UserMessage('Setting jobs must be a non-negative integer, '
+                              'got {!r}'.format(jobs))
+        return jobs
+
+    def jobs_per_host(self):
+        """the number of concurrent network operations per remote host (0
+        for no limit)"""
+        jobs = self.data.get('jobs-per-host', 4)
+        if not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 0:
+            raise UserMessage('Setting jobs-per-host must be a non-negative '
+                              'integer, got {!r}'.format(jobs))
+        return jobs
+
+    def ssh_multiplexing(self):
+        """whether bulk operations share one ssh connection per host"""
+        return bool(self.data.get('ssh-multiplexing', True))
+
+    def status_cache(self):
+        """whether unchanged repositories are answered from the status cache"""
+        return bool(self.data.get('status-cache', True))
+
+    def ui_status_level(self):
+        """the status level the UI evaluates (see GitRepository.status_at)"""
+        from .Repository import STATUS_LEVELS
+        level = self.data.get('ui-status-level', 'full')
+        if level not in STATUS_LEVELS:
+            raise UserMessage('Setting ui-status-level must be one of {}, got '
+                              '{!r}'.format(', '.join(STATUS_LEVELS), level))
+        return level
+
+    def watch(self):
+        """whether the UI updates the rows of changed repositories by itself"""
+        return bool(self.data.get('watch', True))
+
+    def detect_method(self):
+        """how repositories are discovered: 'crawl' or 'locate'"""
+        from .discovery import METHODS as DETECT_METHODS
+        method = self.data.get('detect-method', 'crawl')
+        if method not in DETECT_METHODS:
+            raise UserMessage('Setting detect-method must be one of {}, got '
+                              '{!r}'.format(', '.join(DETECT_METHODS), method))
+        return method
+
+    def detect_roots(self):
+        """the directories the crawler searches for repositories"""
+        return [os.path.expanduser(p)
+                for p in self.data.get('detect-roots', ['~'])]
+
+    def detect_exclude(self):
+        """the glob patterns of directories the crawler skips"""
+        return list(self.data.get('detect-exclude', []))
+
+    def detect_cache(self):
+        """whether the crawler keeps an index of the directories it read"""
+        return bool(self.data.get('detect-cache', True))
+
     def repositories(self):
         """the (mutable) mapping of repository path to its config entry"""
         repos = self.data.get('repositories')
@@ -168,6 +365,38 @@ class Config:
         lines.append('  A finished foreground (run-fg) command only prompts')
         lines.append('  with "Press enter to continue..." when it ran for')
         lines.append('  fewer than this many seconds.')
+        lines.append('jobs: {}'.format(self.jobs()))
+        lines.append('  The number of repositories evaluated at the same time')
+        lines.append('  (0 for one per CPU); -j/--jobs overrides it.')
+        lines.append('jobs-per-host: {}'.format(self.jobs_per_host()))
+        lines.append('  The number of network operations (e.g. fetch) talking')
+        lines.append('  to the same remote host at a time (0 for no limit).')
+        lines.append('ssh-multiplexing: {}'.format(self.ssh_multiplexing()))
+        lines.append('  Let fetch, clone and the UI\'s commands share one ssh')
+        lines.append('  connection per host (OpenSSH ControlMaster).')
+        lines.append('status-cache: {}'.format(self.status_cache()))
+        lines.append('  Reuse the last status of repositories whose git')
+        lines.append('  metadata and directories did not change.')
+        lines.append('ui-status-level: {}'.format(self.ui_status_level()))
+        lines.append('  How deep the UI evaluates a repository (like st')
+        lines.append('  --level): exists, dirty, ahead-behind or full.')
+        lines.append('watch: {}'.format(self.watch()))
+        lines.append('  Let the UI update a repository as soon as its git')
+        lines.append('  metadata changed (needs inotify, i.e. Linux).')
+        lines.append('detect-method: {}'.format(self.detect_method()))
+        lines.append('  How detect finds repositories: crawl the detect-roots')
+        lines.append('  directories, or query the locate database.')
+        lines.append('detect-roots: {}'.format(', '.join(
+            self.data.get('detect-roots', ['~']))))
+        lines.append('  The directories crawled for repositories.')
+        lines.append('detect-exclude: {}'.format(', '.join(
+            self.detect_exclude())))
+        lines.append('  Glob patterns of directories not to crawl (matched')
+        lines.append('  against the whole path if they contain a /).')
+        lines.append('detect-cache: {}'.format(self.detect_cache()))
+        lines.append('  Remember the crawled directories, so crawling again')
+        lines.append('  only reads the directories that changed, and the')
+        lines.append('  fingerprints clone matches found repositories by.')
         lines.append('')
 
         repos = self.repositories()
@@ -214,12 +443,38 @@ class Config:
         return '\n'.join(lines)
 
     def save(self):
-        with open(self.filepath(), 'w') as filehandle:
-            yaml.safe_dump(self.data, filehandle,
-                           sort_keys=False, default_flow_style=False)
+        # write a temporary file next to the config file and rename it over
+        # the latter, so a concurrent reader never sees a half-written config.
+        # A symlinked config (e.g. into a dotfiles repository) is written
+        # through, keeping the link in place.
+        target = os.path.realpath(self.filepath())
+        tmp = '{}.{}.tmp'.format(target, os.getpid())
+        try:
+            with open(tmp, 'w') as filehandle:
+                dump_yaml(self.data, filehandle)
+            try:
+                os.chmod(tmp, stat.S_IMODE(os.stat(target).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    @property
+    def repo_objects(self):
+        """the repository objects by path, built on first use: commands not
+        looking at the repositories don't pay for creating them"""
+        if self._repo_objects is None:
+            self.build_repo_objects()
+        return self._repo_objects
 
     def build_repo_objects(self):
-        self.repo_objects = {}
+        from .Repository import GitRepository, GitSvnRepository
+        repo_objects = {}
         classes = {
             'git': GitRepository,
             'git-svn': GitSvnRepository,
@@ -228,7 +483,8 @@ class Config:
             config = repo_entry_to_config(path, entry)
             repo_type = config.get('type', 'git')
             if repo_type in classes:
-                self.repo_objects[path] = classes[repo_type](path, config)
+                repo_objects[path] = classes[repo_type](path, config)
             else:
                 raise UserMessage('Error in entry {}: unknown type \'{}\''\
                     .format(path, repo_type))
+        self._repo_objects = repo_objects
@@ -6,9 +6,30 @@ object that loads them from the metagit config file lives in Config.py.
 """
 import os
 import sys
+import weakref
+import contextlib
 import subprocess
-
-from .utils import UserMessage, debug, warning, tilde_encode
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import STATUS_LEVELS, UserMessage, debug, warning, tilde_encode
+from .gitdir import (
+    CommitGraph,
+    abbrev_head,
+    ahead_behind,
+    config_get,
+    fetch_changes,
+    find_git_dir,
+    head_branch,
+    parse_ls_remote,
+    read_config,
+    read_symref,
+    read_user_config,
+    rev_parse,
+    rewrite_url,
+    upstream_ref,
+)
+from .index import quick_dirty
+from . import trace
 
 
 class RepoStatus:
@@ -18,6 +39,13 @@ class RepoStatus:
         self.uncommited_changes = 0
         self.unpushed_commits = 0
         self.unmerged_commits = 0
+        # set by the status levels below 'full' (see status_at), which only
+        # tell whether the tracked files have uncommitted changes: then dirty
+        # is True or False and the file counts above are None (not counted)
+        self.dirty = None
+        # the STATUS_LEVELS entry the status was evaluated at; what a lower
+        # level did not look at is None
+        self.level = 'full'
         pass
 
     @staticmethod
@@ -25,17 +53,86 @@ class RepoStatus:
         rs = RepoStatus()
         rs.exists = False
         return rs
+
+    # the attributes saved by to_dict() and restored by from_dict()
+    FIELDS = ('exists', 'untracked_files', 'uncommited_changes',
+              'unpushed_commits', 'unmerged_commits', 'dirty', 'level')
+
+    def to_dict(self):
+        """a JSON serializable representation, see from_dict()"""
+        return {name: getattr(self, name) for name in RepoStatus.FIELDS}
+
+    @staticmethod
+    def from_dict(data):
+        rs = RepoStatus()
+        for name in RepoStatus.FIELDS:
+            if name in data:
+                setattr(rs, name, data[name])
+        return rs
     def __str__(self):
         if not self.exists:
             return "does not exist"
         else:
+            # what a lower status level did not look at is None
             msg = ""
-            msg += "uncommited " if self.uncommited_changes > 0 else "clean "
-            msg += "unpushed " if self.unpushed_commits > 0 else "fully published"
+            if self.uncommited_changes is None and self.dirty is None:
+                msg += "changes unchecked "
+            else:
+                msg += "uncommited " if self.uncommited_changes or self.dirty \
+                    else "clean "
+            if self.unpushed_commits is None:
+                msg += "commits unchecked"
+            else:
+                msg += "unpushed " if self.unpushed_commits > 0 \
+                    else "fully published"
             return msg
 
 
+# the maximum number of commands started by GitRepository.acall() that run at
+# the same time, per event loop (see set_async_limit)
+_async_limit = 64
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_async_limit(limit):
+    """bound the number of concurrently running acall() commands"""
+    global _async_limit
+    _async_limit = max(1, limit)
+    _async_semaphores.clear()
+
+
+def _async_semaphore():
+    """the semaphore shared by all acall()s on the running event loop"""
+    # asyncio is slow to import and only needed by the acall() users, so it
+    # is imported on first use (the acall() callers already have it loaded)
+    import asyncio
+    loop = asyncio.get_running_loop()
+    semaphore = _async_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(_async_limit)
+        _async_semaphores[loop] = semaphore
+    return semaphore
+
+
+# the single call status() gets the changed files and the ahead/behind counts
+# of the checked out branch from. GIT_OPTIONAL_LOCKS=0 keeps git from
+# refreshing the index, so it never contends for index.lock with a git command
+# the user runs at the same time.
+_STATUS_CMD = ('git', 'status', '--porcelain=2', '--branch', '-z')
+_STATUS_ENV = {'GIT_OPTIONAL_LOCKS': '0'}
+# exits with 1 at the first change of a tracked file (add '--cached' for the
+# staged changes)
+_DIFF_QUIET_CMD = ('git', 'diff', '--quiet', '--no-ext-diff')
+_ORIGIN_HEAD_CMD = ('git', 'symbolic-ref', '--short',
+                    'refs/remotes/origin/HEAD')
+
+
 class GitRepository:
+    # the Metagit.ssh.Multiplexer of the running bulk operation, if any:
+    # call() runs every command in its session(), sharing one ssh connection
+    # per host
+    ssh = None
+
     def __init__(self, tilde_path, config):
         self.tilde_path = tilde_path
         self.path = os.path.expanduser(tilde_path)
@@ -47,10 +144,10 @@ class GitRepository:
         # if the fingerprint of two repos match, then it is likely
         # that they are the same repository
         return tuple(map(lambda a: self.config.get(a, None), \
-                ('type', 'branch', 'url')))
+                FINGERPRINT_KEYS))
 
     def call(self, *args, stdout=None, stderr=subprocess.PIPE, may_fail=False,
-             quiet=False, shell=False):
+             quiet=False, shell=False, env=None):
         """run a command with the repository as the working directory.
 
         With shell=False (the default) `args` is the full argument list of a
@@ -59,18 +156,75 @@ class GitRepository:
         commands. Either way it runs inside the repository, so git picks up the
         working tree on its own. When the directory does not exist yet (e.g.
         'git clone', which creates it and is given an explicit destination) the
-        command runs from the current working directory instead.
+        command runs from the current working directory instead. `env` maps
+        additional environment variables to set for the command.
+        """
+        cmd, cmd_str, cwd, env = self._prepare_call(args, shell, env)
+        with self._ssh_session(cmd, env) as env:
+            started = trace.clock()
+            proc = subprocess.Popen(cmd, stdout = stdout, \
+                                    stderr = stderr, cwd = cwd, \
+                                    shell = shell, env = env)
+            out,err = proc.communicate()
+            exit_code = proc.wait()
+        trace.record(cmd_str, started, exit_code, out, err, cwd)
+        return self._finish_call(cmd_str, exit_code, out, err, may_fail, quiet)
+
+    async def acall(self, *args, stdout=None, stderr=subprocess.PIPE,
+                    may_fail=False, quiet=False, shell=False, env=None):
+        """the asyncio counterpart of call(), taking the same arguments.
+
+        The command is run with asyncio's subprocess support, so any number of
+        them can be awaited from a single event loop without a thread each. At
+        most the number set by set_async_limit() run at the same time. Waiting
+        for the `ssh` multiplexer's session (which may open a master
+        connection first) happens in a worker thread, off the event loop.
         """
+        import asyncio
+        cmd, cmd_str, cwd, env = self._prepare_call(args, shell, env)
+        async with _async_semaphore():
+            session = self._ssh_session(cmd, env)
+            if self.ssh is None:
+                env = session.__enter__()
+            else:
+                env = await asyncio.to_thread(session.__enter__)
+            try:
+                started = trace.clock()
+                if shell:
+                    proc = await asyncio.create_subprocess_shell(
+                        cmd, stdout=stdout, stderr=stderr, cwd=cwd, env=env)
+                else:
+                    proc = await asyncio.create_subprocess_exec(
+                        *cmd, stdout=stdout, stderr=stderr, cwd=cwd, env=env)
+                out, err = await proc.communicate()
+            finally:
+                session.__exit__(None, None, None)
+            trace.record(cmd_str, started, proc.returncode, out, err, cwd)
+        return self._finish_call(cmd_str, proc.returncode, out, err,
+                                 may_fail, quiet)
+
+    def _prepare_call(self, args, shell, env):
+        """the command, its printable form, working directory and environment
+        for call() and acall()"""
         cmd = args[0] if shell else list(args)
         cmd_str = cmd if shell else ' '.join(cmd)
         cwd = self.path if os.path.isdir(self.path) else None
         debug('calling', cmd_str, 'in', cwd if cwd else '.')
-        proc = subprocess.Popen(cmd, stdout = stdout, \
-                                stderr = stderr, cwd = cwd, shell = shell)
-        out,err = proc.communicate()
+        if env is not None:
+            env = dict(os.environ, **env)
+        return cmd, cmd_str, cwd, env
+
+    def _ssh_session(self, cmd, env):
+        """the context manager call() runs `cmd` in: the `ssh` multiplexer's
+        session, if one is active"""
+        if self.ssh is None:
+            return contextlib.nullcontext(env)
+        return self.ssh.session(self, cmd, env)
+
+    def _finish_call(self, cmd_str, exit_code, out, err, may_fail, quiet):
+        """evaluate a finished command for call() and acall()"""
         if not out is None:
             out = out.decode()
-        exit_code = proc.wait()
         if may_fail:
             return exit_code, out
         if exit_code != 0:
@@ -82,21 +236,101 @@ class GitRepository:
                 print(err.decode(), end='', file=sys.stderr)
         return out
 
+    # The status logic is written once, as generators ('steps') that yield
+    # the commands they need as (args, kwargs) of call() and receive the
+    # result (or the raised exception) back. _run() drives them with call()
+    # and _arun() with acall(), e.g. status_at() and astatus().
+    def _run(self, steps):
+        """run the generator `steps` with call(), returning its result"""
+        result = error = None
+        while True:
+            try:
+                if error is None:
+                    args, kwargs = steps.send(result)
+                else:
+                    args, kwargs = steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = self.call(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+
+    async def _arun(self, steps):
+        """run the generator `steps` with acall(), returning its result"""
+        result = error = None
+        while True:
+            try:
+                if error is None:
+                    args, kwargs = steps.send(result)
+                else:
+                    args, kwargs = steps.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = await self.acall(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+
     def exists(self):
         return os.path.isdir(self.path)
 
+    def fetch_args(self):
+        """the arguments to 'git' that fetch the repository"""
+        return ['fetch']
+
     def fetch(self, quiet=False):
         if self.exists():
-            # fetch
-            self.call('git', 'fetch', quiet=quiet)
+            self.call('git', *self.fetch_args(), quiet=quiet)
+
+    async def afetch(self, quiet=False):
+        """the asyncio counterpart of fetch()"""
+        if self.exists():
+            await self.acall('git', *self.fetch_args(), quiet=quiet)
+
+    def fetch_needed(self):
+        """whether 'git fetch' would change anything.
+
+        Asks the remote for its refs with 'git ls-remote', which transfers no
+        objects, and compares them with the remote-tracking refs (see
+        gitdir.fetch_changes). True whenever that can not tell.
+        """
+        git_dir = find_git_dir(self.path)
+        if git_dir is None:
+            return True
+        config = read_config(git_dir)
+        if config is None or any(key == 'include.path'
+                                 or key.startswith('includeif.')
+                                 for key in config):
+            return True
+        # like 'git fetch' without arguments: the checked out branch's remote
+        branch = head_branch(git_dir)
+        remote = 'origin'
+        if branch is not None:
+            remote = config_get(config, 'branch.{}.remote'.format(branch),
+                                remote)
+        merged = dict(read_user_config())
+        for key, values in config.items():
+            merged[key] = merged.get(key, []) + values
+        out = self.call('git', 'ls-remote', remote, stdout=subprocess.PIPE,
+                        quiet=True)
+        return fetch_changes(git_dir, remote, parse_ls_remote(out),
+                             merged) is not False
+
+    def fetch_if_needed(self, quiet=False):
+        """fetch() unless fetch_needed() says nothing changed; returns whether
+        it fetched"""
+        if not self.exists() or not self.fetch_needed():
+            return False
+        self.fetch(quiet=quiet)
+        return True
 
     def push(self):
         if self.exists():
             self.call('git', 'push', stderr=None)
 
-    def clone(self):
-        if self.exists():
-            return # nothing to do
+    def clone_args(self):
+        """the arguments to 'git' that clone the repository"""
         if not 'url' in self.config:
             raise UserMessage('Can not run \'git clone\', because url is unset.', self)
         origin = self.config['url']
@@ -106,15 +340,50 @@ class GitRepository:
             # whatever the remote advertises as its default branch
             args += ['-b', self.config['branch']]
         args += [origin, self.path]
-        self.call('git', *args, stderr=None)
+        return args
+
+    def clone(self, quiet=False):
+        if self.exists():
+            return # nothing to do
+        self.call('git', *self.clone_args(), **self._clone_output(quiet))
+
+    async def aclone(self, quiet=False):
+        """the asyncio counterpart of clone()"""
+        if self.exists():
+            return
+        await self.acall('git', *self.clone_args(),
+                         **self._clone_output(quiet))
+
+    @staticmethod
+    def _clone_output(quiet):
+        """the call() arguments for the output of 'git clone'"""
+        if quiet:
+            # e.g. for concurrent clones, whose progress would be interleaved
+            return {'quiet': True}
+        return {'stderr': None}
 
     def main_branch(self):
+        return self._run(self._main_branch_steps())
+
+    def _main_branch_steps(self):
         if 'branch' in self.config:
             return self.config['branch']
         if not hasattr(self, '_detected_main_branch'):
-            self._detected_main_branch = self.detect_main_branch()
+            self._detected_main_branch = \
+                yield from self._detect_main_branch_steps()
         return self._detected_main_branch
 
+    def _origin_head(self):
+        """the branch origin/HEAD points to, if readable without git"""
+        git_dir = find_git_dir(self.path)
+        if git_dir is not None:
+            # usually a loose symbolic ref, which we can read directly
+            head = read_symref(git_dir, 'refs/remotes/origin/HEAD')
+            prefix = 'refs/remotes/origin/'
+            if head is not None and head.startswith(prefix):
+                return head[len(prefix):]
+        return None
+
     def detect_main_branch(self):
         """detect a repository's default branch.
 
@@ -123,13 +392,16 @@ class GitRepository:
         (origin/HEAD, as set up by 'git clone'); when that is unavailable we
         fall back to 'master'.
         """
+        return self._run(self._detect_main_branch_steps())
+
+    def _detect_main_branch_steps(self):
         if self.exists():
-            exit_code, head = self.call('git', 'symbolic-ref', '--short', \
-                'refs/remotes/origin/HEAD', \
-                stdout=subprocess.PIPE, may_fail=True)
-            if exit_code == 0:
-                # e.g. 'origin/main' -> 'main'
-                return head.rstrip('\n').split('/', 1)[-1]
+            branch = self._origin_head()
+            if branch is not None:
+                return branch
+            exit_code, head = yield _ORIGIN_HEAD_CMD, \
+                dict(stdout=subprocess.PIPE, may_fail=True)
+            return _origin_head_branch(exit_code, head)
         return 'master'
 
     def upstream_branch(self):
@@ -164,32 +436,186 @@ class GitRepository:
         return self.tilde_path
 
     def status(self):
+        return self._run(self._status_steps())
+
+    def _status_steps(self):
         p = self.path
         if not os.path.isdir(p):
             return RepoStatus.nonExistent()
         else:
             rs = RepoStatus()
-            git_status_lines = self.call('git', 'status', '--porcelain=1', stdout=subprocess.PIPE).splitlines()
-            for line in git_status_lines:
-                if line[0:2] == '??':
-                    rs.untracked_files += 1
-                else:
-                    rs.uncommited_changes += 1
+            out = yield _STATUS_CMD, dict(stdout=subprocess.PIPE,
+                                          env=_STATUS_ENV)
+            headers = parse_porcelain_v2(out, rs)
             try:
-                rs.unmerged_commits = len( \
-                    self.call('git', 'log', '--format=format:X', \
-                        self.main_branch() + '..' + self.upstream_branch(), \
-                    stdout=subprocess.PIPE) \
-                    .replace('\n', ''))
-                rs.unpushed_commits = len( \
-                    self.call('git', 'log', '--format=format:X', \
-                         self.upstream_branch() + '..' + self.main_branch(), \
-                    stdout=subprocess.PIPE) \
-                    .replace('\n', ''))
+                counts = yield from self._branch_counts_steps(headers)
+                if counts is None:
+                    counts = yield from self._count_commits_steps()
+                rs.unpushed_commits, rs.unmerged_commits = counts
             except Exception as e:
                 warning("Warning: Can not count commits: {}".format(e))
             return rs
 
+    def _branch_counts_steps(self, headers):
+        """the (unpushed, unmerged) counts from the parse_porcelain_v2()
+        headers, or None when they do not describe the main branch"""
+        ab = headers.get('branch.ab')
+        if ab is None or self.upstream_branch() != '@{u}':
+            return None
+        main = yield from self._main_branch_steps()
+        if headers.get('branch.head') != main:
+            return None
+        # '+<ahead> -<behind>' of the checked out main branch
+        ahead, behind = ab.split()
+        return int(ahead.lstrip('+')), int(behind.lstrip('-'))
+
+    def status_at(self, level='full'):
+        """the status evaluated only as deep as `level`, one of
+        STATUS_LEVELS:
+
+          exists        whether the repository is checked out
+          dirty         and whether its tracked files have uncommitted
+                        changes (is_dirty(); untracked files are not looked
+                        for, no files are counted)
+          ahead-behind  and the commits to push and to merge
+          full          status(): everything, with file counts
+
+        What a level does not look at is None in the RepoStatus.
+        """
+        return self._run(self._status_at_steps(level))
+
+    async def astatus(self, level='full'):
+        """the asyncio counterpart of status_at(), running git with
+        acall()"""
+        return await self._arun(self._status_at_steps(level))
+
+    def _status_at_steps(self, level):
+        if level == 'full':
+            return (yield from self._status_steps())
+        if level not in STATUS_LEVELS:
+            raise UserMessage('Unknown status level {!r}, expected one of {}'
+                              .format(level, ', '.join(STATUS_LEVELS)))
+        if not os.path.isdir(self.path):
+            return RepoStatus.nonExistent()
+        rs = RepoStatus()
+        rs.level = level
+        rs.untracked_files = None
+        rs.uncommited_changes = None
+        rs.unpushed_commits = None
+        rs.unmerged_commits = None
+        if level == 'exists':
+            return rs
+        rs.dirty = yield from self._is_dirty_steps()
+        if level == 'ahead-behind':
+            try:
+                rs.unpushed_commits, rs.unmerged_commits = \
+                    yield from self._count_commits_steps()
+            except Exception as e:
+                warning("Warning: Can not count commits: {}".format(e))
+        return rs
+
+    def is_dirty(self):
+        """whether the tracked files have uncommitted changes, staged or not.
+
+        Decided in-process by comparing the index with the files' stat data
+        (see index.quick_dirty) when that is conclusive, otherwise by 'git
+        diff --quiet' and 'git diff --cached --quiet', which stop at the first
+        difference. Untracked files are not looked for.
+        """
+        return self._run(self._is_dirty_steps())
+
+    def _is_dirty_steps(self):
+        git_dir = find_git_dir(self.path)
+        dirty = None if git_dir is None else quick_dirty(self.path, git_dir)
+        if dirty is not None:
+            return dirty
+        for args in (_DIFF_QUIET_CMD, _DIFF_QUIET_CMD + ('--cached',)):
+            exit_code, _out = yield args, dict(stdout=subprocess.DEVNULL,
+                                               env=_STATUS_ENV, may_fail=True)
+            if exit_code == 1:
+                return True
+            if exit_code != 0:
+                raise UserMessage('Command »{}« failed with exit code {}'
+                                  .format(' '.join(args), exit_code))
+        return False
+
+    def count_commits(self):
+        """count the commits (unpushed, unmerged) between the main branch and
+        its upstream.
+
+        Computed in-process from the refs and the commit-graph when possible
+        (see count_commits_in_process), otherwise with a single 'git rev-list'
+        call.
+        """
+        return self._run(self._count_commits_steps())
+
+    def _count_commits_steps(self):
+        # detected (and memoized) first, so the helpers below don't run git
+        # on their own
+        yield from self._main_branch_steps()
+        counts = self.count_commits_in_process()
+        if counts is not None:
+            return counts
+        out = yield self._rev_list_args(), dict(stdout=subprocess.PIPE)
+        unpushed, unmerged = out.split()
+        return int(unpushed), int(unmerged)
+
+    def _rev_list_args(self):
+        return ('git', 'rev-list', '--left-right', '--count',
+                self.main_branch() + '...' + self.upstream_branch(), '--')
+
+    def resolve_upstream(self, git_dir):
+        """the object id of upstream_branch(), read from the git dir (or None)"""
+        upstream = self.upstream_branch()
+        if upstream != '@{u}':
+            return rev_parse(git_dir, upstream)
+        ref = self._tracked_ref(git_dir)
+        return None if ref is None else rev_parse(git_dir, ref)
+
+    def _tracked_ref(self, git_dir):
+        """the full ref name '@{u}' stands for: the upstream of the checked
+        out branch (or None)"""
+        branch = head_branch(git_dir)
+        config = read_config(git_dir)
+        if branch is None or config is None:
+            return None
+        return upstream_ref(config, branch)
+
+    def upstream_name(self):
+        """the short name of the branch upstream_branch() stands for (e.g.
+        'origin/main'), read from the git dir; None if there is none"""
+        upstream = self.upstream_branch()
+        if upstream != '@{u}':
+            return upstream
+        git_dir = find_git_dir(self.path)
+        ref = None if git_dir is None else self._tracked_ref(git_dir)
+        if ref is None:
+            return None
+        for prefix in ('refs/remotes/', 'refs/heads/'):
+            if ref.startswith(prefix):
+                return ref[len(prefix):]
+        return ref
+
+    def count_commits_in_process(self):
+        """count_commits() without spawning git, or None if not possible.
+
+        Resolves both branches from the loose and packed refs; when both point
+        to the same commit the answer is immediate, otherwise the histories
+        are walked in the commit-graph. Returns None (so git is asked instead)
+        when a ref can not be resolved this way or a commit is not covered by
+        the commit-graph yet.
+        """
+        git_dir = find_git_dir(self.path)
+        if git_dir is None:
+            return None
+        main = rev_parse(git_dir, self.main_branch())
+        upstream = self.resolve_upstream(git_dir)
+        if main is None or upstream is None:
+            return None
+        if main == upstream:
+            return 0, 0
+        return ahead_behind(CommitGraph.load(git_dir), main, upstream)
+
 
 class GitSvnRepository(GitRepository):
     def __init__(self, tilde_path, config):
@@ -198,18 +624,18 @@ class GitSvnRepository(GitRepository):
     def upstream_branch(self):
         return 'git-svn'
 
-    def fetch(self, quiet=False):
-        if self.exists():
-            # fetch
-            self.call('git', 'svn', 'fetch', quiet=quiet)
+    def fetch_args(self):
+        return ['svn', 'fetch']
+
+    def fetch_needed(self):
+        # there are no refs to compare with the svn repository
+        return True
 
     def push(self):
         if self.exists():
             self.call('git', 'svn', 'dcommit', stderr=None)
 
-    def clone(self):
-        if self.exists():
-            return # nothing to do
+    def clone_args(self):
         if not 'url' in self.config:
             raise UserMessage('Can not run \'git svn clone\', ' \
                               + 'because url is unset.', self)
@@ -217,7 +643,43 @@ class GitSvnRepository(GitRepository):
         branch = self.main_branch()
         if branch != 'master':
             raise UserMessage('\'git svn clone\' only works for branch master.', self)
-        self.call('git', 'svn', 'clone', origin, self.path, stderr=None)
+        return ['svn', 'clone', origin, self.path]
+
+
+def _origin_head_branch(exit_code, head):
+    """the branch from the output of 'git symbolic-ref --short
+    refs/remotes/origin/HEAD', falling back to 'master'"""
+    if exit_code == 0:
+        # e.g. 'origin/main' -> 'main'
+        return head.rstrip('\n').split('/', 1)[-1]
+    return 'master'
+
+
+def parse_porcelain_v2(output, rs):
+    """count the files listed in 'git status --porcelain=2 --branch -z' output.
+
+    Fills in the untracked_files and uncommited_changes of the RepoStatus `rs`
+    and returns the '# <key> <value>' header lines as a dict (e.g. 'branch.head'
+    -> 'main', 'branch.ab' -> '+1 -0').
+    """
+    headers = {}
+    records = output.split('\0')
+    idx = 0
+    while idx < len(records):
+        record = records[idx]
+        idx += 1
+        if record.startswith('# '):
+            key, _, value = record[2:].partition(' ')
+            headers[key] = value
+        elif record.startswith('? '):
+            rs.untracked_files += 1
+        elif record.startswith('2 '):
+            # a rename or copy is followed by a record holding the original path
+            rs.uncommited_changes += 1
+            idx += 1
+        elif record.startswith(('1 ', 'u ')):
+            rs.uncommited_changes += 1
+    return headers
 
 
 def CreateRepositoryConfig(path = '.', needs_origin = True):
@@ -243,6 +705,63 @@ def CreateRepositoryConfig(path = '.', needs_origin = True):
     return git
 
 
+# the settings making up GitRepository.fingerprint()
+FINGERPRINT_KEYS = ('type', 'branch', 'url')
+
+
+def read_fingerprint(path, user_config=None):
+    """the fingerprint() of CreateRepositoryConfig(path, needs_origin=False),
+    read from the repository's files without running git.
+
+    `user_config` is the read_user_config() dict (read if None), which may
+    rewrite the remote url. Returns None when the answer depends on something
+    not handled here (e.g. config includes or the reftable ref format), in
+    which case CreateRepositoryConfig() has to ask git.
+    """
+    git_dir = find_git_dir(path)
+    bare = git_dir is None
+    if bare:
+        if not os.path.isfile(os.path.join(path, 'HEAD')):
+            return None
+        git_dir = path
+    config = read_config(git_dir)
+    if config is None \
+            or config_get(config, 'extensions.refstorage', 'files') != 'files' \
+            or any(key == 'include.path' or key.startswith('includeif.')
+                   for key in config):
+        return None
+    if user_config is None:
+        user_config = read_user_config()
+    # the branch is only recorded when it deviates from the default branch,
+    # i.e. what origin/HEAD points to (see GitRepository.detect_main_branch)
+    main = 'master'
+    origin_head = read_symref(git_dir, 'refs/remotes/origin/HEAD')
+    prefix = 'refs/remotes/origin/'
+    if origin_head is not None and origin_head.startswith(prefix):
+        main = origin_head[len(prefix):]
+    branch = abbrev_head(git_dir)
+    if branch is None and bare:
+        # without a working tree to mistake it for a path, rev-parse echoes
+        # an unresolvable 'HEAD' (of an unborn branch) instead of failing
+        branch = 'HEAD'
+    if branch == main:
+        branch = None
+    svn_url = config_get(config, 'svn-remote.svn.url')
+    if svn_url is not None:
+        return ('git-svn', branch, svn_url)
+    # like detect_upstream_url(): the url of the remote the branch tracks
+    remote = config_get(config, 'branch.{}.remote'.format(branch or main))
+    url = None
+    if remote is not None:
+        url = config_get(config, 'remote.{}.url'.format(remote))
+        if url is not None:
+            merged = dict(user_config)
+            for key, values in config.items():
+                merged[key] = merged.get(key, []) + values
+            url = rewrite_url(url, merged)
+    return (None, branch, url)
+
+
 # the locate database metagit maintains itself (see update_locate_database).
 # The system-wide database is usually built by a root cron job that excludes
 # the home directory, so metagit keeps its own database of the user's files.
@@ -278,8 +797,11 @@ def update_locate_database():
     cmd = ['updatedb', '--localpaths=' + home, '--output=' + METAGIT_LOCATE_DB]
     # discard updatedb's stderr (transient "no such file" warnings for files
     # that vanish mid-scan); it would otherwise corrupt the ncurses display
+    started = trace.clock()
     proc = subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
-    if proc.wait() != 0:
+    exit_code = proc.wait()
+    trace.record(' '.join(cmd), started, exit_code)
+    if exit_code != 0:
         raise UserMessage('»updatedb« failed to build {}'.format(
             METAGIT_LOCATE_DB))
 
@@ -289,10 +811,12 @@ def locate_git_repositories():
     database = locate_database()
     if database is not None:
         cmd[1:1] = ['-d', database]
+    started = trace.clock()
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE)
     stdout, _ = proc.communicate()
     status = proc.wait()
+    trace.record(' '.join(cmd), started, status, stdout)
     if status != 0:
         return []
     res = []
@@ -304,15 +828,37 @@ def locate_git_repositories():
     return res
 
 
-def repositories_in_filesystem():
-    # return a dictionary of all git repos in the file system
+def repositories_in_filesystem(paths=None, cache=None, jobs=None):
+    # return a dictionary of all git repos in the file system, found in
+    # `paths` (an iterable of repository paths, by default from locate),
+    # by their fingerprint. The fingerprints are read in-process where
+    # possible, on `jobs` threads, and looked up in and stored to the
+    # FingerprintCache `cache` if given.
     if hasattr(repositories_in_filesystem, 'dict'):
         return repositories_in_filesystem.dict
     print("Searching for repositories in the entire file system...", file=sys.stderr)
+    if paths is None:
+        paths = locate_git_repositories()
+    user_config = read_user_config()
+
+    def compute(path):
+        fp = read_fingerprint(path, user_config)
+        if fp is None:
+            fp = CreateRepositoryConfig(path, needs_origin = False) \
+                .fingerprint()
+        return fp
+
+    def fingerprint(path):
+        if cache is not None:
+            return path, cache.fingerprint(path, compute)
+        return path, compute(path)
+
     located_repos = { }
-    for p in locate_git_repositories():
-        r = CreateRepositoryConfig(p, needs_origin = False)
-        fp = r.fingerprint()
-        located_repos[fp] = r
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='metagit-fingerprint') as pool:
+        for p, fp in pool.map(fingerprint, paths):
+            config = {key: value for key, value in zip(FINGERPRINT_KEYS, fp)
+                      if value is not None}
+            located_repos[fp] = GitRepository(tilde_encode(p), config)
     repositories_in_filesystem.dict = located_repos
     return repositories_in_filesystem.dict
@@ -0,0 +1,291 @@
+"""Speeding up 'git status' in repositories with huge working trees.
+
+The 'git status' of GitRepository.status() spends most of its time on large
+working trees comparing the index with the files and scanning the directories
+for untracked files. git has settings that make this cheaper, but whether they
+pay off depends on the repository (and the filesystem):
+
+  untracked-cache  core.untrackedCache: remember which directories had no
+                   untracked files, and only scan those whose mtime changed
+  index-v4         index.version 4 (the part of feature.manyFiles besides
+                   the untracked cache): a prefix-compressed, smaller index
+  split-index      core.splitIndex: only rewrite the changed entries of the
+                   index. read_index() can not read a split index, so it
+                   turns off the status cache and the in-process dirty check
+                   for the repository; it is therefore not tried by default
+  fsmonitor        core.fsmonitor with git's built-in daemon: only look at
+                   the files changed since the last status (only where git
+                   supports the daemon on the platform)
+
+accelerate() enables them in a repository one at a time, verifies that git
+actually uses them (the index's format, the daemon answering) and times the
+repository's status before and after. An acceleration that does not make the
+status at least MIN_GAIN faster is reverted, unless the repository's config
+entry asks for it explicitly (see configured()). The timings are kept in an
+AccelerationLog, so 'metagit accelerate --report' shows which repositories
+benefited.
+"""
+import os
+import json
+import time
+import subprocess
+
+from .gitdir import find_git_dir
+from .index import read_index, UnsupportedIndex
+# the very command GitRepository.status() runs
+from .Repository import _STATUS_CMD, _STATUS_ENV
+from .utils import UserMessage, cache_dir, debug
+from . import trace
+
+
+ACCELERATIONS = ('untracked-cache', 'index-v4', 'split-index', 'fsmonitor')
+
+# what is tried in a repository whose config entry has no 'accelerate' key
+DEFAULT_ACCELERATIONS = ('untracked-cache', 'index-v4', 'fsmonitor')
+
+# the git config settings of every acceleration
+_SETTINGS = {
+    'untracked-cache': (('core.untrackedCache', 'true'),),
+    'index-v4': (('index.version', '4'),),
+    'split-index': (('core.splitIndex', 'true'),),
+    'fsmonitor': (('core.fsmonitor', 'true'),),
+}
+
+# the commands applying an acceleration to the existing index (the settings
+# alone only take effect when git rewrites it, or creates a new one)
+_ENABLE_CMDS = {
+    'untracked-cache': ('git', 'update-index', '--untracked-cache'),
+    'index-v4': ('git', 'update-index', '--index-version', '4'),
+    'split-index': ('git', 'update-index', '--split-index'),
+    'fsmonitor': ('git', 'fsmonitor--daemon', 'start'),
+}
+
+# a status counts as faster when it takes at most (1 - MIN_GAIN) of the time
+# before and saves at least MIN_SAVING seconds; smaller differences are within
+# the noise of the measurement, or not worth a setting
+MIN_GAIN = 0.1
+MIN_SAVING = 0.005
+
+# the status is timed this often, the fastest run counting
+TIMING_RUNS = 3
+
+
+def configured(repo):
+    """the accelerations to try in `repo` and whether they are kept
+    regardless of the timings, from the 'accelerate' key of its config entry:
+
+      (absent)  DEFAULT_ACCELERATIONS, kept where they make status faster
+      a list    exactly these, kept (e.g. [untracked-cache, split-index])
+      false     none; the repository is left alone
+    """
+    setting = repo.config.get('accelerate')
+    if setting is None or setting is True:
+        return DEFAULT_ACCELERATIONS, False
+    if setting is False:
+        return (), True
+    if isinstance(setting, str):
+        setting = [setting]
+    if not isinstance(setting, list):
+        raise UserMessage('Error in entry {}: accelerate must be a list or a '
+                          'boolean, got {!r}'.format(repo.tilde_path, setting))
+    for name in setting:
+        if name not in ACCELERATIONS:
+            raise UserMessage('Error in entry {}: unknown acceleration {!r}, '
+                              'expected one of {}'.format(
+                                  repo.tilde_path, name,
+                                  ', '.join(ACCELERATIONS)))
+    return tuple(setting), True
+
+
+def _index_format(repo):
+    """the version and the extension signatures of the repository's index,
+    (None, ()) when there is none"""
+    git_dir = find_git_dir(repo.path)
+    if git_dir is None:
+        return None, ()
+    try:
+        index = read_index(git_dir, strict=False)
+    except (OSError, UnsupportedIndex):
+        return None, ()
+    return index.version, index.extensions
+
+
+def active(repo, name):
+    """whether git uses the acceleration `name` in `repo`"""
+    if name == 'fsmonitor':
+        exit_code, _out = repo.call('git', 'fsmonitor--daemon', 'status',
+                                    stdout=subprocess.DEVNULL, may_fail=True)
+        return exit_code == 0
+    version, extensions = _index_format(repo)
+    if name == 'untracked-cache':
+        return 'UNTR' in extensions
+    if name == 'index-v4':
+        return version == 4
+    if name == 'split-index':
+        return 'link' in extensions
+    raise UserMessage('Unknown acceleration {!r}'.format(name))
+
+
+def _get_config(repo, key):
+    exit_code, out = repo.call('git', 'config', '--local', '--get', key,
+                               stdout=subprocess.PIPE, may_fail=True)
+    return out.rstrip('\n') if exit_code == 0 else None
+
+
+def _set_config(repo, key, value):
+    """set the repository's `key` to `value`, or unset it for None"""
+    if value is None:
+        # exits with 5 when it was not set
+        repo.call('git', 'config', '--local', '--unset-all', key,
+                  may_fail=True)
+    else:
+        repo.call('git', 'config', '--local', key, value)
+
+
+def refresh(repo):
+    """let git rewrite the index with the current settings: metagit's own
+    status runs with GIT_OPTIONAL_LOCKS=0 and never writes it, so e.g. the
+    untracked cache is only filled by this (or a git command of the user)"""
+    repo.call('git', 'status', '--porcelain', stdout=subprocess.DEVNULL,
+              quiet=True)
+
+
+def enable(repo, name):
+    """turn the acceleration `name` on in `repo`; returns what disable()
+    needs to restore the previous state"""
+    saved = {key: _get_config(repo, key) for key, _value in _SETTINGS[name]}
+    if name == 'index-v4':
+        saved['version'] = _index_format(repo)[0]
+    try:
+        for key, value in _SETTINGS[name]:
+            _set_config(repo, key, value)
+        repo.call(*_ENABLE_CMDS[name], stdout=subprocess.DEVNULL, quiet=True)
+        refresh(repo)
+    except UserMessage:
+        disable(repo, name, saved)
+        raise
+    return saved
+
+
+def disable(repo, name, saved):
+    """undo enable(), restoring the settings `saved`"""
+    for key, _value in _SETTINGS[name]:
+        _set_config(repo, key, saved.get(key))
+    if name == 'fsmonitor':
+        repo.call('git', 'fsmonitor--daemon', 'stop',
+                  stdout=subprocess.DEVNULL, may_fail=True)
+    elif name == 'untracked-cache':
+        repo.call('git', 'update-index', '--no-untracked-cache',
+                  stdout=subprocess.DEVNULL, may_fail=True)
+    elif name == 'split-index':
+        repo.call('git', 'update-index', '--no-split-index',
+                  stdout=subprocess.DEVNULL, may_fail=True)
+    elif name == 'index-v4':
+        repo.call('git', 'update-index', '--index-version',
+                  str(saved.get('version') or 2), stdout=subprocess.DEVNULL,
+                  may_fail=True)
+    refresh(repo)
+
+
+def status_time(repo, runs=TIMING_RUNS):
+    """the seconds the 'git status' of GitRepository.status() takes in
+    `repo`, the fastest of `runs` runs after a first one warming the caches
+    up"""
+    timings = []
+    for _ in range(runs + 1):
+        started = trace.clock()
+        repo.call(*_STATUS_CMD, stdout=subprocess.DEVNULL, env=_STATUS_ENV)
+        timings.append(trace.clock() - started)
+    return min(timings[1:])
+
+
+def accelerate(repo, names, keep=False):
+    """try the accelerations `names` in `repo`, one after the other, keeping
+    those making the status faster by MIN_GAIN and MIN_SAVING (all of them
+    with keep=True).
+
+    Returns the record of the outcome (as kept by an AccelerationLog): the
+    status time 'before' and 'after', the accelerations 'kept', 'reverted',
+    'unsupported' (mapped to the reason) and found 'active' before, and the
+    status time with each acceleration tried in 'timings'.
+    """
+    record = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'kept': [],
+        'reverted': [],
+        'unsupported': {},
+        'active': [n for n in names if active(repo, n)],
+        'timings': {},
+    }
+    best = record['before'] = status_time(repo)
+    for name in names:
+        if name in record['active']:
+            continue
+        debug('trying {} in {}'.format(name, repo.tilde_path))
+        try:
+            saved = enable(repo, name)
+        except UserMessage as e:
+            debug('enabling {} failed: {}'.format(name, e))
+            record['unsupported'][name] = str(e)
+            continue
+        if not active(repo, name):
+            disable(repo, name, saved)
+            record['unsupported'][name] = 'not used by git after enabling it'
+            continue
+        seconds = record['timings'][name] = status_time(repo)
+        if keep or (seconds <= best * (1 - MIN_GAIN)
+                    and seconds <= best - MIN_SAVING):
+            record['kept'].append(name)
+            best = seconds
+        else:
+            disable(repo, name, saved)
+            record['reverted'].append(name)
+    if record['kept'] or record['reverted']:
+        record['after'] = status_time(repo)
+    else:
+        record['after'] = record['before']
+    return record
+
+
+def record_cells(record):
+    """the cells 'metagit accelerate' shows for an accelerate() record: the
+    status time before and after, and what became of every acceleration"""
+    def ms(seconds):
+        return '{:.1f} ms'.format(seconds * 1000)
+    lines = ['{}: on before'.format(n) for n in record['active']]
+    for outcome in ('kept', 'reverted'):
+        lines += ['{}: {} ({})'.format(n, outcome, ms(record['timings'][n]))
+                  for n in record[outcome]]
+    lines += ['{}: not supported'.format(n) for n in record['unsupported']]
+    return [ms(record['before']), ms(record['after']),
+            '\n'.join(lines) or '-']
+
+
+class AccelerationLog:
+    """the records of accelerate() by repository path, kept in the cache
+    directory"""
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'accelerate.json')
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path) as filehandle:
+                data = json.load(filehandle)
+        except (OSError, ValueError):
+            data = {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            data = {}
+        self.entries = data.get('repositories', {})
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {'version': self.VERSION, 'repositories': self.entries}
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as filehandle:
+            json.dump(data, filehandle, indent=1)
+        os.replace(tmp, self.path)
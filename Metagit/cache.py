@@ -0,0 +1,476 @@
+"""A persistent cache of the repository status.
+
+Most repositories do not change between two 'st' runs, yet computing their
+status means running git in each of them. The StatusCache keeps the last
+RepoStatus of every repository on disk together with a fingerprint of the stat
+data it depends on: the index, HEAD, the config, the loose and packed refs,
+the modification times of the directories holding tracked files (which catch
+files being created, deleted or renamed), the stat data of the tracked
+files (which catches files modified in place) and of the exclude files outside
+the working tree (info/exclude and core.excludesFile). As long as the
+fingerprint matches, the cached status is returned without spawning git.
+
+Like git's untracked cache, the fingerprint covers the mtime of every
+directory below an untracked one (e.g. an ignored node_modules or build
+tree), as a file created there may show up as a new untracked directory;
+their files are not stat()ed. Still, taking the fingerprint means a stat per
+tracked file, done in Python; where that costs more than evaluating the
+repository did (a huge working tree, where git is faster at it), the
+repository is not looked up, until measuring again every few runs tells
+otherwise.
+
+The FingerprintCache likewise keeps the fingerprint of every repository found
+in the filesystem (see Repository.repositories_in_filesystem), together with
+the stat data of the files it was read from.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+from .gitdir import (
+    common_dir,
+    config_get,
+    find_git_dir,
+    read_config,
+    read_symref,
+    read_user_config,
+    ref_path,
+    user_config_files,
+)
+from .index import read_index, UnsupportedIndex
+from .Repository import STATUS_LEVELS, RepoStatus
+from .utils import cache_dir, debug
+
+
+def _stamp(path):
+    """the stat data of `path` that changes whenever the file is replaced"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '-'
+    return '{} {} {}'.format(st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _walk_stamps(top, update, files=False, names=()):
+    """feed the mtime of every directory below `top` to update(), skipping
+    '.git'; with files=True also the mtime and size of every file, otherwise
+    of those whose name is in `names`"""
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name == '.git':
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                stack.append(entry.path)
+                update('{} {}\n'.format(entry.path, st.st_mtime_ns))
+            elif files or entry.name in names:
+                update('{} {} {}\n'.format(entry.path, st.st_mtime_ns,
+                                           st.st_size))
+
+
+def status_fingerprint(repo):
+    """a digest of the stat data the status of `repo` depends on.
+
+    Returns None when the repository has no (readable) git directory or its
+    index can not be read in-process, in which case its status is not cached.
+    """
+    git_dir = find_git_dir(repo.path)
+    if git_dir is None:
+        return None
+    try:
+        index = read_index(git_dir)
+    except (OSError, UnsupportedIndex):
+        return None
+    common = common_dir(git_dir)
+    digest = hashlib.blake2b(digest_size=16)
+
+    def update(text):
+        digest.update(text.encode('utf-8', 'replace'))
+
+    # the status also depends on the repository's settings (e.g. 'branch')
+    update(type(repo).__name__)
+    update(json.dumps(repo.config, sort_keys=True, default=str))
+    for path in (os.path.join(git_dir, 'index'),
+                 os.path.join(git_dir, 'HEAD'),
+                 os.path.join(common, 'config'),
+                 os.path.join(common, 'packed-refs')):
+        update('{} {}\n'.format(path, _stamp(path)))
+    for path in _exclude_files(git_dir):
+        update('{} {}\n'.format(path, _stamp(path)))
+    for refs in ('heads', 'remotes'):
+        _walk_stamps(os.path.join(common, 'refs', refs), update, files=True)
+    _worktree_stamps(repo.path, index.entries, update)
+    return digest.hexdigest()
+
+
+# the core.excludesFile of the user wide config, memoized per stat data of
+# the config files
+_user_excludes = (None, None)
+
+
+def _exclude_files(git_dir):
+    """the ignore files outside the working tree git reads for the
+    repository in `git_dir`: info/exclude and core.excludesFile (from the
+    repository's or the user's config, by default $XDG_CONFIG_HOME/git/ignore)
+    """
+    global _user_excludes
+    files = [os.path.join(common_dir(git_dir), 'info', 'exclude')]
+    path = config_get(read_config(git_dir), 'core.excludesfile')
+    if path is None:
+        stamp = ' '.join(_stamp(f) for f in user_config_files())
+        if _user_excludes[0] != stamp:
+            _user_excludes = (stamp, config_get(read_user_config(),
+                                                'core.excludesfile'))
+        path = _user_excludes[1]
+    if path is None:
+        xdg = os.environ.get('XDG_CONFIG_HOME') \
+            or os.path.join(os.path.expanduser('~'), '.config')
+        path = os.path.join(xdg, 'git', 'ignore')
+    files.append(os.path.expanduser(path))
+    return files
+
+
+def _worktree_stamps(worktree, entries, update):
+    """feed the stat data of the working tree the status depends on to
+    update(): of every directory holding tracked files (the index `entries`)
+    its mtime, the stat data of its tracked files and the mtime of its other
+    subdirectories and of every directory below them (which changes when a
+    file is created in an untracked tree), plus the stat data of the
+    .gitignore files there."""
+    root = os.fsencode(worktree)
+    tracked = set()
+    # the directories holding tracked files and their parents, b'' being the
+    # top of the working tree
+    directories = {b''}
+    for entry in entries:
+        tracked.add(entry.path)
+        parent = entry.path.rpartition(b'/')[0]
+        while parent not in directories:
+            directories.add(parent)
+            parent = parent.rpartition(b'/')[0]
+    for directory in sorted(directories):
+        path = root + b'/' + directory if directory else root
+        prefix = directory + b'/' if directory else b''
+        stamps = []
+        untracked = []
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as scan:
+                for item in scan:
+                    name = prefix + item.name
+                    if name in tracked:
+                        st = item.stat(follow_symlinks=False)
+                        stamps.append((item.name, st.st_mtime_ns,
+                                       st.st_ctime_ns, st.st_size))
+                    elif name not in directories and item.name != b'.git' \
+                            and item.is_dir(follow_symlinks=False):
+                        stamps.append((item.name, item.stat(
+                            follow_symlinks=False).st_mtime_ns))
+                        untracked.append(item.path)
+        except OSError:
+            # e.g. a directory removed meanwhile
+            update('{!r} -\n'.format(directory))
+            continue
+        stamps.sort()
+        update('{!r} {} {!r}\n'.format(directory, mtime, stamps))
+        for path in sorted(untracked):
+            _walk_stamps(os.fsdecode(path), update, names=('.gitignore',))
+
+
+class StatusCache:
+    """the on-disk cache of RepoStatus objects, keyed by repository path.
+
+    load() reads the cache file and save() writes it back (when anything
+    changed); status() is safe to call from several threads at once. The hits
+    and misses counters tell how many status() calls were answered from the
+    cache, `bypassed` how many were not even looked up, as taking the
+    repository's fingerprint cost more than evaluating it. With refresh=True
+    nothing is looked up, but the evaluated statuses are still stored.
+    """
+
+    VERSION = 1
+    # a repository that is not worthwhile() is measured again after this many
+    # status() calls bypassing the cache
+    REMEASURE_AFTER = 10
+    # the weight of a new measurement in the smoothed costs
+    SMOOTHING = 0.5
+
+    def __init__(self, path=None, refresh=False):
+        self.path = path or os.path.join(cache_dir(), 'status.json')
+        self.refresh = refresh
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._modified = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as filehandle:
+                data = json.load(filehandle)
+        except (OSError, ValueError):
+            # no cache yet, or an unreadable one: start over
+            data = {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            data = {}
+        self.entries = data.get('repositories', {})
+        return self
+
+    def save(self):
+        if not self._modified:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            data = {'version': self.VERSION, 'repositories': self.entries}
+            # write to a temporary file first, so a concurrent reader never
+            # sees a half-written cache
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as filehandle:
+                json.dump(data, filehandle)
+            os.replace(tmp, self.path)
+            self._modified = False
+
+    def lookup(self, repo, fingerprint, level='full'):
+        """the cached RepoStatus of `repo` if it matches `fingerprint` and
+        was evaluated at least as deep as `level`"""
+        entry = self.entries.get(repo.path)
+        if entry is None or entry.get('fingerprint') != fingerprint:
+            return None
+        rs = RepoStatus.from_dict(entry['status'])
+        if _level_rank(rs.level) < _level_rank(level):
+            return None
+        return rs
+
+    def snapshot(self, repo):
+        """the RepoStatus of `repo` recorded last, whether or not it is still
+        valid, or None"""
+        entry = self.entries.get(repo.path)
+        if entry is None:
+            return None
+        return RepoStatus.from_dict(entry['status'])
+
+    def store(self, repo, fingerprint, rs, costs=None):
+        """remember `rs` as the status of `repo` with the `fingerprint`;
+        `costs` are the seconds taking the fingerprint and evaluating the
+        status took, if measured"""
+        with self._lock:
+            entry = self.entries.get(repo.path)
+            if entry is None or entry.get('fingerprint') != fingerprint \
+                    or _level_rank(entry['status'].get('level', 'full')) \
+                    <= _level_rank(rs.level):
+                # otherwise keep the deeper status of the same state
+                previous = entry
+                entry = self.entries[repo.path] = {
+                    'fingerprint': fingerprint,
+                    'status': rs.to_dict(),
+                }
+                if previous is not None and 'costs' in previous:
+                    entry['costs'] = previous['costs']
+            elif costs is None:
+                return
+            if costs is not None:
+                entry['costs'] = self._smoothed(entry.get('costs'), costs)
+                entry.pop('bypassed', None)
+            self._modified = True
+
+    @classmethod
+    def _smoothed(cls, old, new):
+        """the moving average of the costs measured before (`old`, if any)
+        and the `new` measurement"""
+        if old is None:
+            return list(new)
+        return [o + cls.SMOOTHING * (n - o) for o, n in zip(old, new)]
+
+    def worthwhile(self, repo):
+        """whether looking `repo` up is cheaper than evaluating it, as far
+        as known: taking the fingerprint took less time than evaluating the
+        status, on average over the past measurements"""
+        entry = self.entries.get(repo.path)
+        costs = None if entry is None else entry.get('costs')
+        return costs is None or costs[0] < costs[1]
+
+    def _remeasure(self, repo):
+        """whether the costs of `repo` are to be measured again, having
+        bypassed the cache REMEASURE_AFTER times since the last measurement"""
+        entry = self.entries.get(repo.path)
+        return entry is not None \
+            and entry.get('bypassed', 0) >= self.REMEASURE_AFTER
+
+    def _bypass(self, repo):
+        """count a status() call not looking `repo` up"""
+        with self._lock:
+            self.bypassed += 1
+            entry = self.entries.get(repo.path)
+            if entry is not None:
+                entry['bypassed'] = entry.get('bypassed', 0) + 1
+                self._modified = True
+
+    def status(self, repo, compute=None, level='full'):
+        """the status of `repo` at the status `level` (see
+        GitRepository.status_at), from the cache if its fingerprint matches
+        and the cached status is at least that deep.
+
+        Otherwise it is computed by compute() (default: repo.status_at(level))
+        and stored, unless a deeper status of the same state is cached. A
+        repository that is not worthwhile() is computed right away; every
+        REMEASURE_AFTER such calls (and with refresh=True) the costs are
+        measured again instead, by taking the fingerprint and computing.
+        """
+        if compute is None:
+            def compute():
+                return repo.status_at(level)
+        rs, pending = self._lookup_status(repo, level)
+        if rs is None:
+            rs = self._store_status(repo, pending, compute())
+        return rs
+
+    async def astatus(self, repo, acompute=None, level='full'):
+        """the asyncio counterpart of status(), computing the status by
+        awaiting acompute() (default: repo.astatus(level))"""
+        if acompute is None:
+            def acompute():
+                return repo.astatus(level)
+        rs, pending = self._lookup_status(repo, level)
+        if rs is None:
+            rs = self._store_status(repo, pending, await acompute())
+        return rs
+
+    def _lookup_status(self, repo, level):
+        """the first half of status(): (rs, None) when the status `rs` is
+        answered without computing it, otherwise (None, pending), the status
+        then being computed and passed to _store_status() with `pending`"""
+        measure = self.refresh or self._remeasure(repo)
+        if not measure and not self.worthwhile(repo):
+            self._bypass(repo)
+            return None, None
+        # taken before running git, so a change made while git runs leads to a
+        # mismatch (and a recomputation) next time
+        started = time.perf_counter()
+        fingerprint = status_fingerprint(repo)
+        fingerprinted = time.perf_counter()
+        if fingerprint is not None and not measure:
+            rs = self.lookup(repo, fingerprint, level)
+            if rs is not None:
+                with self._lock:
+                    self.hits += 1
+                return rs, None
+        return None, (fingerprint, started, fingerprinted)
+
+    def _store_status(self, repo, pending, rs):
+        """the second half of status(): count the computed status `rs` as a
+        miss and store it; returns `rs`"""
+        if pending is None:
+            # bypassed
+            return rs
+        fingerprint, started, fingerprinted = pending
+        computed = time.perf_counter()
+        with self._lock:
+            self.misses += 1
+        if fingerprint is not None and rs.exists:
+            self.store(repo, fingerprint, rs,
+                       (fingerprinted - started, computed - fingerprinted))
+        return rs
+
+    def report(self):
+        """print the hit/miss counters in verbose mode"""
+        debug('status cache: {} hits, {} misses, {} not looked up'.format(
+            self.hits, self.misses, self.bypassed))
+
+
+def _level_rank(level):
+    """the position of `level` in STATUS_LEVELS (unknown ones rank lowest)"""
+    try:
+        return STATUS_LEVELS.index(level)
+    except ValueError:
+        return -1
+
+
+def _fingerprint_stamp(path):
+    """the stat data of the files the fingerprint of the repository at `path`
+    is read from"""
+    git_dir = find_git_dir(path) or path
+    common = common_dir(git_dir)
+    files = [os.path.join(git_dir, 'HEAD'),
+             os.path.join(common, 'config'),
+             os.path.join(common, 'packed-refs'),
+             ref_path(git_dir, 'refs/remotes/origin/HEAD')]
+    head = read_symref(git_dir, 'HEAD')
+    if head is not None:
+        # whether the checked out branch exists yet
+        files.append(ref_path(git_dir, head))
+    return ' '.join(_stamp(f) for f in files)
+
+
+class FingerprintCache:
+    """the on-disk cache of repository fingerprints, keyed by path.
+
+    An entry is used as long as the stat data of the repository's HEAD,
+    config and the refs the fingerprint depends on did not change; all of
+    them are dropped when one of the user wide git config files changed (as
+    it may rewrite the urls). fingerprint() is safe to call from several
+    threads at once.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'fingerprints.json')
+        self.entries = {}
+        self._modified = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _user_stamp():
+        return ' '.join(_stamp(f) for f in user_config_files())
+
+    def load(self):
+        try:
+            with open(self.path) as filehandle:
+                data = json.load(filehandle)
+        except (OSError, ValueError):
+            data = {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION \
+                or data.get('user-config') != self._user_stamp():
+            data = {}
+        self.entries = data.get('repositories', {})
+        return self
+
+    def save(self):
+        if not self._modified:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            data = {'version': self.VERSION,
+                    'user-config': self._user_stamp(),
+                    'repositories': self.entries}
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as filehandle:
+                json.dump(data, filehandle)
+            os.replace(tmp, self.path)
+            self._modified = False
+
+    def fingerprint(self, path, compute):
+        """the fingerprint of the repository at `path`, from the cache if its
+        files did not change, otherwise computed by compute(path)"""
+        stamp = _fingerprint_stamp(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry.get('stamp') == stamp:
+            return tuple(entry['fingerprint'])
+        fp = compute(path)
+        with self._lock:
+            self.entries[path] = {'stamp': stamp, 'fingerprint': list(fp)}
+            self._modified = True
+        return fp
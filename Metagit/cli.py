@@ -0,0 +1,752 @@
+"""The metagit command line: the argument parser and the SUBCMDs.
+
+Only what every invocation needs is imported here: the commands import the
+modules they use themselves, so e.g. 'metagit --help' or a shell completion
+does not pay for yaml or the UI (see benchmarks/startup.py).
+"""
+import os
+import sys
+import argparse
+
+from . import trace, utils
+from .utils import STATUS_LEVELS, UserMessage
+
+
+def add_jobs_argument(sub):
+    sub.add_argument('-j', '--jobs', type=int, metavar='N', default=None,
+                     help='evaluate up to N repositories at the same time '
+                          '(default: the \'jobs\' setting, 0 for one per CPU)')
+
+
+def status_arguments(sub):
+    add_jobs_argument(sub)
+    sub.add_argument('--no-cache', action='store_true',
+                     help='evaluate every repository, ignoring the status '
+                          'cache (it is still updated)')
+    sub.add_argument('--level', choices=STATUS_LEVELS, default=None,
+                     help='how deep to evaluate a repository: whether it '
+                          'exists, whether it is dirty, also the commits '
+                          'ahead and behind, or everything (default: full; '
+                          'for \'ui\': the ui-status-level setting)')
+    sub.add_argument('--no-daemon', action='store_true',
+                     help='evaluate the repositories here even if a '
+                          '\'metagit daemon\' is running')
+    sub.add_argument('--fresh', action='store_true',
+                     help='let a running \'metagit daemon\' check every '
+                          'repository first instead of answering from memory')
+
+
+def st_arguments(sub):
+    status_arguments(sub)
+    sub.add_argument('--format', choices=('table', 'jsonl'), default='table',
+                     help='print a table (the default), or a JSON object per '
+                          'repository and line as soon as it is evaluated')
+    sub.add_argument('--stream', action='store_true',
+                     help='print the table row by row as the repositories '
+                          'are evaluated, with a progress footer on a '
+                          'terminal')
+    sub.add_argument('--ordered', action='store_true',
+                     help='with --stream or --format=jsonl: print the '
+                          'repositories in the config order instead of as '
+                          'they complete')
+
+
+def daemon_arguments(sub):
+    add_jobs_argument(sub)
+    sub.add_argument('--interval', type=float, metavar='SECONDS',
+                     default=None,
+                     help='re-evaluate every repository this often '
+                          '(default: 60)')
+    sub.add_argument('--stop', action='store_true',
+                     help='stop the running daemon')
+
+
+def clone_arguments(sub):
+    sub.add_argument('-y', '--yes', action='store_true',
+                     help='carry out the plan without asking')
+    add_jobs_argument(sub)
+
+
+def fetch_arguments(sub):
+    sub.add_argument('-c', '--clone', action='store_true',
+                     help='clone repository if it does not exist locally')
+    sub.add_argument('-s', '--skip-unchanged', action='store_true',
+                     help="ask the remotes for their refs first and only fetch "
+                          "the repositories where any of them moved")
+    add_jobs_argument(sub)
+
+
+def accelerate_arguments(sub):
+    sub.add_argument('repositories', nargs='*', metavar='REPO',
+                     help='only these repositories (their path, as in the '
+                          'config or relative to the current directory)')
+    sub.add_argument('--report', action='store_true',
+                     help='only show the timings recorded before')
+    sub.add_argument('--save', action='store_true',
+                     help='write the accelerations kept to the \'accelerate\' '
+                          'key of the repositories\' config entries')
+
+
+def discard_stdout():
+    """after the consumer of a streaming output stopped reading (e.g. 'head'):
+    keep the interpreter from complaining when it flushes stdout on exit"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+
+def move_repository(source, repo):
+    """move the located repository `source` to where `repo` belongs"""
+    import shutil
+    parent = os.path.dirname(repo.path.rstrip('/'))
+    os.makedirs(parent, exist_ok=True)
+    shutil.move(source.path, repo.path)
+
+
+class Main:
+    def __init__(self):
+        # maps a command name to a tuple (callback, add_arguments), where
+        # add_arguments is an optional callable registering command specific
+        # arguments on the command's subparser (or None for none)
+        self.cmd_dict = {
+            'add': (Main.add, lambda sub: sub.add_argument(
+                '-n', '--dry-run', action='store_true',
+                help='dry run: only print config')),
+            'clone': (Main.clone, clone_arguments),
+            'st': (Main.status, st_arguments),
+            'status': (Main.status, st_arguments),
+            'ui': (Main.ui, status_arguments),
+            'detect': (Main.detect, lambda sub: sub.add_argument(
+                '-u', '--update', action='store_true',
+                help='with detect-method locate: rebuild metagit\'s locate '
+                     'database (~/.locatedb) over the home directory before '
+                     'listing')),
+            'help': (Main.help, None),
+            'fetch': (Main.fetch, fetch_arguments),
+            'daemon': (Main.daemon, daemon_arguments),
+            'accelerate': (Main.accelerate, accelerate_arguments),
+        }
+        self.parser = self.build_parser(self.invoked_command(sys.argv[1:]))
+        parsed = self.parser.parse_args()
+        if getattr(parsed, 'verbose', False):
+            utils.set_verbose(True)
+        trace_file = getattr(parsed, 'trace', None)
+        if trace_file is not None:
+            trace.start()
+        # the config is only loaded once the arguments are known to be valid,
+        # so --help and usage errors don't pay for it
+        from .Config import Config
+        self.c = Config()
+        try:
+            self.c.reload()
+        except UserMessage as e:
+            print("Error while loading config {}:\n{}"\
+                .format(self.c.filepath(), e))
+            sys.exit(1)
+        method = getattr(parsed, 'func', Main.ui)
+        try:
+            res = method(self, parsed)
+        except UserMessage as e:
+            print("Error: {}".format(str(e)))
+            res = 1
+        except KeyboardInterrupt:
+            print("Interrupted.", file=sys.stderr)
+            res = 1
+        finally:
+            if trace_file is not None:
+                trace.write(trace_file)
+                trace.summary(getattr(parsed, 'trace_top', 10))
+        if res is not None:
+            sys.exit(res)
+
+    # the global options taking a value as the next argument
+    VALUE_OPTIONS = ('--trace', '--trace-top')
+
+    def invoked_command(self, args):
+        """the SUBCMD given in the command line `args`, or None"""
+        args = iter(args)
+        for arg in args:
+            if arg in self.VALUE_OPTIONS:
+                next(args, None)
+            elif not arg.startswith('-'):
+                # the first positional argument is the SUBCMD
+                return arg
+        return None
+
+    def build_parser(self, command=None):
+        """the argument parser; the command specific arguments are only
+        registered for the SUBCMD `command`, which saves most of argparse's
+        setup time"""
+        # the global options are shared by the top-level parser and every
+        # subparser, so e.g. -v may be passed before or after the SUBCMD.
+        # Without a default, the subparser doesn't reset what was given
+        # before the SUBCMD.
+        global_parser = argparse.ArgumentParser(add_help=False)
+        global_parser.add_argument('-v', '--verbose', action='store_true',
+                                   default=argparse.SUPPRESS,
+                                   help='activate verbose output')
+        global_parser.add_argument('--trace', metavar='FILE',
+                                   default=argparse.SUPPRESS,
+                                   help='record the external commands run '
+                                        '(with their duration, exit code and '
+                                        'output size) to FILE in the Chrome '
+                                        'trace event format and list the '
+                                        'slowest on stderr')
+        global_parser.add_argument('--trace-top', metavar='N', type=int,
+                                   default=argparse.SUPPRESS,
+                                   help='list the N slowest commands with '
+                                        '--trace (default: 10)')
+        parser = argparse.ArgumentParser(
+            parents=[global_parser],
+            description='Manage a collection of git repositories.')
+        subparsers = parser.add_subparsers(dest='command', metavar='SUBCMD')
+        for name, (method, add_arguments) in self.cmd_dict.items():
+            doc = method.__doc__ or ''
+            sub = subparsers.add_parser(
+                name,
+                parents=[global_parser],
+                help=doc.split('\n', 1)[0],
+                description=doc,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+            sub.set_defaults(func=method)
+            if add_arguments is not None and name == command:
+                add_arguments(sub)
+        return parser
+
+    def add(self, argv):
+        """add a new repository"""
+        from .Config import config_to_repo_entry, dump_yaml
+        from .Repository import GitRepository, CreateRepositoryConfig
+        dry_run = argv.dry_run
+        path = '.'
+        git_root = utils.detect_git(path)
+        if git_root is None:
+            raise UserMessage('{} not part of a git repository'.format( \
+                os.path.abspath(path)))
+        g = CreateRepositoryConfig(git_root)
+        filepath = self.c.filepath()
+        entry = config_to_repo_entry(g.config)
+        if dry_run:
+            dump_yaml({'repositories': {g.tilde_path: entry}}, sys.stdout)
+            return
+        # add the new repository and write the whole config file back
+        self.c.repositories()[g.tilde_path] = entry
+        self.c.save()
+        if os.path.islink(filepath):
+            filepath = os.readlink(filepath)
+        # detect the git repository handling the config
+        git_path = utils.detect_git(os.path.dirname(filepath))
+        if git_path is None:
+            print("Config file {} not managed in a git, not committing anything"\
+                    .format(filepath))
+        else:
+            print("Committing changes to the git at {}".format(git_path))
+            config_repo = GitRepository(git_path, {})
+            msg = 'Add git ' + g.name
+            config_repo.call('git', 'commit', '-m', msg, '--', filepath)
+
+    def clone(self, argv):
+        """clone non-existing repositories
+
+First plans what to do for every repository that does not exist: if a copy of
+it can be found in the filesystem already (as by 'detect', matching its url,
+branch and type), the directory is simply moved, otherwise it is cloned. The
+plan is shown and every step confirmed, or carried out right away with --yes.
+
+The moves and clones then run concurrently (see -j/--jobs and the 'jobs'
+setting), but at most 'jobs-per-host' clones talk to the same remote host at a
+time. A failing clone does not stop the others; all failures are summarized
+at the end.
+"""
+        from .engine import default_jobs, remote_host
+        repos = self.c.repo_objects
+        missing = []
+        for p, r in repos.items():
+            if r.exists():
+                print("{} exists".format(r.tilde_path))
+            else:
+                missing.append((p, r))
+        if not missing:
+            return
+        # never move a managed repository, nor one copy to two places
+        taken = {os.path.realpath(r.path) for r in repos.values()}
+        located = self.located_repositories(argv)
+        plan = []
+        for p, r in missing:
+            source = located.get(r.fingerprint(), None)
+            if source is not None \
+                    and os.path.realpath(source.path) not in taken:
+                taken.add(os.path.realpath(source.path))
+                plan.append((p, r, source))
+                print("{} does not exist, move it from {}"
+                      .format(r.tilde_path, source.tilde_path))
+            else:
+                plan.append((p, r, None))
+                print("{} does not exist, clone it".format(r.tilde_path))
+        if not argv.yes:
+            confirmed = []
+            for p, r, source in plan:
+                if source is not None and utils.ask(
+                        'Move {} to {}?'.format(source.tilde_path, p)):
+                    confirmed.append((p, r, source))
+                elif utils.ask('Clone {}?'.format(p)):
+                    confirmed.append((p, r, None))
+            plan = confirmed
+        jobs = self.jobs(argv) or default_jobs()
+        # git's own output is only passed through when nothing runs alongside
+        quiet = jobs > 1
+        tasks = []
+        for p, r, source in plan:
+            if source is not None:
+                tasks.append(((r, 'move', 'Moving {} to {}'.format(
+                                   source.tilde_path, r.tilde_path)), None,
+                              lambda r=r, source=source: move_repository(
+                                  source, r)))
+            else:
+                tasks.append(((r, 'clone', 'Cloning ' + r.tilde_path),
+                              remote_host(r.config.get('url')),
+                              lambda r=r: r.clone(quiet=quiet)))
+        _results, failed = self.run_bulk(tasks, jobs)
+        if failed:
+            return 1
+
+    def run_bulk(self, tasks, jobs):
+        """run the tasks of a bulk operation (such as 'fetch' or 'clone')
+        with run_limited(), printing the progress and a summary of the
+        failures.
+
+        The key of every (key, host, func) task is a tuple (repository, verb,
+        progress text), the verb completing 'Failed to ...'. Returns the
+        results of the successful tasks and whether any task failed.
+        """
+        from .engine import run_limited
+        from .ssh import multiplexing
+        total = len(tasks)
+        started = 0
+
+        def on_start(key):
+            nonlocal started
+            started += 1
+            print("({}/{}) {}".format(started, total, key[2]),
+                  file=sys.stderr)
+
+        results = []
+        failures = []
+        with multiplexing(self.c.ssh_multiplexing()):
+            for (r, verb, _text), future in run_limited(
+                    tasks, jobs, self.c.jobs_per_host(), on_start=on_start):
+                try:
+                    results.append(future.result())
+                except (UserMessage, OSError) as e:
+                    if jobs > 1:
+                        print("Failed to {} {}".format(verb, r.tilde_path),
+                              file=sys.stderr)
+                    failures.append((r, e))
+        if failures:
+            print("{} of {} repositories failed:".format(len(failures), total))
+            for r, e in failures:
+                print("  {}: {}".format(r.tilde_path, e))
+        return results, bool(failures)
+
+    def located_repositories(self, argv):
+        """the repositories in the filesystem by their fingerprint (see
+        Repository.repositories_in_filesystem), read by as many workers as
+        -j/--jobs asks for"""
+        from .cache import FingerprintCache
+        from .Repository import repositories_in_filesystem
+        cache = FingerprintCache().load() if self.c.detect_cache() else None
+        try:
+            return repositories_in_filesystem(self.discover(), cache,
+                                              self.jobs(argv) or None)
+        finally:
+            if cache is not None:
+                cache.save()
+
+    def fetch(self, argv):
+        """update all repositories
+
+The repositories are fetched concurrently (see -j/--jobs and the 'jobs'
+setting), but at most 'jobs-per-host' fetches talk to the same remote host at
+a time. A failing fetch does not stop the others; all failures are summarized
+at the end.
+
+With -s/--skip-unchanged the remote's refs are listed first ('git ls-remote',
+which transfers no objects) and compared with the remote-tracking refs; only
+the repositories where they differ are fetched. Repositories whose refs can
+not be compared that way (git-svn ones, remotes that prune or have unusual
+refspecs) are always fetched.
+"""
+        from .engine import default_jobs, remote_host
+        clone_if_necessary = argv.clone
+        repos = self.c.repo_objects
+        jobs = self.jobs(argv) or default_jobs()
+        # git's own output is only passed through when nothing runs alongside
+        quiet = jobs > 1
+        tasks = []
+        for p, r in repos.items():
+            host = remote_host(r.config.get('url'))
+            if r.exists() and argv.skip_unchanged:
+                tasks.append(((r, 'fetch', 'Checking ' + r.tilde_path), host,
+                              lambda r=r: r.fetch_if_needed(quiet=quiet)))
+            elif r.exists():
+                tasks.append(((r, 'fetch', 'Fetching ' + r.tilde_path), host,
+                              lambda r=r: r.fetch(quiet=quiet)))
+            elif clone_if_necessary:
+                tasks.append(((r, 'clone', 'Cloning ' + r.tilde_path), host,
+                              lambda r=r: r.clone(quiet=quiet)))
+            else:
+                print("{} does not exist".format(r.tilde_path))
+        results, failed = self.run_bulk(tasks, jobs)
+        if argv.skip_unchanged:
+            # fetch_if_needed() returns False for an unchanged repository
+            print("Skipped {} of {} repositories, their remote refs did not "
+                  "change".format(results.count(False), len(tasks)))
+        if failed:
+            return 1
+
+    def jobs(self, argv):
+        """the -j/--jobs option if given, otherwise the 'jobs' setting"""
+        jobs = getattr(argv, 'jobs', None)
+        if jobs is None:
+            return self.c.jobs()
+        elif jobs < 0:
+            raise UserMessage('--jobs must not be negative')
+        return jobs
+
+    def status_engine(self, argv, level=None):
+        """the StatusEngine honouring the -j/--jobs, --no-cache and --level
+        options; `level` is the status level without the latter"""
+        from .cache import StatusCache
+        from .engine import StatusEngine
+        cache = None
+        if self.c.status_cache():
+            # with --no-cache, evaluate everything, but keep the cache up to
+            # date
+            cache = StatusCache(refresh=getattr(argv, 'no_cache', False))
+            cache.load()
+        return StatusEngine(self.jobs(argv), cache,
+                            level=self.status_level(argv, level))
+
+    def status_level(self, argv, level=None):
+        """the status level asked for by the --level option; `level` is the
+        one without it (None for 'full')"""
+        if getattr(argv, 'level', None) is not None:
+            return argv.level
+        return level
+
+    def status(self, argv):
+        """list the status for the managed repositories
+
+The repositories are evaluated concurrently (see -j/--jobs and the 'jobs'
+setting); the table still lists them in the config order. Repositories whose
+git metadata and working tree directories did not change since the last run
+are answered from the status cache (see the 'status-cache' setting and
+--no-cache); -v reports the cache hits and misses.
+
+--level picks how much is evaluated at all: 'exists' only looks whether the
+repository is checked out, 'dirty' also whether its tracked files have
+uncommitted changes, 'ahead-behind' adds the commits to push and merge and
+'full', the default, is everything. What was not evaluated is listed as
+"unchecked". Below 'full', uncommitted changes are detected by comparing the
+index with the stat data of the tracked files in-process instead of running
+'git status': the result only says whether there are uncommitted changes
+(untracked files are not looked for); git is still used where the stat data
+is not conclusive. For 'ahead-behind' and 'full', cached statuses of at least that
+level are reused; the lower levels cost less than taking the fingerprint the
+cache is looked up by.
+
+When a 'metagit daemon' is running, the statuses come from it instead (unless
+--no-daemon, --no-cache or a --level below 'full' is given): those it keeps in
+memory, which follow the git metadata right away, but edits in the working
+trees only with the daemon's next sweep (see 'daemon --interval'). With
+--fresh the daemon checks every repository first (answering the unchanged ones
+from the status cache).
+
+With --stream the table is printed row by row, as the repositories are
+evaluated (in the order they complete, or the config order with --ordered),
+instead of all at once at the end; its columns have a fixed width then.
+
+With --format=jsonl a JSON object is printed per repository as soon as its
+status is known, in the order the evaluations complete (or the config order
+with --ordered). It holds the repository's 'path' and 'name', the counters
+('untracked_files', 'uncommited_changes', 'unpushed_commits',
+'unmerged_commits'; null when not counted, see --level), 'exists', 'dirty',
+'main_branch', 'upstream_branch' and the 'seconds' the evaluation took (null
+for statuses from the daemon).
+"""
+        if argv.format == 'jsonl':
+            return self.status_jsonl(argv)
+        if argv.stream:
+            return self.status_stream(argv)
+        repos = self.c.repo_objects
+        table = [
+            [ "repository\nname",
+              "status",
+            ]
+        ]
+        statuses = self.daemon_statuses(argv)
+        if statuses is not None:
+            for p, r in repos.items():
+                table.append([text for text, _color
+                              in utils.repo_status_cells(r, rs=statuses[p])])
+            utils.pretty_print_table(table)
+            return
+        engine = self.status_engine(argv)
+        try:
+            for r, rs in engine.evaluate(repos.values()):
+                # drop the per-cell color, pretty_print_table only shows text
+                table.append([text for text, _color
+                              in utils.repo_status_cells(r, rs=rs)])
+        finally:
+            engine.shutdown()
+        utils.pretty_print_table(table)
+
+    def status_stream(self, argv):
+        """print the 'st --stream' table, see status()"""
+        repos = self.c.repo_objects
+        header = ["repository\nname", "status"]
+        # the names are known up front, the status column is bounded
+        widths = [max([len(line) for line in header[0].split('\n')]
+                      + [len(r.name) for r in repos.values()]),
+                  utils.STATUS_WIDTH]
+        table = utils.StreamingTable(header, widths)
+        engine = None
+        try:
+            table.begin()
+            table.progress('0/{} repositories'.format(len(repos)))
+            statuses = self.daemon_statuses(argv)
+            if statuses is not None:
+                results = ((r, statuses[p]) for p, r in repos.items())
+            else:
+                engine = self.status_engine(argv)
+                results = engine.evaluate(repos.values(),
+                                          ordered=argv.ordered)
+            for done, (r, rs) in enumerate(results, 1):
+                table.add([text for text, _color
+                           in utils.repo_status_cells(r, rs=rs)])
+                table.progress('{}/{} repositories'.format(done, len(repos)))
+            table.end()
+        except BrokenPipeError:
+            discard_stdout()
+        finally:
+            if engine is not None:
+                engine.shutdown()
+
+    def status_jsonl(self, argv):
+        """print the 'st --format=jsonl' records, see status()"""
+        import json
+        repos = self.c.repo_objects
+        statuses = self.daemon_statuses(argv)
+        try:
+            if statuses is not None:
+                for p, r in repos.items():
+                    print(json.dumps(utils.repo_status_record(r, statuses[p])),
+                          flush=True)
+                return
+            engine = self.status_engine(argv)
+            try:
+                for r, rs in engine.evaluate(repos.values(),
+                                             ordered=argv.ordered):
+                    record = utils.repo_status_record(
+                        r, rs, engine.durations.get(r.path))
+                    print(json.dumps(record), flush=True)
+            finally:
+                engine.shutdown()
+        except BrokenPipeError:
+            discard_stdout()
+
+    def daemon_statuses(self, argv, level=None):
+        """the current status of every repository from the running daemon,
+        or None if there is none or the options ask for evaluating here.
+        The daemon only keeps full statuses: a lower status level (`level`,
+        or the one of --level) is evaluated here as well"""
+        if getattr(argv, 'no_daemon', False) \
+                or getattr(argv, 'no_cache', False) \
+                or self.status_level(argv, level) not in (None, 'full'):
+            return None
+        from .daemon import remote_statuses
+        statuses = remote_statuses(self.c.filepath(),
+                                   fresh=getattr(argv, 'fresh', False))
+        if statuses is None or not set(self.c.repo_objects) <= set(statuses):
+            # e.g. the daemon could not evaluate some repository
+            return None
+        return statuses
+
+    def daemon(self, argv):
+        """keep the repository status at hand for other commands
+
+Runs in the foreground until interrupted (or 'metagit daemon --stop'), keeping
+the status of every repository in memory. A repository is re-evaluated as soon
+as its git metadata changes (see the 'watch' setting) and all of them every
+--interval seconds. 'st' and 'ui' use the daemon when it is running; other
+programs, such as shell prompts, can ask it for the status over its Unix
+socket (see Metagit/daemon.py for the protocol).
+"""
+        from .daemon import REFRESH_INTERVAL, StatusDaemon, query
+        if argv.stop:
+            if query({'cmd': 'stop'}) is None:
+                raise UserMessage('no metagit daemon is running')
+            return
+        daemon = StatusDaemon(self.c, self.status_engine(argv),
+                              interval=argv.interval or REFRESH_INTERVAL)
+        daemon.listen()
+        print("Serving the status of {} repositories on {}".format(
+            len(self.c.repo_objects), daemon.path), file=sys.stderr)
+        daemon.serve_forever()
+
+    def accelerate(self, argv):
+        """speed up the status of repositories with huge working trees
+
+Tries git's settings for large working trees in every repository, one at a
+time: the untracked cache (core.untrackedCache), index version 4, the split
+index (core.splitIndex) and the built-in fsmonitor daemon (core.fsmonitor).
+Each is verified to be used by git, and the repository's status is timed
+before and after; an acceleration not making it at least 10% (and 5 ms) faster
+is reverted. The repositories are measured one after the other, so that the
+timings don't disturb each other.
+
+The 'accelerate' key of a repository's config entry selects what is done.
+Without it, all but the split index are tried (metagit can not read a split
+index in-process, so the repository would lose the status cache). A list, e.g.
+[untracked-cache, split-index], enables exactly these and keeps them whatever
+the timings. false leaves the repository alone. With --save the accelerations
+kept are written to the config entries of the repositories tried.
+
+The timings are recorded in the cache directory; --report shows them again.
+"""
+        from .accelerate import (
+            AccelerationLog,
+            accelerate,
+            configured,
+            record_cells,
+        )
+        from .Config import config_to_repo_entry, repo_entry_to_config
+        repos = self.selected_repositories(argv.repositories)
+        log = AccelerationLog().load()
+        if not argv.report:
+            plan = []
+            for p, r in repos.items():
+                names, keep = configured(r)
+                if not r.exists():
+                    print("{} does not exist".format(r.tilde_path))
+                elif names:
+                    plan.append((p, r, names, keep))
+            for number, (p, r, names, keep) in enumerate(plan, 1):
+                print("({}/{}) Accelerating {}".format(number, len(plan),
+                                                       r.tilde_path),
+                      file=sys.stderr)
+                log.entries[p] = accelerate(r, names, keep)
+                # after every repository, so an interrupted run keeps what
+                # was measured
+                log.save()
+            if argv.save:
+                entries = self.c.repositories()
+                for p, r, names, keep in plan:
+                    if keep:
+                        continue
+                    config = repo_entry_to_config(p, entries[p])
+                    record = log.entries[p]
+                    config['accelerate'] = \
+                        record['active'] + record['kept'] or False
+                    entries[p] = config_to_repo_entry(config)
+                self.c.save()
+            repos = {p: repos[p] for p, _r, _names, _keep in plan}
+        table = [['repository', 'status\nbefore', 'status\nafter',
+                  'accelerations']]
+        for p, r in repos.items():
+            if p in log.entries:
+                table.append([r.tilde_path] + record_cells(log.entries[p]))
+        if len(table) == 1:
+            print("No timings recorded{}".format(
+                ", run 'metagit accelerate' first" if argv.report else ""))
+            return
+        utils.pretty_print_table(table)
+
+    def selected_repositories(self, paths):
+        """the repositories by path named by `paths` (as in the config, or a
+        path in the filesystem), all of them if `paths` is empty"""
+        repos = self.c.repo_objects
+        if not paths:
+            return repos
+        by_location = {os.path.realpath(r.path): p for p, r in repos.items()}
+        selected = {}
+        for path in paths:
+            p = path if path in repos else by_location.get(
+                os.path.realpath(os.path.expanduser(path)))
+            if p is None:
+                raise UserMessage('{} is not a managed repository'
+                                  .format(path))
+            selected[p] = repos[p]
+        return selected
+
+    def ui(self, argv):
+        """interactive ncurses UI showing the repository status
+
+Navigate the scrollable table and act on the selected repository with the
+configured key bindings (see the 'keys' section of the config). By default:
+j/k or the arrow keys move, f fetches (in the background), P pushes, r
+refreshes and q quits.
+"""
+        from .ssh import multiplexing
+        from .ui import run_ui
+        level = self.c.ui_status_level()
+        statuses = self.daemon_statuses(argv, level=level)
+        engine = self.status_engine(argv, level=level)
+        try:
+            # e.g. 'run-all-bg git fetch' shares the ssh connections
+            with multiplexing(self.c.ssh_multiplexing()):
+                run_ui(self.c.repo_objects, self.c.keys(), self.c.colors(),
+                       self.c.run_fg_prompt_threshold(),
+                       documentation=self.c.documentation, engine=engine,
+                       watch=self.c.watch(),
+                       discover=lambda: self.discover(update=True),
+                       statuses=statuses)
+        finally:
+            engine.shutdown(wait=False)
+
+    def detect(self, argv):
+        """find git repositories in the filesystem
+
+Lists the repositories found, most recently used first (sorted by the mtime of
+their index). Nothing is added to the configuration; this is the same discovery
+the interactive UI's 'detect' action performs.
+
+By default (detect-method crawl) the directories in the 'detect-roots' setting
+are crawled, skipping those matching 'detect-exclude'; working trees, linked
+worktrees, submodules and bare repositories are all found. Unless the
+'detect-cache' setting is off, the crawled directories are remembered and only
+those modified since are read again next time.
+
+With detect-method locate, metagit reads its own locate database (~/.locatedb)
+instead, honouring $LOCATE_PATH when it is set. Pass --update to (re)build
+~/.locatedb over the home directory first; run this once (e.g. from cron) so
+'detect' finds your repositories even where the system database excludes the
+home directory.
+"""
+        from .discovery import by_last_use
+        if argv.update and self.c.detect_method() == 'locate':
+            print("Building {} over the home directory..."
+                  .format(os.path.expanduser('~/.locatedb')), file=sys.stderr)
+        found = by_last_use(self.discover(update=argv.update))
+        print("Found {} repositories:".format(len(found)), file=sys.stderr)
+        for path in found:
+            print(path)
+
+    def discover(self, update=False):
+        """the paths of the repositories in the filesystem, found as the
+        detect-* settings say (see Metagit.discovery)"""
+        from .discovery import DiscoveryIndex, discover_repositories
+        index = DiscoveryIndex() if self.c.detect_cache() else None
+        return discover_repositories(self.c.detect_method(),
+                                     self.c.detect_roots(),
+                                     self.c.detect_exclude(), update=update,
+                                     index=index)
+
+    def help(self, argv):
+        """show the documentation for the current configuration
+
+Renders the effective configuration (settings, managed repositories, key
+bindings and available actions) and pipes it through $PAGER.
+"""
+        from .ui import page_text
+        page_text(self.c.documentation())
+
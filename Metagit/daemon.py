@@ -0,0 +1,338 @@
+"""A long-running process keeping the repository status at hand.
+
+'metagit daemon' loads the config once, keeps the status of every managed
+repository in memory and re-evaluates a repository as soon as its git
+metadata changes (see Metagit.watch), and all of them every now and then.
+Shell prompts, editor plugins and 'metagit st' itself then get the status
+from it in a few milliseconds, instead of starting a new metagit that loads
+the config and the status cache first.
+
+The daemon listens on a Unix domain socket (see socket_path()), for one
+request per line, each a JSON object with a 'cmd' entry, and answers each
+with one line holding a JSON object: {"ok": true, ...} or {"ok": false,
+"error": "..."}. The commands are:
+
+  ping         {"ok": true, "pid": <the daemon's pid>}
+  list         {"repositories": [<path>, ...]}, in the config order
+  status       {"repositories": {<path>: <status>}}, a status being
+               RepoStatus.to_dict(). With "fresh": true every repository is
+               checked first (cheap for the unchanged ones, see
+               Metagit.cache), otherwise the statuses in memory are returned
+               right away. "paths": [...] restricts the answer to those.
+  dirty-count  {"count": <n>}, the number of repositories with uncommitted
+               changes (takes "fresh" as well)
+  stop         shut the daemon down
+
+The paths are those of the config's 'repositories' section. A request may
+carry "config": <the config file path>; a daemon serving a different config
+refuses it, so a client with another $HOME or $XDG_CONFIG_HOME does not get
+foreign answers.
+"""
+import os
+import json
+import socket
+import threading
+from concurrent.futures import as_completed
+
+from .utils import UserMessage, cache_dir, debug
+
+
+# how often the daemon re-evaluates every repository, in seconds; changes of
+# the git metadata are picked up right away, edits in the working trees only
+# by this sweep (or a "fresh" request)
+REFRESH_INTERVAL = 60
+
+# how long a client waits for the daemon's answer, in seconds
+CLIENT_TIMEOUT = 30
+
+
+def socket_path():
+    """the path of the daemon's socket: in $XDG_RUNTIME_DIR if set (a
+    private directory that is cleaned up on logout), in the cache directory
+    otherwise"""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'metagit', 'daemon.sock')
+    return os.path.join(cache_dir(), 'daemon.sock')
+
+
+def query(request, path=None, timeout=CLIENT_TIMEOUT):
+    """send `request` (a dict) to the daemon and return its answer.
+
+    Returns None when no daemon is running (or it does not answer in time),
+    so the caller can do the work itself. A refused request raises
+    UserMessage.
+    """
+    path = path or socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            with sock.makefile('rb') as stream:
+                line = stream.readline()
+    except OSError as e:
+        # no socket, a stale one, or a hanging daemon
+        debug('daemon not available: {}'.format(e))
+        return None
+    try:
+        answer = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(answer, dict):
+        return None
+    if not answer.get('ok'):
+        raise UserMessage('metagit daemon: {}'.format(
+            answer.get('error', 'request failed')))
+    return answer
+
+
+def remote_statuses(config_path, paths=None, fresh=False):
+    """the statuses (RepoStatus by path) the running daemon knows, or None if
+    there is no daemon or it serves another config. With fresh=True the
+    daemon checks every repository first instead of answering from memory"""
+    from .Repository import RepoStatus
+    request = {'cmd': 'status', 'fresh': fresh, 'config': config_path}
+    if paths is not None:
+        request['paths'] = list(paths)
+    try:
+        answer = query(request)
+    except UserMessage as e:
+        debug(str(e))
+        return None
+    if answer is None:
+        return None
+    return {path: RepoStatus.from_dict(data)
+            for path, data in answer.get('repositories', {}).items()}
+
+
+class StatusDaemon:
+    """serve the status of the repositories of `config` (a loaded Config)
+    on the Unix socket `path` (default: socket_path()).
+
+    The statuses are evaluated with `engine` (a StatusEngine, whose status
+    cache is written back after every sweep) and kept in memory; a watcher
+    re-evaluates changed repositories in the background.
+    """
+
+    def __init__(self, config, engine, path=None,
+                 interval=REFRESH_INTERVAL):
+        self.config = config
+        self.engine = engine
+        self.path = path or socket_path()
+        self.interval = interval
+        self.statuses = {}
+        self._lock = threading.Lock()
+        self._changed = set()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._watcher = None
+        self._config_stamp = None
+        self._config_lock = threading.Lock()
+        self._server = None
+
+    # --- the repositories ----------------------------------------------------
+
+    def _load(self):
+        """(re)load the config and watch its repositories"""
+        self.config.reload()
+        self._config_stamp = self._stamp()
+        repos = self.config.repo_objects
+        with self._lock:
+            self.statuses = {p: s for p, s in self.statuses.items()
+                             if p in repos}
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        if self.config.watch():
+            from .watch import RepoWatcher
+            try:
+                self._watcher = RepoWatcher(self._on_change)
+            except OSError:
+                pass
+            else:
+                for p, r in repos.items():
+                    self._watcher.watch(p, r.path)
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.config.filepath())
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _check_config(self):
+        with self._config_lock:
+            if self._stamp() != self._config_stamp:
+                debug('config changed, reloading')
+                self._load()
+
+    def _on_change(self, paths):
+        with self._lock:
+            self._changed |= paths
+        self._wakeup.set()
+
+    def refresh(self, paths=None):
+        """evaluate the repositories `paths` (default: all) and remember
+        their status"""
+        repos = self.config.repo_objects
+        if paths is None:
+            paths = list(repos)
+        futures = {self.engine.submit(repos[p]): p for p in paths
+                   if p in repos}
+        for future in as_completed(futures):
+            try:
+                rs = future.result()
+            except Exception as e:
+                # e.g. 'git status' failing: keep the status known before
+                debug('evaluating {} failed: {}'.format(futures[future], e))
+                continue
+            with self._lock:
+                self.statuses[futures[future]] = rs
+        if self.engine.cache is not None:
+            self.engine.cache.save()
+
+    def _refresher(self):
+        """the background thread re-evaluating changed repositories, and all
+        of them every `interval` seconds"""
+        while not self._stopping:
+            woken = self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            try:
+                self.refresh(sorted(changed) if woken else None)
+            except Exception as e:
+                debug('refreshing failed: {}'.format(e))
+
+    # --- the requests ----------------------------------------------------------
+
+    def handle(self, request):
+        """the answer (a dict) to `request`"""
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'a request must be a JSON object'}
+        config = request.get('config')
+        if config is not None \
+                and os.path.abspath(config) != self.config.filepath():
+            return {'ok': False,
+                    'error': 'serving {}, not {}'.format(
+                        self.config.filepath(), config)}
+        cmd = request.get('cmd')
+        if cmd == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        if cmd == 'stop':
+            threading.Thread(target=self.stop, daemon=True).start()
+            return {'ok': True}
+        if cmd not in ('list', 'status', 'dirty-count'):
+            return {'ok': False, 'error': 'unknown command {!r}'.format(cmd)}
+        self._check_config()
+        repos = self.config.repo_objects
+        if cmd == 'list':
+            return {'ok': True, 'repositories': list(repos)}
+        paths = request.get('paths')
+        if paths is None:
+            paths = list(repos)
+        paths = [p for p in paths if p in repos]
+        with self._lock:
+            missing = [p for p in paths if p not in self.statuses]
+        if request.get('fresh'):
+            self.refresh(paths)
+        elif missing:
+            self.refresh(missing)
+        with self._lock:
+            statuses = {p: self.statuses[p] for p in paths
+                        if p in self.statuses}
+        if cmd == 'dirty-count':
+            count = sum(1 for rs in statuses.values()
+                        if rs.exists and (rs.uncommited_changes
+                                          or rs.untracked_files or rs.dirty))
+            return {'ok': True, 'count': count}
+        return {'ok': True,
+                'repositories': {p: rs.to_dict()
+                                 for p, rs in statuses.items()}}
+
+    # --- the server ------------------------------------------------------------
+
+    def listen(self):
+        """bind the socket; a stale socket file (of a daemon that died) is
+        replaced, a live daemon's is not"""
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        if query({'cmd': 'ping'}, self.path, timeout=2) is not None:
+            raise UserMessage('a metagit daemon is running already ({})'
+                              .format(self.path))
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only the user may talk to the daemon
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        self._server = sock
+
+    def _serve_client(self, conn):
+        with conn, conn.makefile('rwb') as stream:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    answer = {'ok': False, 'error': 'invalid JSON'}
+                else:
+                    try:
+                        answer = self.handle(request)
+                    except Exception as e:
+                        answer = {'ok': False, 'error': str(e)}
+                try:
+                    stream.write(json.dumps(answer).encode() + b'\n')
+                    stream.flush()
+                except OSError:
+                    # the client went away
+                    return
+
+    def serve_forever(self):
+        """load the repositories, evaluate them and answer requests until
+        stop() is called (or a 'stop' request arrives)"""
+        if self._server is None:
+            self.listen()
+        try:
+            self._load()
+            self.refresh()
+            threading.Thread(target=self._refresher, daemon=True,
+                             name='metagit-refresh').start()
+            debug('listening on {}'.format(self.path))
+            while not self._stopping:
+                try:
+                    conn, _ = self._server.accept()
+                except OSError:
+                    # the socket was closed by stop()
+                    break
+                threading.Thread(target=self._serve_client, args=(conn,),
+                                 daemon=True).start()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        if self._watcher is not None:
+            self._watcher.close()
+        if self._server is not None:
+            try:
+                # wake up accept()
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self.engine.shutdown(wait=False)
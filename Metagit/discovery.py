@@ -0,0 +1,263 @@
+"""Finding git repositories in the filesystem.
+
+crawl() walks directory trees with os.scandir on a thread pool and yields the
+repositories as it finds them: working trees (with a '.git' directory, or a
+'.git' file as used by linked worktrees and submodules) and bare repositories.
+It never descends into a git directory or a bare repository, nor into the
+directories matching one of the exclude patterns (e.g. 'node_modules'). Working
+trees are searched further, so nested repositories (e.g. submodules or
+repositories inside a dotfiles repository in the home directory) are found too.
+
+With a DiscoveryIndex, the crawler remembers the modification time, the
+subdirectories and whether it is a repository of every directory it read. On
+the next crawl a directory whose mtime did not change is not read again (its
+entries can only have changed if its mtime did), so recrawling an unchanged
+tree costs one stat() per directory.
+
+discover_repositories() picks between the crawler and the locate database
+(see Repository.locate_git_repositories) according to the 'detect-method'
+setting.
+"""
+import os
+import json
+import time
+import fnmatch
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .utils import cache_dir
+from .gitdir import find_git_dir
+
+
+# the values of the 'detect-method' setting
+METHODS = ('crawl', 'locate')
+
+
+def _is_bare(entries):
+    """whether a directory with the os.scandir() `entries` (by name) is a bare
+    repository"""
+    try:
+        return entries['HEAD'].is_file() and entries['objects'].is_dir() \
+            and entries['refs'].is_dir()
+    except (KeyError, OSError):
+        return False
+
+
+def _excluded(entry, patterns):
+    """whether the directory `entry` matches one of the exclude `patterns`.
+
+    A pattern containing a '/' is matched against the whole path, any other
+    against the directory's name only.
+    """
+    for pattern in patterns:
+        if fnmatch.fnmatch(entry.path if '/' in pattern else entry.name,
+                           pattern):
+            return True
+    return False
+
+
+def _scan(path, patterns):
+    """the repositories found directly in `path` and the subdirectories to
+    crawl next, as a (repositories, subdirectories) pair"""
+    try:
+        with os.scandir(path) as it:
+            entries = {entry.name: entry for entry in it}
+    except OSError:
+        # vanished, or not readable
+        return [], []
+    repos = []
+    if '.git' in entries:
+        repos.append(path)
+    elif _is_bare(entries):
+        return [path], []
+    subdirs = []
+    for name, entry in entries.items():
+        if name == '.git':
+            continue
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+        except OSError:
+            continue
+        if not _excluded(entry, patterns):
+            subdirs.append(entry.path)
+    return repos, subdirs
+
+
+# the number of directories a crawler task reads before it hands the rest of
+# its subtree back: one task per directory would spend more time on the
+# thread pool's bookkeeping than on reading directories
+_BATCH = 256
+
+
+# a directory modified less than this many nanoseconds before the crawl
+# started may be modified again within the same mtime tick, unnoticed: it is
+# read again next time
+_RACY_NS = 2 * 1000000000
+
+
+class DiscoveryIndex:
+    """the directory tree crawled last, stored in the cache directory.
+
+    load() reads the index of the last crawl, scan() is the (thread safe)
+    replacement of _scan() that uses it, and save() stores the index of the
+    current crawl, made of the directories scan() visited.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), 'discovery.json')
+        self.exclude = []
+        # path -> [mtime in ns (None: read again), repository?, subdirectory
+        # names], of the last crawl and the current one
+        self.previous = {}
+        self.current = {}
+        self.started = time.time_ns()
+
+    def load(self, exclude=()):
+        """read the index; it is dropped if it was built with different
+        `exclude` patterns"""
+        self.exclude = list(exclude)
+        try:
+            with open(self.path) as filehandle:
+                data = json.load(filehandle)
+        except (OSError, ValueError):
+            data = {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION \
+                or data.get('exclude') != self.exclude:
+            data = {}
+        self.previous = data.get('directories', {})
+        self.current = {}
+        self.started = time.time_ns()
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {'version': self.VERSION, 'exclude': self.exclude,
+                'directories': self.current}
+        # write to a temporary file first, so a concurrent reader never sees
+        # a half-written index
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as filehandle:
+            json.dump(data, filehandle)
+        os.replace(tmp, self.path)
+
+    def scan(self, path, patterns):
+        """like _scan(), but without reading `path` if it did not change"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return [], []
+        entry = self.previous.get(path)
+        if entry is not None and entry[0] == mtime:
+            repos = [path] if entry[1] else []
+            subdirs = [os.path.join(path, name) for name in entry[2]]
+        else:
+            repos, subdirs = _scan(path, patterns)
+            if mtime >= self.started - _RACY_NS:
+                mtime = None
+        self.current[path] = [mtime, bool(repos),
+                              [os.path.basename(d) for d in subdirs]]
+        return repos, subdirs
+
+
+def _scan_batch(paths, scan, patterns):
+    """crawl up to _BATCH directories of the trees below `paths`, depth
+    first, reading each with scan(directory, patterns).
+
+    Returns the repositories found and the directories left to crawl.
+    """
+    repos = []
+    stack = list(paths)
+    for _ in range(_BATCH):
+        if not stack:
+            break
+        found, subdirs = scan(stack.pop(), patterns)
+        repos.extend(found)
+        stack.extend(reversed(subdirs))
+    return repos, stack
+
+
+def crawl(roots, exclude=(), jobs=None, index=None):
+    """yield the path of every repository below the directories `roots`.
+
+    The directories are read by `jobs` threads (ThreadPoolExecutor's default
+    if None) and the repositories are yielded as soon as they are found, in no
+    particular order. `exclude` is a list of glob patterns for directories not
+    to descend into ('~' is expanded). Symbolic links are not followed.
+
+    With a DiscoveryIndex `index`, the directories unchanged since the last
+    crawl are not read again, and the index is updated and saved once the
+    crawl completed.
+    """
+    patterns = [os.path.expanduser(p) for p in exclude]
+    scan = _scan
+    if index is not None:
+        index.load(exclude)
+        scan = index.scan
+    seen = set()
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='metagit-crawl') as pool:
+        pending = {pool.submit(_scan_batch, [os.path.expanduser(root)], scan,
+                               patterns)
+                   for root in roots}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    repos, left = future.result()
+                    # split what is left in two, so the work spreads over the
+                    # threads without a task for every single directory
+                    for part in (left[0::2], left[1::2]):
+                        if part:
+                            pending.add(pool.submit(_scan_batch, part, scan,
+                                                    patterns))
+                    for repo in repos:
+                        # overlapping roots find a repository twice
+                        if repo not in seen:
+                            seen.add(repo)
+                            yield repo
+        finally:
+            # e.g. the caller stopped early: drop the directories not read yet
+            for future in pending:
+                future.cancel()
+    if index is not None:
+        # only a complete crawl makes a complete index
+        index.save()
+
+
+def discover_repositories(method='crawl', roots=('~',), exclude=(),
+                          update=False, jobs=None, index=None):
+    """yield the paths of the repositories in the filesystem.
+
+    With method 'crawl' the directories `roots` are crawled (see crawl(),
+    which also takes the DiscoveryIndex `index`); with 'locate' the locate
+    database is queried, after rebuilding it when `update` is set.
+    """
+    if method == 'locate':
+        # the crawler does without the repository classes
+        from .Repository import (
+            locate_git_repositories,
+            update_locate_database,
+        )
+        if update:
+            update_locate_database()
+        yield from locate_git_repositories()
+    else:
+        yield from crawl(roots, exclude, jobs, index)
+
+
+def last_used(path):
+    """the modification time of the index of the repository at `path` (0 for
+    none), telling when it was last used"""
+    git_dir = find_git_dir(path)
+    try:
+        return os.path.getmtime(os.path.join(git_dir or path, 'index'))
+    except OSError:
+        # no (readable) index, e.g. a fresh or a bare repository
+        return 0
+
+
+def by_last_use(paths):
+    """the repositories `paths` as a list, the most recently used first"""
+    return sorted(paths, key=last_used, reverse=True)
@@ -0,0 +1,261 @@
+"""Concurrent evaluation of the repository status and of bulk operations.
+
+Computing a RepoStatus spawns a few git processes per repository, so walking a
+long repository list one at a time is dominated by waiting for those processes.
+The StatusEngine runs the evaluations on a bounded pool of worker threads
+instead (the work happens in the git subprocesses, so the GIL is no obstacle).
+The 'st' command and the interactive UI share it.
+
+Network operations such as 'fetch' go through run_limited(), which additionally
+caps the number of operations talking to the same remote host at a time.
+
+A CommandLoop drives coroutines such as GitRepository.acall() from a single
+event loop in a background thread, so the UI can run a command in every
+repository at once without a thread each. StatusEngine.astatus() evaluates a
+status on such a loop, with the same level and cache as status().
+"""
+import os
+import re
+import time
+import threading
+import collections
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+
+# the status levels answered from the status cache: the lower ones are cheaper
+# to evaluate than the fingerprint a lookup takes
+CACHED_LEVELS = ('ahead-behind', 'full')
+
+
+def default_jobs():
+    """the number of workers used when neither -j nor the config sets one"""
+    return os.cpu_count() or 1
+
+
+class StatusEngine:
+    """evaluate RepoStatus objects on a bounded pool of worker threads.
+
+    `jobs` is the maximum number of repositories evaluated at the same time;
+    None or 0 picks default_jobs(). The pool is created on first use and kept
+    until shutdown(), so long-lived users such as the UI can keep submitting.
+    With a StatusCache as `cache`, unchanged repositories are answered from it
+    (at the CACHED_LEVELS); shutdown() then writes the cache back. The
+    repositories are evaluated at the status `level` (see
+    GitRepository.status_at, default: 'full').
+    `durations` maps the path of every evaluated repository to the seconds
+    its last evaluation took (cache lookup included).
+    """
+
+    def __init__(self, jobs=None, cache=None, level=None):
+        self.jobs = jobs if jobs else default_jobs()
+        self.cache = cache
+        self.level = level or 'full'
+        self.durations = {}
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.jobs, thread_name_prefix='metagit-status')
+        return self._executor
+
+    def status(self, repo):
+        """compute the status of a single repository in the calling thread"""
+        started = time.perf_counter()
+        if self.cache is not None and self.level in CACHED_LEVELS:
+            rs = self.cache.status(repo, level=self.level)
+        else:
+            rs = repo.status_at(self.level)
+        self.durations[repo.path] = time.perf_counter() - started
+        return rs
+
+    async def astatus(self, repo):
+        """the asyncio counterpart of status(), evaluating with
+        GitRepository.astatus() at the same level and through the same cache
+        """
+        started = time.perf_counter()
+        if self.cache is not None and self.level in CACHED_LEVELS:
+            rs = await self.cache.astatus(repo, level=self.level)
+        else:
+            rs = await repo.astatus(self.level)
+        self.durations[repo.path] = time.perf_counter() - started
+        return rs
+
+    def submit(self, repo, callback=None):
+        """schedule the status evaluation of `repo`, returning its Future.
+
+        When given, callback(repo, future) is called from the worker thread as
+        soon as the evaluation finished (successfully or not).
+        """
+        future = self._pool().submit(self.status, repo)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(repo, f))
+        return future
+
+    def evaluate(self, repos, ordered=True):
+        """yield (repo, RepoStatus) for every repository in `repos`.
+
+        All repositories are submitted up front. With ordered=True the results
+        are yielded in the order of `repos` (e.g. the config order of the 'st'
+        table); otherwise in the order they complete. An exception raised by a
+        repository's evaluation is re-raised when its result is reached, after
+        which the remaining evaluations are cancelled.
+        """
+        futures = [(repo, self.submit(repo)) for repo in repos]
+        try:
+            if ordered:
+                for repo, future in futures:
+                    yield repo, future.result()
+            else:
+                repo_of = {future: repo for repo, future in futures}
+                for future in as_completed(repo_of):
+                    yield repo_of[future], future.result()
+        finally:
+            # a no-op for finished evaluations; drops the queued ones when the
+            # consumer stopped early (an error or a KeyboardInterrupt)
+            for _repo, future in futures:
+                future.cancel()
+
+    def shutdown(self, wait=True):
+        """stop the worker pool; pending evaluations are cancelled"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+        if self.cache is not None:
+            self.cache.save()
+            if self.level in CACHED_LEVELS:
+                self.cache.report()
+
+
+class CommandLoop:
+    """an asyncio event loop running in a background thread.
+
+    submit() schedules a coroutine on it from any thread and returns a
+    concurrent.futures.Future for its result. The loop is started on first
+    use and bounds the commands started with GitRepository.acall() to `jobs`
+    at a time (see Repository.set_async_limit; None or 0 picks
+    default_jobs()). shutdown() cancels what is still running and stops the
+    loop.
+    """
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs if jobs else default_jobs()
+        self._loop = None
+        self._thread = None
+
+    def _start(self):
+        import asyncio
+        from .Repository import set_async_limit
+        set_async_limit(self.jobs)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='metagit-commands', daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine):
+        """run `coroutine` on the loop, returning its Future"""
+        import asyncio
+        if self._loop is None:
+            self._start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def shutdown(self):
+        """cancel the pending coroutines and stop the loop"""
+        if self._loop is None:
+            return
+        loop = self._loop
+
+        async def stop():
+            import asyncio
+            tasks = [t for t in asyncio.all_tasks()
+                     if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            loop.stop()
+
+        loop.call_soon_threadsafe(lambda: loop.create_task(stop()))
+        self._thread.join()
+        loop.close()
+        self._loop = None
+        self._thread = None
+
+
+# scheme://[user@]host[:port]/path, e.g. https://github.com/x or ssh://git@h/x
+_URL_HOST = re.compile(
+    r'^[A-Za-z][A-Za-z0-9+.-]*://(?:[^@/]*@)?(\[[^]/]*\]|[^:/]*)')
+# the scp-like [user@]host:path syntax, e.g. git@github.com:t-wissmann/metagit
+# or git@[::1]:metagit
+_SCP_HOST = re.compile(r'^(?:[^@/]*@)?(\[[^]/]*\]|[^:/\[]+):')
+
+
+def remote_host(url):
+    """the host name a remote url talks to, or None for a local repository.
+
+    Understands urls with a scheme (https://, ssh://, git://, ...) and git's
+    scp-like [user@]host:path syntax; file:// urls and plain paths are local.
+    """
+    if not url:
+        return None
+    match = _URL_HOST.match(url)
+    if match is not None:
+        return match.group(1).lower() or None
+    if '://' in url:
+        return None
+    match = _SCP_HOST.match(url)
+    if match is not None:
+        return match.group(1).lower()
+    return None
+
+
+def run_limited(tasks, jobs, per_host=0, on_start=None):
+    """run callables concurrently, limiting the concurrency per remote host.
+
+    `tasks` is an iterable of (key, host, func) triples, `host` being the value
+    of remote_host() (None for local work, which is only subject to `jobs`). At
+    most `jobs` tasks run at the same time and, unless per_host is 0, at most
+    `per_host` of them for the same host; tasks for one host start in the
+    given order. on_start(key) is called in the calling thread right before a
+    task is started, so progress output stays in a coherent order. Yields
+    (key, future) pairs as the tasks complete.
+    """
+    jobs = max(1, jobs or default_jobs())
+    # one queue of waiting tasks per host, visited in order of first appearance
+    queues = collections.OrderedDict()
+    for key, host, func in tasks:
+        queues.setdefault(host, collections.deque()).append((key, func))
+    active = collections.Counter()
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='metagit-bulk') as pool:
+        try:
+            while queues or running:
+                for host in list(queues):
+                    queue = queues[host]
+                    while queue and len(running) < jobs and (
+                            host is None or not per_host
+                            or active[host] < per_host):
+                        key, func = queue.popleft()
+                        if on_start is not None:
+                            on_start(key)
+                        running[pool.submit(func)] = (key, host)
+                        active[host] += 1
+                    if not queue:
+                        del queues[host]
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, host = running.pop(future)
+                    active[host] -= 1
+                    yield key, future
+        finally:
+            # the consumer stopped early: don't start anything else
+            queues.clear()
+            for future in running:
+                future.cancel()
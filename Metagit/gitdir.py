@@ -0,0 +1,610 @@
+"""Read a repository's git metadata directly from its git directory.
+
+Spawning git for trivial lookups (e.g. which branch a symbolic ref points to)
+costs more than the lookup itself. The helpers here read the few files
+involved directly (loose and packed refs, the config and the commit-graph) and
+return None whenever the answer is not available that way, leaving it to the
+caller to fall back to asking git.
+"""
+import os
+
+
+def find_git_dir(worktree):
+    """the git directory of the repository checked out at `worktree`.
+
+    Handles both a plain '.git' directory and a '.git' file ('gitdir: <path>',
+    as used by linked worktrees and submodules). Returns None when `worktree`
+    has neither.
+    """
+    dotgit = os.path.join(worktree, '.git')
+    if os.path.isdir(dotgit):
+        return dotgit
+    try:
+        with open(dotgit) as filehandle:
+            content = filehandle.read()
+    except OSError:
+        return None
+    if not content.startswith('gitdir:'):
+        return None
+    path = content[len('gitdir:'):].strip()
+    return os.path.normpath(os.path.join(worktree, path))
+
+
+def common_dir(git_dir):
+    """the directory holding the refs and objects shared by all worktrees"""
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as filehandle:
+            path = filehandle.read().strip()
+    except OSError:
+        return git_dir
+    return os.path.normpath(os.path.join(git_dir, path))
+
+
+def ref_path(git_dir, ref):
+    """the file a loose ref such as 'HEAD' or 'refs/heads/main' is stored in"""
+    if ref.startswith('refs/') and not ref.startswith('refs/worktree/'):
+        return os.path.join(common_dir(git_dir), ref)
+    # HEAD and the other pseudo refs are per worktree
+    return os.path.join(git_dir, ref)
+
+
+def read_symref(git_dir, ref):
+    """the ref a symbolic ref (e.g. 'refs/remotes/origin/HEAD') points to.
+
+    Returns None when `ref` does not exist as a loose file or is not
+    symbolic.
+    """
+    try:
+        with open(ref_path(git_dir, ref)) as filehandle:
+            content = filehandle.read().strip()
+    except OSError:
+        return None
+    if not content.startswith('ref:'):
+        return None
+    return content[len('ref:'):].strip()
+
+
+def read_packed_refs(git_dir):
+    """the mapping of ref name to object id listed in 'packed-refs'"""
+    refs = {}
+    try:
+        with open(os.path.join(common_dir(git_dir), 'packed-refs')) as fh:
+            for line in fh:
+                # skip the '# pack-refs with: ...' header and the peeled
+                # '^<oid>' lines following annotated tags
+                if line.startswith(('#', '^')):
+                    continue
+                oid, _, name = line.rstrip('\n').partition(' ')
+                if name:
+                    refs[name] = oid
+    except OSError:
+        pass
+    return refs
+
+
+def resolve_ref(git_dir, ref, packed=None):
+    """the object id the (full) ref name `ref` points to, or None.
+
+    Follows symbolic refs and falls back to packed-refs for refs without a
+    loose file; `packed` may pass an already read read_packed_refs() result.
+    """
+    for _depth in range(5):
+        try:
+            with open(ref_path(git_dir, ref)) as filehandle:
+                content = filehandle.read().strip()
+        except (OSError, UnicodeDecodeError):
+            content = None
+        if content is None or content == '':
+            if packed is None:
+                packed = read_packed_refs(git_dir)
+            return packed.get(ref)
+        if not content.startswith('ref:'):
+            return content
+        ref = content[len('ref:'):].strip()
+    return None
+
+
+def rev_parse(git_dir, name):
+    """resolve a branch or ref name like git's rev-parse does for refs.
+
+    Tries '<name>', 'refs/<name>', 'refs/tags/<name>', 'refs/heads/<name>',
+    'refs/remotes/<name>' and 'refs/remotes/<name>/HEAD' in this order and
+    returns the object id of the first that exists, or None. Revision syntax
+    (e.g. '@{u}' or 'HEAD~2') is not supported and yields None.
+    """
+    if any(c in name for c in '@{}~^:'):
+        return None
+    packed = read_packed_refs(git_dir)
+    for pattern in ('{}', 'refs/{}', 'refs/tags/{}', 'refs/heads/{}',
+                    'refs/remotes/{}', 'refs/remotes/{}/HEAD'):
+        ref = pattern.format(name)
+        if '/' not in ref and ref != 'HEAD' and not ref.endswith('_HEAD'):
+            # only HEAD-like names are looked up directly in the git dir
+            continue
+        oid = resolve_ref(git_dir, ref, packed)
+        if oid is not None:
+            return oid
+    return None
+
+
+_CONFIG_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+
+def _config_value(raw):
+    """unquote and unescape a config value (the part after '=')"""
+    value = []
+    quoted = False
+    idx = 0
+    pending_space = ''
+    while idx < len(raw):
+        c = raw[idx]
+        idx += 1
+        if c == '"':
+            quoted = not quoted
+        elif c == '\\' and idx < len(raw):
+            escaped = _CONFIG_ESCAPES.get(raw[idx], raw[idx])
+            value.append(pending_space + escaped)
+            pending_space = ''
+            idx += 1
+        elif c in ';#' and not quoted:
+            break
+        elif c.isspace() and not quoted:
+            # inner whitespace is kept, trailing whitespace is dropped
+            if value:
+                pending_space += c
+        else:
+            value.append(pending_space + c)
+            pending_space = ''
+    return ''.join(value)
+
+
+def read_config(git_dir):
+    """parse the repository's config file into a dict.
+
+    Maps 'section.key' or 'section.subsection.key' (section and key in lower
+    case, like 'git config' expects them) to the list of its values; a key
+    without '=' is a boolean 'true'. Include directives are not followed.
+    Returns None when the config can not be read.
+    """
+    return read_config_file(os.path.join(common_dir(git_dir), 'config'))
+
+
+def read_config_file(path, config=None):
+    """parse the config file `path` like read_config(), adding to the dict
+    `config` if given; None when the file can not be read"""
+    try:
+        with open(path, encoding='utf-8', errors='replace') as filehandle:
+            lines = filehandle.read().split('\n')
+    except OSError:
+        return None
+    if config is None:
+        config = {}
+    section = None
+    idx = 0
+    while idx < len(lines):
+        line = lines[idx].strip()
+        idx += 1
+        # a value continued with a trailing backslash
+        while line.endswith('\\') and idx < len(lines):
+            line = line[:-1] + lines[idx].strip()
+            idx += 1
+        if not line or line[0] in ';#':
+            continue
+        if line.startswith('['):
+            header = line[1:line.rfind(']')]
+            name, _, sub = header.partition(' ')
+            sub = sub.strip()
+            if sub.startswith('"') and sub.endswith('"') and len(sub) >= 2:
+                sub = sub[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                section = name.lower() + '.' + sub
+            elif '.' in name:
+                # the deprecated [section.subsection] syntax
+                name, _, sub = name.partition('.')
+                section = name.lower() + '.' + sub.lower()
+            else:
+                section = name.lower()
+            # anything after the header on the same line is a key
+            line = line[line.rfind(']') + 1:].strip()
+            if not line or line[0] in ';#':
+                continue
+        if section is None:
+            continue
+        key, eq, raw = line.partition('=')
+        key = key.strip().lower()
+        value = _config_value(raw.strip()) if eq else 'true'
+        config.setdefault(section + '.' + key, []).append(value)
+    return config
+
+
+def user_config_files():
+    """the system and user wide config files git reads, in git's order"""
+    home = os.path.expanduser('~')
+    xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+    files = []
+    if not os.environ.get('GIT_CONFIG_NOSYSTEM'):
+        files.append('/etc/gitconfig')
+    files.append(os.path.join(xdg, 'git', 'config'))
+    files.append(os.path.join(home, '.gitconfig'))
+    return files
+
+
+def read_user_config():
+    """the merged read_config() dict of the system and user wide config.
+
+    Unconditional includes ('include.path') are followed; conditional ones
+    ('includeIf') depend on the repository and are skipped.
+    """
+    config = {}
+    for path in user_config_files():
+        _read_with_includes(path, config, 0)
+    return config
+
+
+def _read_with_includes(path, config, depth):
+    included = {}
+    if depth > 10 or read_config_file(path, included) is None:
+        return
+    for key, values in included.items():
+        if key == 'include.path':
+            for value in values:
+                value = os.path.expanduser(value)
+                _read_with_includes(os.path.join(os.path.dirname(path), value),
+                                    config, depth + 1)
+        else:
+            config.setdefault(key, []).extend(values)
+
+
+def rewrite_url(url, config):
+    """apply the 'url.<base>.insteadOf' rules of `config` to `url`, like git
+    does for remote urls (the longest matching prefix wins)"""
+    best = None
+    for key, values in config.items():
+        if not (key.startswith('url.') and key.endswith('.insteadof')):
+            continue
+        base = key[len('url.'):-len('.insteadof')]
+        for prefix in values:
+            if url.startswith(prefix) \
+                    and (best is None or len(prefix) > len(best[1])):
+                best = (base, prefix)
+    if best is None:
+        return url
+    return best[0] + url[len(best[1]):]
+
+
+def config_get(config, key, default=None):
+    """the last value of `key` in a read_config() dict, like 'git config'"""
+    values = config.get(key) if config else None
+    return values[-1] if values else default
+
+
+def _map_refspec(spec, ref):
+    """map `ref` through a fetch refspec ('+src:dst'), or None if no match"""
+    src, _, dst = spec.lstrip('+').partition(':')
+    if '*' in src:
+        prefix, _, suffix = src.partition('*')
+        if ref.startswith(prefix) and ref.endswith(suffix) \
+                and len(ref) >= len(prefix) + len(suffix):
+            middle = ref[len(prefix):len(ref) - len(suffix)]
+            return dst.replace('*', middle, 1) if dst else None
+        return None
+    return dst if src == ref and dst else None
+
+
+def parse_ls_remote(output):
+    """the {ref: object id} listed in the output of 'git ls-remote',
+    without the peeled '<tag>^{}' entries"""
+    refs = {}
+    for line in output.splitlines():
+        oid, _, ref = line.partition('\t')
+        if ref and not ref.endswith('^{}'):
+            refs[ref] = oid
+    return refs
+
+
+def fetch_changes(git_dir, remote, advertised, config):
+    """whether 'git fetch <remote>' would update any ref.
+
+    Maps the refs the remote `advertised` (see parse_ls_remote) through the
+    remote's fetch refspecs and compares them with the local refs they are
+    fetched into; an advertised tag missing locally counts as a change too,
+    unless the remote is configured with --no-tags. `config` is the
+    repository's read_config() dict, merged with the user's config.
+
+    Returns None when that can not be told this way: the remote has no or
+    negative refspecs, fetching prunes refs (deleted upstream refs would have
+    to be looked for), or the refs are not stored as files.
+    """
+    specs = config.get('remote.{}.fetch'.format(remote), [])
+    if not specs or any(spec.startswith('^') for spec in specs) \
+            or config_get(config, 'extensions.refstorage', 'files') != 'files':
+        return None
+    prune = config_get(config, 'remote.{}.prune'.format(remote),
+                       config_get(config, 'fetch.prune', 'false'))
+    if prune.lower() in ('true', 'yes', 'on', '1'):
+        return None
+    packed = read_packed_refs(git_dir)
+    tags = config_get(config, 'remote.{}.tagopt'.format(remote)) \
+        != '--no-tags'
+    for ref, oid in advertised.items():
+        for spec in specs:
+            local = _map_refspec(spec, ref)
+            if local is not None \
+                    and resolve_ref(git_dir, local, packed) != oid:
+                return True
+        if tags and ref.startswith('refs/tags/') \
+                and resolve_ref(git_dir, ref, packed) is None:
+            return True
+    return False
+
+
+def upstream_ref(config, branch):
+    """the full name of the ref the local `branch` tracks, or None.
+
+    Like git's '<branch>@{u}': branch.<branch>.merge mapped through the fetch
+    refspecs of branch.<branch>.remote (or the ref itself for the remote '.').
+    """
+    remote = config_get(config, 'branch.{}.remote'.format(branch))
+    merge = config_get(config, 'branch.{}.merge'.format(branch))
+    if remote is None or merge is None:
+        return None
+    if remote == '.':
+        return merge
+    for spec in config.get('remote.{}.fetch'.format(remote), []):
+        mapped = _map_refspec(spec, merge)
+        if mapped is not None:
+            return mapped
+    return None
+
+
+def head_branch(git_dir):
+    """the name of the checked out branch, or None for a detached HEAD"""
+    ref = read_symref(git_dir, 'HEAD')
+    if ref is None or not ref.startswith('refs/heads/'):
+        return None
+    return ref[len('refs/heads/'):]
+
+
+def abbrev_head(git_dir):
+    """what 'git rev-parse --abbrev-ref HEAD' prints, or None where it fails.
+
+    That is the checked out branch's name (prefixed with 'heads/' if it is
+    ambiguous), or 'HEAD' when detached. None also for an unborn branch.
+    """
+    packed = read_packed_refs(git_dir)
+    if resolve_ref(git_dir, 'HEAD', packed) is None:
+        return None
+    ref = read_symref(git_dir, 'HEAD')
+    if ref is None:
+        return 'HEAD'
+    if not ref.startswith('refs/heads/'):
+        return ref
+    branch = ref[len('refs/heads/'):]
+    for other in ('refs/{}', 'refs/tags/{}', 'refs/remotes/{}',
+                  'refs/remotes/{}/HEAD'):
+        if resolve_ref(git_dir, other.format(branch), packed) is not None:
+            return 'heads/' + branch
+    return branch
+
+
+class CommitGraph:
+    """an in-process reader for git's commit-graph files.
+
+    The commit-graph (objects/info/commit-graph, or a chain of split files in
+    objects/info/commit-graphs) lists the parents and the generation number of
+    every commit it covers, which is all ahead_behind() needs. Commits are
+    addressed by their (global) position in the graph.
+    """
+
+    PARENT_NONE = 0x70000000
+    EDGE_EXTRA = 0x80000000
+    EDGE_LAST = 0x80000000
+
+    def __init__(self, paths):
+        import mmap
+        self._layers = []
+        offset = 0
+        for path in paths:
+            with open(path, 'rb') as filehandle:
+                data = mmap.mmap(filehandle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            layer = self._parse(data, path)
+            layer['offset'] = offset
+            offset += layer['count']
+            self._layers.append(layer)
+        self.count = offset
+
+    @staticmethod
+    def _parse(data, path):
+        import struct
+        if data[0:4] != b'CGPH' or data[4] != 1:
+            raise ValueError('{}: not a commit-graph (version 1)'.format(path))
+        hash_len = {1: 20, 2: 32}.get(data[5])
+        if hash_len is None:
+            raise ValueError('{}: unknown hash version'.format(path))
+        chunks = {}
+        num_chunks = data[6]
+        for idx in range(num_chunks):
+            chunk_id, chunk_offset = struct.unpack_from('>4sQ', data,
+                                                        8 + 12 * idx)
+            chunks[chunk_id] = chunk_offset
+        for required in (b'OIDF', b'OIDL', b'CDAT'):
+            if required not in chunks:
+                raise ValueError('{}: missing {} chunk'.format(path, required))
+        fanout = struct.unpack_from('>256I', data, chunks[b'OIDF'])
+        return {
+            'data': data,
+            'hash_len': hash_len,
+            'fanout': fanout,
+            'count': fanout[255],
+            'oidl': chunks[b'OIDL'],
+            'cdat': chunks[b'CDAT'],
+            'edge': chunks.get(b'EDGE'),
+        }
+
+    @staticmethod
+    def load(git_dir):
+        """the CommitGraph of a repository, or None when it has none"""
+        info = os.path.join(common_dir(git_dir), 'objects', 'info')
+        paths = []
+        chain = os.path.join(info, 'commit-graphs', 'commit-graph-chain')
+        try:
+            with open(chain) as filehandle:
+                for line in filehandle:
+                    if line.strip():
+                        paths.append(os.path.join(
+                            info, 'commit-graphs',
+                            'graph-{}.graph'.format(line.strip())))
+        except OSError:
+            single = os.path.join(info, 'commit-graph')
+            if os.path.isfile(single):
+                paths.append(single)
+        if not paths:
+            return None
+        try:
+            return CommitGraph(paths)
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def position(self, oid):
+        """the graph position of the commit with the hex object id `oid`"""
+        try:
+            raw = bytes.fromhex(oid)
+        except ValueError:
+            return None
+        for layer in self._layers:
+            if len(raw) != layer['hash_len']:
+                return None
+            fanout = layer['fanout']
+            lo = fanout[raw[0] - 1] if raw[0] > 0 else 0
+            hi = fanout[raw[0]]
+            data, base, size = layer['data'], layer['oidl'], layer['hash_len']
+            while lo < hi:
+                mid = (lo + hi) // 2
+                candidate = data[base + mid * size:base + (mid + 1) * size]
+                if candidate < raw:
+                    lo = mid + 1
+                elif candidate > raw:
+                    hi = mid
+                else:
+                    return layer['offset'] + mid
+        return None
+
+    def _record(self, pos):
+        """the layer holding graph position `pos` and the offset of its CDAT
+        record"""
+        for layer in reversed(self._layers):
+            if pos >= layer['offset']:
+                local = pos - layer['offset']
+                return layer, layer['cdat'] + local * (layer['hash_len'] + 16)
+        raise IndexError(pos)
+
+    def tree(self, pos):
+        """the hex object id of the root tree of the commit at `pos`"""
+        layer, record = self._record(pos)
+        return layer['data'][record:record + layer['hash_len']].hex()
+
+    def generation(self, pos):
+        """the topological level of the commit at `pos` (0 if not computed)"""
+        layer, record = self._record(pos)
+        offset = record + layer['hash_len'] + 8
+        return int.from_bytes(layer['data'][offset:offset + 4], 'big') >> 2
+
+    def parents(self, pos):
+        """the graph positions of the parents of the commit at `pos`"""
+        layer, record = self._record(pos)
+        data = layer['data']
+        offset = record + layer['hash_len']
+        first = int.from_bytes(data[offset:offset + 4], 'big')
+        second = int.from_bytes(data[offset + 4:offset + 8], 'big')
+        if first == self.PARENT_NONE:
+            return []
+        if second == self.PARENT_NONE:
+            return [first]
+        if not second & self.EDGE_EXTRA:
+            return [first, second]
+        # an octopus merge: the remaining parents are listed in EDGE
+        result = [first]
+        edge = layer['edge'] + 4 * (second & ~self.EDGE_EXTRA)
+        while True:
+            value = int.from_bytes(data[edge:edge + 4], 'big')
+            result.append(value & ~self.EDGE_LAST)
+            if value & self.EDGE_LAST:
+                return result
+            edge += 4
+
+
+def ahead_behind(graph, left, right):
+    """count the commits reachable only from `left` and only from `right`.
+
+    `left` and `right` are hex object ids; returns the pair of counts (like
+    'git rev-list --left-right --count left...right'), or None when either
+    commit is not covered by the CommitGraph `graph`. Walks both histories in
+    decreasing generation order and stops as soon as everything still queued
+    is reachable from both sides.
+    """
+    import heapq
+    if left is None or right is None:
+        return None
+    if left == right:
+        return 0, 0
+    if graph is None:
+        return None
+    LEFT, RIGHT, BOTH = 1, 2, 3
+    flags = {}
+    queue = []
+    for oid, flag in ((left, LEFT), (right, RIGHT)):
+        pos = graph.position(oid)
+        if pos is None:
+            return None
+        if pos not in flags:
+            heapq.heappush(queue, (-graph.generation(pos), pos))
+        flags[pos] = flags.get(pos, 0) | flag
+    # the number of queued commits that are not (yet) reachable from both
+    undecided = sum(1 for f in flags.values() if f != BOTH)
+    counts = [0, 0]
+    while queue and undecided:
+        neg_generation, pos = heapq.heappop(queue)
+        if neg_generation == 0:
+            # generation numbers were never computed: the order is unreliable
+            return None
+        flag = flags[pos]
+        if flag != BOTH:
+            undecided -= 1
+            counts[flag - 1] += 1
+        for parent in graph.parents(pos):
+            old = flags.get(parent)
+            new = (old or 0) | flag
+            if old is None:
+                # a parent's generation is lower than its child's, so it is
+                # popped only after every child reaching it was processed
+                heapq.heappush(queue, (-graph.generation(parent), parent))
+                if new != BOTH:
+                    undecided += 1
+            elif new == BOTH and old != BOTH:
+                undecided -= 1
+            flags[parent] = new
+    return counts[0], counts[1]
+
+
+def commit_tree(git_dir, oid, graph=None):
+    """the hex object id of the root tree of the commit `oid`, or None.
+
+    Looked up in the CommitGraph `graph` (if given) or read from the loose
+    commit object; packed objects are not read.
+    """
+    import zlib
+    if graph is not None:
+        pos = graph.position(oid)
+        if pos is not None:
+            return graph.tree(pos)
+    path = os.path.join(common_dir(git_dir), 'objects', oid[:2], oid[2:])
+    try:
+        with open(path, 'rb') as filehandle:
+            # the header and the first line fit into the first few bytes
+            data = zlib.decompressobj().decompress(filehandle.read(), 256)
+    except (OSError, zlib.error):
+        return None
+    header, _, body = data.partition(b'\0')
+    if not header.startswith(b'commit ') or not body.startswith(b'tree '):
+        return None
+    return body[5:body.find(b'\n')].decode('ascii', 'replace')
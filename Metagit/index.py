@@ -0,0 +1,292 @@
+"""A native reader for git's index file and a quick 'is it dirty' check.
+
+For large working trees, 'git status' spends most of its time comparing the
+stat data recorded in the index with the files on disk. quick_dirty() does the
+same comparison in-process (spread over a thread pool), which is enough to
+tell whether the tracked files have uncommitted changes without launching git.
+
+It answers None instead of guessing whenever the stat data alone is not
+conclusive (e.g. a file touched without changing its size, an entry written
+in the same instant as the index, a submodule or an index extension we do
+not understand), so the caller can fall back to git.
+"""
+import os
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from .gitdir import (
+    CommitGraph,
+    commit_tree,
+    config_get,
+    read_config,
+    resolve_ref,
+)
+
+
+class UnsupportedIndex(Exception):
+    """the index uses a version or extension read_index() can not handle"""
+
+
+# the fixed part of an entry: ctime, mtime (seconds and nanoseconds each),
+# dev, ino, mode, uid, gid, size
+_ENTRY_STAT = struct.Struct('>10I')
+_FLAG_EXTENDED = 0x4000
+_FLAG_STAGE = 0x3000
+_FLAG_NAME_LENGTH = 0x0fff
+_FLAG_ASSUME_VALID = 0x8000
+_XFLAG_INTENT_TO_ADD = 0x2000
+_XFLAG_SKIP_WORKTREE = 0x4000
+_MODE_GITLINK = 0o160000
+
+
+class IndexEntry:
+    __slots__ = ('path', 'ctime', 'mtime', 'ino', 'mode', 'uid', 'gid',
+                 'size', 'oid', 'stage', 'assume_valid', 'intent_to_add',
+                 'skip_worktree')
+
+
+class Index:
+    """the parsed content of an index file.
+
+    `entries` is the list of IndexEntry objects (paths as bytes), `root_tree`
+    the hex tree id the cached tree (TREE extension) records for the whole
+    index, or None when that is invalid or absent, `mtime` the index file's
+    (seconds, nanoseconds) modification time and `extensions` the signatures
+    of its extensions (e.g. 'TREE', 'UNTR'), in file order.
+    """
+
+    def __init__(self, version, entries, root_tree, mtime, extensions=()):
+        self.version = version
+        self.entries = entries
+        self.root_tree = root_tree
+        self.mtime = mtime
+        self.extensions = extensions
+
+
+def _varint(data, offset):
+    """decode the offset encoding used by index version 4"""
+    c = data[offset]
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+
+def _root_tree(data, hash_len):
+    """the root tree id recorded by a TREE extension, or None if invalid"""
+    # '<path>\0<entry count> <subtrees>\n<oid>', the root having an empty path
+    if not data.startswith(b'\0'):
+        return None
+    line_end = data.find(b'\n')
+    count = data[1:line_end].split(b' ')[0]
+    if count == b'-1':
+        return None
+    return data[line_end + 1:line_end + 1 + hash_len].hex()
+
+
+def object_id_length(config):
+    """the length in bytes of an object id in a repository with the
+    read_config() dict `config`"""
+    if config_get(config, 'extensions.objectformat') == 'sha256':
+        return 32
+    return 20
+
+
+def read_index(git_dir, hash_len=None, strict=True):
+    """parse the index of a repository (versions 2 to 4).
+
+    Raises UnsupportedIndex for other versions and for mandatory extensions
+    (e.g. a split or sparse index), and OSError when there is no index.
+    `hash_len` is the length of an object id, read from the config if None.
+    With strict=False, mandatory extensions are only listed in `extensions`:
+    the entries are then incomplete, but the index's format can be told.
+    """
+    if hash_len is None:
+        hash_len = object_id_length(read_config(git_dir))
+    path = os.path.join(git_dir, 'index')
+    with open(path, 'rb') as filehandle:
+        st = os.fstat(filehandle.fileno())
+        data = filehandle.read()
+    try:
+        return _parse_index(path, data, st, hash_len, strict)
+    except (struct.error, ValueError, IndexError):
+        raise UnsupportedIndex('{}: truncated or corrupt index'.format(path))
+
+
+def _parse_index(path, data, st, hash_len, strict=True):
+    if len(data) < 12 or data[0:4] != b'DIRC':
+        raise UnsupportedIndex('{}: not an index file'.format(path))
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in (2, 3, 4):
+        raise UnsupportedIndex('{}: index version {}'.format(path, version))
+    entries = []
+    offset = 12
+    previous = b''
+    for _ in range(count):
+        start = offset
+        fields = _ENTRY_STAT.unpack_from(data, offset)
+        offset += _ENTRY_STAT.size
+        oid = data[offset:offset + hash_len]
+        offset += hash_len
+        flags, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        xflags = 0
+        if flags & _FLAG_EXTENDED:
+            xflags, = struct.unpack_from('>H', data, offset)
+            offset += 2
+        if version == 4:
+            strip, offset = _varint(data, offset)
+            end = data.index(b'\0', offset)
+            name = previous[:len(previous) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b'\0', offset)
+            name = data[offset:end]
+            # entries are padded with 1-8 NUL bytes to a multiple of 8
+            offset = start + ((end - start) // 8 + 1) * 8
+        previous = name
+        entry = IndexEntry()
+        entry.path = name
+        entry.ctime = (fields[0], fields[1])
+        entry.mtime = (fields[2], fields[3])
+        entry.ino = fields[5]
+        entry.mode = fields[6]
+        entry.uid = fields[7]
+        entry.gid = fields[8]
+        entry.size = fields[9]
+        entry.oid = oid
+        entry.stage = (flags & _FLAG_STAGE) >> 12
+        entry.assume_valid = bool(flags & _FLAG_ASSUME_VALID)
+        entry.intent_to_add = bool(xflags & _XFLAG_INTENT_TO_ADD)
+        entry.skip_worktree = bool(xflags & _XFLAG_SKIP_WORKTREE)
+        entries.append(entry)
+    root_tree = None
+    extensions = []
+    # the extensions follow the entries, the file ends with its checksum
+    while offset + 8 <= len(data) - hash_len:
+        signature = data[offset:offset + 4]
+        size, = struct.unpack_from('>I', data, offset + 4)
+        body = data[offset + 8:offset + 8 + size]
+        offset += 8 + size
+        extensions.append(signature.decode('ascii', 'replace'))
+        if signature == b'TREE':
+            root_tree = _root_tree(body, hash_len)
+        elif strict and not b'A' <= signature[0:1] <= b'Z':
+            # extensions starting with a lower case letter change the meaning
+            # of the entries and must be understood (e.g. 'link', 'sdir')
+            raise UnsupportedIndex('{}: unsupported extension {}'
+                                   .format(path, signature.decode('ascii',
+                                                                  'replace')))
+    mtime = (st.st_mtime_ns // 1000000000, st.st_mtime_ns % 1000000000)
+    return Index(version, entries, root_tree, mtime, tuple(extensions))
+
+
+def _split_ns(ns):
+    """a stat timestamp as the (seconds, nanoseconds) pair the index stores"""
+    return (ns // 1000000000) & 0xffffffff, ns % 1000000000
+
+
+def _check_entries(worktree, entries, index_mtime, trust_ctime, check_mode):
+    """compare the stat data of `entries` with the files in `worktree`.
+
+    Returns True as soon as one of them certainly changed, None if one of
+    them may have changed, and False if all of them are unchanged.
+    """
+    unknown = False
+    for entry in entries:
+        if entry.skip_worktree or entry.assume_valid:
+            continue
+        if entry.stage != 0 or entry.intent_to_add:
+            return True
+        if entry.mode == _MODE_GITLINK:
+            # a submodule: whether it changed is up to its own repository
+            unknown = True
+            continue
+        try:
+            st = os.lstat(os.path.join(worktree, entry.path))
+        except (FileNotFoundError, NotADirectoryError):
+            return True
+        except OSError:
+            unknown = True
+            continue
+        if stat.S_ISLNK(entry.mode) != stat.S_ISLNK(st.st_mode) \
+                or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+            return True
+        if check_mode and stat.S_ISREG(st.st_mode) \
+                and (entry.mode & 0o100) != (st.st_mode & 0o100):
+            return True
+        if entry.size != st.st_size & 0xffffffff:
+            if entry.size == 0:
+                # git zeroes the size of racily clean entries when writing
+                # the index, so the content has to be compared
+                unknown = True
+                continue
+            # a different size means different content
+            return True
+        mtime = _split_ns(st.st_mtime_ns)
+        ctime = _split_ns(st.st_ctime_ns)
+        if entry.mtime != mtime or (trust_ctime and entry.ctime != ctime) \
+                or entry.ino != st.st_ino & 0xffffffff \
+                or entry.uid != st.st_uid or entry.gid != st.st_gid:
+            # touched, but possibly with the same content: git would have to
+            # compare the content
+            unknown = True
+        elif entry.mtime >= index_mtime:
+            # 'racily clean': modified in the same instant the index was
+            # written, so the stat data can not be trusted
+            unknown = True
+    return None if unknown else False
+
+
+def quick_dirty(worktree, git_dir, jobs=None):
+    """whether the tracked files of a repository have uncommitted changes.
+
+    Returns True or False when the index and the stat data tell for sure,
+    and None otherwise (including for repositories without commits or with
+    an index read_index() can not handle). Both staged changes (by comparing
+    the index's cached tree with HEAD's tree) and unstaged ones count;
+    untracked files are not looked at. The stat calls are spread over `jobs`
+    threads (default: one per CPU).
+    """
+    config = read_config(git_dir) or {}
+    try:
+        index = read_index(git_dir, object_id_length(config))
+    except (OSError, UnsupportedIndex):
+        return None
+    # staged changes: the index must still describe HEAD's tree
+    head = resolve_ref(git_dir, 'HEAD')
+    head_tree = None
+    if head is not None and index.root_tree is not None:
+        head_tree = commit_tree(git_dir, head, CommitGraph.load(git_dir))
+        if head_tree is not None and head_tree != index.root_tree:
+            return True
+    trust_ctime = config_get(config, 'core.trustctime', 'true') \
+        .lower() in ('true', 'yes', 'on', '1')
+    check_mode = config_get(config, 'core.filemode', 'true') \
+        .lower() in ('true', 'yes', 'on', '1')
+    root = os.fsencode(worktree)
+    entries = index.entries
+    jobs = jobs or os.cpu_count() or 1
+    chunk = max(1024, len(entries) // (jobs * 4) + 1)
+    if len(entries) <= chunk:
+        results = [_check_entries(root, entries, index.mtime, trust_ctime,
+                                  check_mode)]
+    else:
+        chunks = [entries[i:i + chunk]
+                  for i in range(0, len(entries), chunk)]
+        with ThreadPoolExecutor(max_workers=jobs,
+                                thread_name_prefix='metagit-index') as pool:
+            results = list(pool.map(
+                lambda part: _check_entries(root, part, index.mtime,
+                                            trust_ctime, check_mode),
+                chunks))
+    if True in results:
+        return True
+    if None in results or head_tree is None:
+        # without a valid cached tree, staged changes can not be ruled out
+        return None
+    return False
@@ -0,0 +1,279 @@
+"""Sharing one SSH connection per host between the git commands of a bulk
+operation.
+
+Fetching or cloning dozens of repositories from the same SSH host costs a full
+SSH handshake (key exchange and authentication) per git command. While a
+Multiplexer is active, GitRepository.call() runs git with a GIT_SSH_COMMAND
+that makes OpenSSH share one master connection per host (ControlMaster), the
+control sockets living in a private directory owned by metagit. The first
+command for a host opens its master connection before git runs, so the
+commands started alongside it do not race to become the master (each of them
+would pay a handshake), and at most MAX_SESSIONS commands share a master at a
+time. close() shuts the master connections down again and, in verbose mode,
+reports how many handshakes were saved.
+
+Only repositories with an ssh url are multiplexed, and only when git would use
+OpenSSH's ssh: a repository's core.sshCommand (or the user wide one, or
+$GIT_SSH_COMMAND) is kept as the base of the command, while $GIT_SSH and
+commands other than ssh (e.g. plink) disable multiplexing.
+"""
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+import contextlib
+import subprocess
+
+from .gitdir import config_get, find_git_dir, read_config, read_user_config
+from .utils import debug
+from . import trace
+
+
+# how long an idle master connection outlives its last session, in seconds.
+# close() ends the masters right away; this only bounds their lifetime when
+# metagit dies before
+CONTROL_PERSIST = 60
+
+# how long opening a master connection may take, in seconds
+CONNECT_TIMEOUT = 10
+
+# the number of commands sharing a master connection at a time: sshd refuses
+# more sessions per connection than its MaxSessions (10 by default)
+MAX_SESSIONS = 10
+
+# the git commands that may talk to a remote; other ones (e.g. 'git status')
+# are run unchanged
+_REMOTE_COMMANDS = frozenset(('clone', 'fetch', 'ls-remote', 'pull', 'push',
+                              'remote', 'submodule'))
+
+_SSH_URL = re.compile(r'^(?:ssh|git\+ssh|ssh\+git)://(?:([^@/]*)@)?'
+                      r'(\[[^\]/]*\]|[^:/]*)(?::(\d*))?', re.IGNORECASE)
+_SCP_URL = re.compile(r'^(?:([^@/]*)@)?(\[[^\]/]*\]|[^:/\[]+):')
+
+
+def ssh_destination(url):
+    """the (user, host, port) an ssh url (ssh://..., or git's scp-like
+    [user@]host:path) talks to, user and port being None unless given; None
+    for any other url"""
+    if not url:
+        return None
+    match = _SSH_URL.match(url)
+    if match is not None:
+        user, host, port = match.groups()
+        if not host:
+            return None
+        return user, host.strip('[]'), port or None
+    if '://' in url:
+        return None
+    match = _SCP_URL.match(url)
+    if match is not None:
+        user, host = match.groups()
+        return user, host.strip('[]'), None
+    return None
+
+
+def _is_openssh(command):
+    """whether the shell command line `command` runs OpenSSH's ssh"""
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return False
+    return bool(words) and os.path.basename(words[0]) == 'ssh'
+
+
+class Multiplexer:
+    """the master connections of one bulk operation.
+
+    Use it as a context manager around the operation, or call start() and
+    close(); while it is started, GitRepository.call() runs every command in
+    a session().
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.base = None
+        # the commands run with multiplexing, and the master connections
+        # (control sockets, by name and inode) seen so far
+        self.sessions = 0
+        self._masters = set()
+        self._lock = threading.Lock()
+        # per master connection: a lock held while it is opened, and a
+        # semaphore bounding its sessions
+        self._connecting = {}
+        self._connected = set()
+        self._sessions = {}
+
+    def start(self):
+        """create the socket directory and hook into GitRepository; does
+        nothing (and returns False) when git would not use OpenSSH"""
+        from .Repository import GitRepository
+        if os.environ.get('GIT_SSH_COMMAND'):
+            self.base = os.environ['GIT_SSH_COMMAND']
+        elif os.environ.get('GIT_SSH'):
+            debug('ssh multiplexing: $GIT_SSH is set, not multiplexing')
+            return False
+        else:
+            self.base = config_get(read_user_config(), 'core.sshcommand',
+                                   'ssh')
+        if shutil.which('ssh') is None:
+            return False
+        # a socket path must fit into about 100 bytes: prefer the short,
+        # private $XDG_RUNTIME_DIR, and /tmp over long paths
+        parent = os.environ.get('XDG_RUNTIME_DIR')
+        if not parent or len(parent) > 40 or not os.path.isdir(parent):
+            parent = None
+        self.directory = tempfile.mkdtemp(prefix='metagit-ssh-', dir=parent)
+        GitRepository.ssh = self
+        return True
+
+    @contextlib.contextmanager
+    def session(self, repo, cmd, env=None):
+        """a context manager giving the environment to run the command `cmd`
+        (an argument list, or a shell command line) for `repo` in: `env`
+        (None for the inherited one) with multiplexing added, if `cmd` is a
+        git command that may talk to a remote.
+
+        The master connection to the repository's host is opened first,
+        unless that was tried before; commands for the same host meanwhile
+        wait for it, as do those exceeding MAX_SESSIONS.
+        """
+        master = self._master(repo, cmd)
+        if master is None:
+            yield env
+            return
+        self._connect(*master)
+        with self._lock:
+            self.sessions += 1
+            self._masters |= self._sockets()
+            sessions = self._sessions.setdefault(
+                master, threading.BoundedSemaphore(MAX_SESSIONS))
+        with sessions:
+            yield dict(os.environ if env is None else env,
+                       GIT_SSH_COMMAND=master[0])
+
+    def _master(self, repo, cmd):
+        """the ssh command line and the (user, host, port) of the master
+        connection `cmd` run for `repo` shares, None if it is not
+        multiplexed"""
+        if isinstance(cmd, str):
+            # a shell command line only counts as the git command it starts
+            # with: anything else (e.g. 'make') may never talk to the host,
+            # and would only wait for its master connection
+            try:
+                cmd = shlex.split(cmd)
+            except ValueError:
+                return None
+        if len(cmd) < 2 or cmd[0] != 'git' or cmd[1] not in _REMOTE_COMMANDS:
+            return None
+        destination = ssh_destination(repo.config.get('url'))
+        if self.directory is None or destination is None:
+            return None
+        base = self.base
+        git_dir = find_git_dir(repo.path)
+        if git_dir is not None:
+            # a repository's own ssh command (e.g. choosing a key) is kept
+            base = config_get(read_config(git_dir), 'core.sshcommand', base)
+        if not _is_openssh(base):
+            return None
+        command = '{} -o ControlMaster=auto -o ControlPath={} ' \
+            '-o ControlPersist={}'.format(
+                base, shlex.quote(os.path.join(self.directory, '%C')),
+                CONTROL_PERSIST)
+        return command, destination
+
+    def _connect(self, command, destination):
+        """open the master connection to `destination` in the background with
+        the ssh command line `command`, unless that was tried already"""
+        with self._lock:
+            lock = self._connecting.setdefault(
+                (command, destination), threading.Lock())
+        with lock:
+            if (command, destination) in self._connected:
+                return
+            user, host, port = destination
+            args = shlex.split(command) + [
+                # never prompt: when a password is needed, git's own ssh
+                # asks for it (and becomes the master)
+                '-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout={}'.format(CONNECT_TIMEOUT),
+                '-f', '-N']
+            if port:
+                args += ['-p', port]
+            args.append(host if user is None else '{}@{}'.format(user, host))
+            started = trace.clock()
+            # the master stays in the background holding on to its stderr, so
+            # a pipe would never see the end of it
+            with tempfile.TemporaryFile() as errors:
+                try:
+                    proc = subprocess.run(args, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=errors,
+                                          timeout=2 * CONNECT_TIMEOUT)
+                except (OSError, subprocess.TimeoutExpired) as e:
+                    debug('ssh multiplexing: connecting {} failed: {}'
+                          .format(host, e))
+                else:
+                    errors.seek(0)
+                    err = errors.read()
+                    trace.record(' '.join(args), started, proc.returncode,
+                                 None, err)
+                    if proc.returncode != 0:
+                        debug('ssh multiplexing: connecting {} failed: {}'
+                              .format(host,
+                                      err.decode(errors='replace').strip()))
+            self._connected.add((command, destination))
+
+    def _sockets(self):
+        sockets = set()
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return sockets
+        for entry in entries:
+            try:
+                sockets.add((entry.name, entry.inode()))
+            except OSError:
+                continue
+        return sockets
+
+    def close(self):
+        """shut the master connections down and remove the socket directory"""
+        from .Repository import GitRepository
+        if self.directory is None:
+            return
+        if GitRepository.ssh is self:
+            GitRepository.ssh = None
+        sockets = self._sockets()
+        self._masters |= sockets
+        for name, _inode in sockets:
+            # the control path alone identifies the master; the host name is
+            # only required by the syntax
+            path = os.path.join(self.directory, name).replace('%', '%%')
+            subprocess.run(['ssh', '-o', 'ControlPath=' + path, '-O', 'exit',
+                            'metagit'], stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+        if self.sessions:
+            debug('ssh multiplexing: {} ssh commands over {} connections, '
+                  '{} handshakes saved'.format(
+                      self.sessions, len(self._masters),
+                      max(self.sessions - len(self._masters), 0)))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def multiplexing(enabled=True):
+    """a context manager multiplexing the ssh connections of the git commands
+    run inside it (a no-op with enabled=False)"""
+    if not enabled:
+        return contextlib.nullcontext()
+    return Multiplexer()
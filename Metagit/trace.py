@@ -0,0 +1,158 @@
+"""Recording the external commands metagit runs (see the --trace option).
+
+While tracing is on, every command started through GitRepository.call() and
+acall(), detect_git(), updatedb and locate is recorded with its start time,
+duration, exit code, the size of its output and the thread it ran in. write()
+stores the records in the Chrome trace event format, which chrome://tracing,
+https://ui.perfetto.dev and speedscope display as a timeline with one lane per
+worker thread; summary() lists the slowest commands.
+
+When tracing is off, clock() and record() cost next to nothing, so the calls
+stay in place unconditionally.
+"""
+import os
+import sys
+import time
+
+
+# the recorded commands while tracing, None otherwise
+_records = None
+# the clock() value tracing started at; the trace's timestamps are relative
+# to it
+_origin = 0.0
+
+
+def start():
+    """start recording commands (again, dropping earlier records)"""
+    global _records, _origin
+    _records = []
+    _origin = time.perf_counter()
+
+
+def enabled():
+    return _records is not None
+
+
+def clock():
+    """the time to pass to record() as the start of a command"""
+    return time.perf_counter()
+
+
+def record(cmd, started, exit_code, out=None, err=None, cwd=None):
+    """record the command `cmd` (a string) that ran from `started` (a clock()
+    value) until now, exiting with `exit_code` after printing the bytes `out`
+    and `err` (None when not captured)"""
+    if _records is None:
+        return
+    import threading
+    finished = time.perf_counter()
+    thread = threading.current_thread()
+    # list.append is atomic, so no lock is needed
+    _records.append({
+        'cmd': cmd,
+        'cwd': cwd or os.getcwd(),
+        'start': started - _origin,
+        'duration': finished - started,
+        'exit': exit_code,
+        'stdout': None if out is None else len(out),
+        'stderr': None if err is None else len(err),
+        'thread': thread.name,
+        'thread_id': threading.get_native_id(),
+    })
+
+
+def records():
+    """the records so far, in the order the commands finished"""
+    return list(_records or [])
+
+
+def _name(cmd):
+    """a short name for the command line `cmd`, e.g. 'git status'"""
+    words = cmd.split()
+    if len(words) > 1 and os.path.basename(words[0]) == 'git' \
+            and not words[1].startswith('-'):
+        return 'git ' + words[1]
+    return os.path.basename(words[0]) if words else cmd
+
+
+def _lanes(records):
+    """the lane of every record: commands overlapping in time within one
+    thread (as those of acall() on an event loop do) go to separate lanes,
+    as a trace viewer can only nest events of a lane, not overlap them.
+
+    Returns a list of lane numbers parallel to `records` and the name of
+    every lane.
+    """
+    lanes = [None] * len(records)
+    names = {}
+    # per thread: the end time of the last command in each of its lanes
+    busy = {}
+    for i in sorted(range(len(records)), key=lambda i: records[i]['start']):
+        r = records[i]
+        ends = busy.setdefault(r['thread_id'], [])
+        for slot, end in enumerate(ends):
+            if end <= r['start']:
+                break
+        else:
+            slot = len(ends)
+            ends.append(0)
+        ends[slot] = r['start'] + r['duration']
+        key = (r['thread_id'], slot)
+        if key not in names:
+            names[key] = r['thread'] if slot == 0 \
+                else '{} ({})'.format(r['thread'], slot + 1)
+        lanes[i] = key
+    numbers = {key: n for n, key in enumerate(sorted(names), 1)}
+    return [numbers[key] for key in lanes], \
+        {numbers[key]: name for key, name in names.items()}
+
+
+def chrome_trace(records):
+    """the Chrome trace event JSON object of `records`"""
+    pid = os.getpid()
+    lanes, names = _lanes(records)
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+               'args': {'name': 'metagit ' + ' '.join(sys.argv[1:])}}]
+    for lane, name in sorted(names.items()):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': lane, 'args': {'name': name}})
+        events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': pid,
+                       'tid': lane, 'args': {'sort_index': lane}})
+    for r, lane in zip(records, lanes):
+        events.append({
+            'name': _name(r['cmd']),
+            'cat': 'subprocess',
+            'ph': 'X',
+            # in microseconds
+            'ts': round(r['start'] * 1e6, 3),
+            'dur': round(r['duration'] * 1e6, 3),
+            'pid': pid,
+            'tid': lane,
+            'args': {key: r[key] for key in
+                     ('cmd', 'cwd', 'exit', 'stdout', 'stderr', 'thread')},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write(path):
+    """write the records to `path` in the Chrome trace event format"""
+    import json
+    with open(path, 'w') as filehandle:
+        json.dump(chrome_trace(records()), filehandle)
+
+
+def summary(top=10, file=None):
+    """print the number and total duration of the commands and the `top`
+    slowest of them (to stderr by default)"""
+    file = sys.stderr if file is None else file
+    recorded = records()
+    total = sum(r['duration'] for r in recorded)
+    print('{} commands ran for {:.3f} s in total{}'.format(
+        len(recorded), total, '; the slowest:' if recorded else ''),
+        file=file)
+    recorded.sort(key=lambda r: r['duration'], reverse=True)
+    for r in recorded[:top]:
+        print('{:9.3f} s  exit {:<3} {:>9}  {}  (in {}, {})'.format(
+            r['duration'], r['exit'],
+            '' if r['stdout'] is None else '{} B'.format(r['stdout']),
+            r['cmd'], r['cwd'], r['thread']), file=file)
@@ -1,8 +1,17 @@
 """Interactive ncurses UI showing the repository status.
 
+The UI starts right away with the statuses the previous run left in the status
+cache, shown as stale, and evaluates the repositories in the background
+(those visible on screen first), updating each row as its status arrives.
+While it runs, it watches the git metadata (HEAD, index, refs) of the
+repositories and re-evaluates those that change, e.g. after a commit in
+another terminal.
+
 Repositories can run a command (e.g. fetch) in the background. While such a
 command is running, its status is shown in place of the status column next to
 the repository name; when it finishes the row is refreshed with the new status.
+The background commands of all repositories are driven by one event loop (a
+CommandLoop), at most as many at a time as the engine has workers.
 
 The key bindings are configurable: the 'keys' section of the config maps a key
 to an action string. The available actions are the names registered in
@@ -11,26 +20,46 @@ run as an argument (e.g. 'run-bg git fetch').
 
 The colors are configurable too: the 'colors' section of the config maps a UI
 element (the status color names returned by status_summary, plus the
-header/selected/running/failed/detected entries) to a color/attribute spec
+header/selected/running/failed/detected/stale entries) to a color/attribute spec
 parsed by _ColorScheme.
 """
+import io
 import os
+import sys
+import select
+import signal
 import threading
+import contextlib
+import collections
 
 from .utils import UserMessage, repo_status_cells, tilde_encode
-from .Repository import locate_git_repositories, update_locate_database
+from .Repository import RepoStatus
+from .discovery import by_last_use, discover_repositories
+from .engine import CommandLoop, StatusEngine
 
 
 # frames of the rotating bar shown while a background command runs
 _SPINNER = "|/—\\"
+# the status shown for a repository with neither a snapshot nor a fresh status
+_PENDING = "…"
 
 
 def run_ui(repos, keys, colors=None, run_fg_prompt_threshold=5,
-           documentation=None):
+           documentation=None, engine=None, watch=True, discover=None,
+           statuses=None):
     """interactive ncurses UI showing the repository status
 
 Navigate the scrollable table and act on the selected repository with the
-configured key bindings (see the 'keys' section of the config).
+configured key bindings (see the 'keys' section of the config). The status of
+the repositories is evaluated by `engine` (a StatusEngine, by default one with
+the default number of workers). The UI opens with the statuses recorded in the
+engine's status cache (if any), marked as stale until the background
+evaluation replaced them. With watch=True (and inotify available), rows are
+re-evaluated whenever the git metadata of their repository changes.
+The 'detect' action lists the repositories yielded by discover() (by default
+Metagit.discovery.discover_repositories()). `statuses` maps the paths of
+`repos` to a RepoStatus known to be current (e.g. from the daemon); those
+rows are not evaluated again on start.
 """
     import locale
     locale.setlocale(locale.LC_ALL, '')
@@ -38,11 +67,69 @@ configured key bindings (see the 'keys' section of the config).
         import curses
     except ImportError:
         raise UserMessage("curses is not available on this platform")
-    rows = []
-    for p, r in repos.items():
-        rows.append({'repo': r, 'cells': repo_status_cells(r, ', '), 'bg': None})
-    curses.wrapper(_ui_main, rows, keys, colors or {},
-                   run_fg_prompt_threshold, documentation)
+    if engine is None:
+        engine = StatusEngine()
+    statuses = statuses or {}
+    rows = [_snapshot_row(r, engine.cache, statuses.get(p))
+            for p, r in repos.items()]
+    # the statuses are evaluated while the screen is up: hold back the
+    # warnings the background work prints meanwhile, they would scribble over
+    # the display
+    warnings = _BackgroundStderr(sys.stderr)
+    try:
+        with contextlib.redirect_stderr(warnings):
+            curses.wrapper(_ui_main, rows, keys, colors or {},
+                           run_fg_prompt_threshold, documentation, engine,
+                           watch, discover)
+    finally:
+        sys.stderr.write(warnings.held.getvalue())
+
+
+class _BackgroundStderr(io.TextIOBase):
+    """the sys.stderr of the curses session.
+
+    What the worker threads write (the background status evaluations,
+    detection, the watcher) is kept in `held`; the main thread's output, e.g.
+    of a run-fg command or the help screen, which run outside curses mode,
+    goes to `stream` right away.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.held = io.StringIO()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        if threading.current_thread() is threading.main_thread():
+            return self.stream.write(text)
+        with self._lock:
+            return self.held.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _snapshot_row(repo, cache, current=None):
+    """the initial display row of a repository, before its status is known.
+
+    Shows the status the cache recorded last time (or a placeholder) and
+    marks the row 'stale' until _start_revalidation() replaced it. A missing
+    repository is cheap to tell, so it is shown as such right away, and so
+    is a `current` RepoStatus.
+    """
+    if current is not None:
+        return {'repo': repo, 'bg': None, 'stale': False,
+                'cells': repo_status_cells(repo, ', ', current)}
+    if not repo.exists():
+        return {'repo': repo, 'bg': None, 'stale': False,
+                'cells': repo_status_cells(repo, ', ',
+                                           RepoStatus.nonExistent())}
+    rs = cache.snapshot(repo) if cache is not None else None
+    if rs is None:
+        cells = [(repo.name, None), (_PENDING, None)]
+    else:
+        cells = repo_status_cells(repo, ', ', rs)
+    return {'repo': repo, 'cells': cells, 'bg': None, 'stale': True}
 
 
 class _ColorScheme:
@@ -124,13 +211,15 @@ class _ColorScheme:
 
 # --- background command handling ------------------------------------------
 
-def _start_background(row, command, func):
-    """run func() in a background thread, tracking its state on the row.
+def _start_background(row, command, start, loop, wake=None):
+    """run the coroutine start() returns on the CommandLoop `loop`, tracking
+    its state on the row.
 
     `command` is the literal command line shown while it runs (with a spinner)
     and, on failure, followed by 'failed'. Only one background command runs per
     repository at a time; a second request is ignored while one is still in
-    flight.
+    flight. wake() (if given) is called from the loop when the coroutine
+    finished.
     """
     bg = row['bg']
     if bg is not None and not bg['finished']:
@@ -142,61 +231,176 @@ def _start_background(row, command, func):
         'handled': False,
     }
 
-    def worker():
+    async def run():
         try:
-            func()
+            await start()
         except Exception as e:
             bg['error'] = str(e)
         finally:
             bg['finished'] = True
+            if wake is not None:
+                wake()
 
-    bg['thread'] = threading.Thread(target=worker, daemon=True)
     row['bg'] = bg
-    bg['thread'].start()
+    bg['future'] = loop.submit(run())
 
 
-def _reap_background(rows):
+def _run_background(state, row, command):
+    """start the user command `command` in the background for `row`"""
+    if row.get('detected'):
+        return
+    _start_background(row, command,
+                      lambda repo=row['repo']: _arun_repo_command(repo,
+                                                                  command),
+                      state.commands, state.wake)
+    state.background[id(row)] = row
+    _mark_dirty(state, row)
+
+
+def _reap_background(state):
     """fold successfully finished background commands back into the status.
 
-    A command that failed is left in place so its failure stays visible until
+    The status of the repository is then re-evaluated in the background. A
+    command that failed is left in place so its failure stays visible until
     the row is refreshed.
     """
-    for row in rows:
+    for key, row in list(state.background.items()):
         bg = row['bg']
-        if bg is None or not bg['finished'] or bg['handled']:
+        if bg is not None and not bg['finished']:
+            continue
+        del state.background[key]
+        if bg is None or bg['handled']:
             continue
         bg['handled'] = True
-        bg['thread'].join()
+        _mark_dirty(state, row)
         if bg['error'] is None:
-            row['cells'] = repo_status_cells(row['repo'], ', ')
             row['bg'] = None
+            _queue_revalidation(state, [row])
 
 
-# --- repository detection --------------------------------------------------
+# --- background status evaluation -----------------------------------------
 
-def _detect_rows():
-    """locate git repositories in the filesystem, most recently used first.
+def _queue_revalidation(state, rows, stale=True):
+    """queue `rows` for a status evaluation in the background.
 
-    Rebuilds metagit's locate database (like 'detect --update') and returns
-    display rows (marked 'detected') for every repository found by
-    Repository.locate_git_repositories(), sorted by the mtime of their
-    .git/index so the repositories touched most recently come first. These are
-    only shown, not added to the configuration.
+    The evaluations are handed to the engine by _pump_revalidation() a few at
+    a time, so rows scrolled into view jump the queue. With stale=True the
+    rows are shown as stale until their new status arrived. A row whose
+    evaluation is already in flight is evaluated once more afterwards, as the
+    running one may have missed the change.
     """
-    update_locate_database()
-    found = []
-    for path in locate_git_repositories():
+    for row in rows:
+        # detected rows are not managed repositories and have no status
+        if row.get('detected'):
+            continue
+        if stale and not row.get('stale'):
+            row['stale'] = True
+            _mark_dirty(state, row)
+        if id(row) in state.evaluating:
+            row['again'] = True
+        elif not row.get('pending'):
+            row['pending'] = True
+            state.revalidate.append(row)
+
+
+def _pump_revalidation(state, visible):
+    """hand queued rows to the engine, the ones in `visible` first.
+
+    At most as many evaluations as the engine has workers are in flight, so
+    the queue order can still change with what is on screen.
+    """
+    while state.revalidate and len(state.evaluating) < state.engine.jobs:
+        row = next((r for r in visible if r.get('pending')), None)
+        if row is None:
+            row = state.revalidate.popleft()
+            if not row.get('pending'):
+                continue
+        row['pending'] = False
+
+        def done(repo, future, row=row):
+            # runs in the worker thread; the result is applied by
+            # _reap_revalidation() in the main loop
+            row['result'] = future
+            state.results.append(row)
+            state.wake()
+
+        state.evaluating.add(id(row))
+        state.engine.submit(row['repo'], done)
+
+
+def _reap_revalidation(state):
+    """show the statuses evaluated in the background"""
+    while state.results:
+        row = state.results.popleft()
+        future = row.pop('result')
+        state.evaluating.discard(id(row))
+        _mark_dirty(state, row)
         try:
-            mtime = os.path.getmtime(os.path.join(path, '.git', 'index'))
-        except OSError:
-            # no (readable) index, e.g. a fresh repository: sort it last
-            mtime = 0
-        found.append((mtime, path))
-    found.sort(key=lambda t: t[0], reverse=True)
+            row['cells'] = repo_status_cells(row['repo'], ', ',
+                                             future.result())
+            row['stale'] = False
+        except Exception:
+            # e.g. 'git status' failing: keep the old status
+            pass
+        if row.pop('again', False):
+            _queue_revalidation(state, [row], stale=False)
+
+
+# --- watching for changes --------------------------------------------------
+
+def _start_watching(state):
+    """watch the git metadata of every managed repository.
+
+    The watcher thread reports changed rows (by id) in state.changed, where
+    _reap_changes() picks them up. Without inotify the UI only updates on
+    the 'refresh' action.
+    """
+    from .watch import RepoWatcher
+
+    def on_change(keys):
+        state.changed.extend(keys)
+        state.wake()
+
+    try:
+        state.watcher = RepoWatcher(on_change)
+    except OSError:
+        return
+    watcher = state.watcher
+    rows = [row for row in state.rows if not row.get('detected')]
+
+    def register():
+        # walking the refs of many repositories takes a moment: don't hold
+        # up the first screen for it
+        for row in rows:
+            watcher.watch(id(row), row['repo'].path)
+
+    threading.Thread(target=register, daemon=True).start()
+
+
+def _reap_changes(state):
+    """re-evaluate the rows of the repositories the watcher saw change"""
+    changed = set()
+    while state.changed:
+        changed.add(state.changed.popleft())
+    if changed:
+        _queue_revalidation(state, [row for row in state.rows
+                                    if id(row) in changed], stale=False)
+
+
+# --- repository detection --------------------------------------------------
+
+def _detect_rows(discover):
+    """find git repositories in the filesystem, most recently used first.
+
+    Returns display rows (marked 'detected') for every repository yielded by
+    discover() (like 'detect --update'), sorted by the mtime of their index so
+    the repositories touched most recently come first. These are only shown,
+    not added to the configuration.
+    """
     return [{'repo': None,
              'cells': [(tilde_encode(path), None), ('', None)],
              'bg': None, 'detected': True}
-            for _mtime, path in found]
+            for path in by_last_use(discover())]
 
 
 def _start_detection(state):
@@ -212,13 +416,14 @@ def _start_detection(state):
 
     def worker():
         try:
-            detect['rows'] = _detect_rows()
+            detect['rows'] = _detect_rows(state.discover)
         except Exception as e:
             # e.g. updatedb/locate missing or failing: keep the UI alive and
             # simply show no detected repositories
             detect['error'] = str(e)
         finally:
             detect['finished'] = True
+            state.wake()
 
     detect['thread'] = threading.Thread(target=worker, daemon=True)
     state.detect = detect
@@ -241,6 +446,7 @@ def _reap_detection(state):
         state.rows.extend(detect['rows'])
     # keep the selection within the (possibly shortened) row list
     state.sel = min(state.sel, max(0, len(state.rows) - 1))
+    _reset_display(state)
 
 
 def _display_cells(row, tick):
@@ -253,6 +459,9 @@ def _display_cells(row, tick):
     cells = list(row['cells'])
     while len(cells) < 2:
         cells.append(('', None))
+    if row.get('stale'):
+        # a status from the previous run, still being re-evaluated
+        cells[1] = (cells[1][0], 'stale')
     bg = row['bg']
     if bg is not None:
         if not bg['finished']:
@@ -278,6 +487,14 @@ def _run_repo_command(repo, command, live=False):
         repo.call(command, shell=True, quiet=True)
 
 
+async def _arun_repo_command(repo, command):
+    """the asyncio counterpart of _run_repo_command() for background
+    commands"""
+    if not repo.exists():
+        return
+    await repo.acall(command, shell=True, quiet=True)
+
+
 def page_text(text):
     """pipe `text` through the user's $PAGER, falling back to stdout.
 
@@ -309,9 +526,13 @@ def page_text(text):
 
 class _UIState:
     def __init__(self, stdscr, rows, run_fg_prompt_threshold=5,
-                 documentation=None):
+                 documentation=None, engine=None):
         self.stdscr = stdscr
         self.rows = rows
+        # the StatusEngine evaluating the repository status
+        self.engine = engine or StatusEngine()
+        # the event loop running the background commands
+        self.commands = CommandLoop(self.engine.jobs)
         self.sel = 0
         self.top = 0
         self.tick = 0
@@ -323,6 +544,51 @@ class _UIState:
         # callable returning the documentation string shown by the 'help'
         # action (None disables it)
         self.documentation = documentation
+        # rows waiting for a background status evaluation, the ids of the
+        # rows being evaluated and the rows whose evaluation finished (see
+        # _queue_revalidation)
+        self.revalidate = collections.deque()
+        self.evaluating = set()
+        self.results = collections.deque()
+        # the RepoWatcher (see _start_watching), if any, and the ids of the
+        # rows it reported as changed
+        self.watcher = None
+        self.changed = collections.deque()
+        # id -> row of the rows with a background command to reap
+        self.background = {}
+        # the rows whose displayed cells must be recomputed, the number of
+        # display cells of each length per column (for the column widths),
+        # and the signature of what is drawn on each screen line (see
+        # _draw_screen)
+        self.dirty = []
+        self.width_counts = []
+        self.widths = []
+        self.lines = {}
+        self.size = None
+        self.redraw = True
+        # the worker threads wake the main loop up through this pipe
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        _reset_display(self)
+
+    def wake(self):
+        """wake the main loop up (from any thread), e.g. to show a result"""
+        wake_w = self.wake_w
+        if wake_w is None:
+            return
+        try:
+            os.write(wake_w, b'.')
+        except OSError:
+            # the pipe is full (so the loop wakes up anyway) or closed
+            pass
+
+    def close(self):
+        self.commands.shutdown()
+        wake_r, wake_w = self.wake_r, self.wake_w
+        self.wake_w = None
+        os.close(wake_r)
+        os.close(wake_w)
 
 
 def _action_down(state, arg):
@@ -340,16 +606,17 @@ def _action_quit(state, arg):
 
 
 def _action_refresh(state, arg):
-    # recompute the status of every repository, dropping any finished
-    # background command
+    # re-evaluate the status of every repository in the background, dropping
+    # any finished background command
+    todo = []
     for row in state.rows:
-        # detected rows are not managed repositories and have no status
-        if row.get('detected'):
-            continue
-        if row['bg'] is not None and not row['bg']['finished']:
-            continue
-        row['bg'] = None
-        row['cells'] = repo_status_cells(row['repo'], ', ')
+        if row['bg'] is not None:
+            if not row['bg']['finished']:
+                continue
+            row['bg'] = None
+            _mark_dirty(state, row)
+        todo.append(row)
+    _queue_revalidation(state, todo)
 
 
 def _action_detect(state, arg):
@@ -359,21 +626,14 @@ def _action_detect(state, arg):
 def _action_run_bg(state, arg):
     if not state.rows:
         return
-    row = state.rows[state.sel]
-    if row.get('detected'):
-        return
-    _start_background(row, arg,
-                      lambda repo=row['repo']: _run_repo_command(repo, arg))
+    _run_background(state, state.rows[state.sel], arg)
 
 
 def _action_run_all_bg(state, arg):
     # start the command in the background for every managed repository;
     # _start_background skips any repository already running a command
     for row in state.rows:
-        if row.get('detected'):
-            continue
-        _start_background(row, arg,
-                          lambda repo=row['repo']: _run_repo_command(repo, arg))
+        _run_background(state, row, arg)
 
 
 def _action_run_fg(state, arg):
@@ -401,9 +661,8 @@ def _action_run_fg(state, arg):
         except (EOFError, KeyboardInterrupt):
             pass
     # refresh the status of the affected repository
-    row['cells'] = repo_status_cells(repo, ', ')
-    state.stdscr.clear()
-    state.stdscr.refresh()
+    _queue_revalidation(state, [row])
+    state.redraw = True
 
 
 def _action_help(state, arg):
@@ -413,8 +672,7 @@ def _action_help(state, arg):
     # leave curses mode so the pager gets the normal terminal
     curses.endwin()
     page_text(state.documentation())
-    state.stdscr.clear()
-    state.stdscr.refresh()
+    state.redraw = True
 
 
 _ACTIONS = {
@@ -443,7 +701,7 @@ _ACTION_DOCS = {
                   'repository (e.g. "run-all-bg git fetch")',
     'run-fg': 'run the given command in the foreground for the selected '
               'repository, leaving the UI while it runs (e.g. "run-fg $SHELL")',
-    'detect': 'locate git repositories in the filesystem and list them (most '
+    'detect': 'find git repositories in the filesystem and list them (most '
               'recently used first) below the managed ones, without adding '
               'them to the configuration',
     'help': 'show this documentation, paged through $PAGER',
@@ -501,6 +759,153 @@ def _build_keymap(keys, curses):
 
 
 # --- main loop -------------------------------------------------------------
+#
+# The loop only does work proportional to what changed: rows are marked dirty
+# (_mark_dirty) when their displayed cells change, the column widths are kept
+# up to date from per-length counters, and only the screen lines whose content
+# differs from what is drawn are redrawn. Between events it sleeps in select(),
+# woken by a key press or, through the state's self-pipe, by a worker thread.
+
+_HEADER = ["repository", "status"]
+
+
+def _mark_dirty(state, row):
+    """note that the displayed cells of `row` have to be recomputed"""
+    if not row.get('dirty'):
+        row['dirty'] = True
+        state.dirty.append(row)
+
+
+def _reset_display(state):
+    """recompute the displayed cells of every row and redraw the screen"""
+    state.width_counts = [collections.Counter({len(h): 1}) for h in _HEADER]
+    state.widths = [len(h) for h in _HEADER]
+    state.dirty = []
+    for row in state.rows:
+        row.pop('display', None)
+        row['dirty'] = False
+        _mark_dirty(state, row)
+    state.redraw = True
+
+
+def _update_display(state):
+    """recompute the displayed cells of the dirty rows and the column widths"""
+    if not state.dirty:
+        return
+    counts = state.width_counts
+    for row in state.dirty:
+        row['dirty'] = False
+        old = row.get('display', ())
+        new = _display_cells(row, state.tick)
+        for i, (text, _name) in enumerate(old[:len(counts)]):
+            counts[i][len(text)] -= 1
+        for i, (text, _name) in enumerate(new[:len(counts)]):
+            counts[i][len(text)] += 1
+        row['display'] = new
+    state.dirty = []
+    state.widths = [max(length for length, n in count.items() if n > 0)
+                    for count in counts]
+
+
+def _draw_screen(state, color, curses):
+    """bring the screen up to date, redrawing only the lines that changed"""
+    stdscr = state.stdscr
+    rows = state.rows
+    h, w = stdscr.getmaxyx()
+    if (h, w) != state.size:
+        state.size = (h, w)
+        state.redraw = True
+    if state.redraw:
+        state.redraw = False
+        stdscr.clear()
+        state.lines = {}
+    width = max(1, w - 1)
+    body_top = 2
+    body_height = max(1, h - body_top)
+    # keep the selected row within the visible window
+    if state.sel < state.top:
+        state.top = state.sel
+    elif state.sel >= state.top + body_height:
+        state.top = state.sel - body_height + 1
+    visible = rows[state.top:state.top + body_height]
+    _pump_revalidation(state, visible)
+    for row in visible:
+        if row['bg'] is not None and not row['bg']['finished']:
+            # the spinner turns
+            _mark_dirty(state, row)
+    _update_display(state)
+    widths = tuple(state.widths)
+    lines = []
+    # fixed table head (no per-column colors, so a plain (text, None) row)
+    lines.append((tuple((h, None) for h in _HEADER),
+                  color.get('header', curses.A_BOLD)))
+    lines.append(None)
+    for ri, row in enumerate(visible, state.top):
+        if ri == state.sel:
+            base = color.get('selected', curses.A_REVERSE)
+        elif row.get('detected'):
+            # detected (not yet managed) repositories are shown shaded
+            base = color.get('detected', curses.A_DIM)
+        else:
+            base = curses.A_NORMAL
+        lines.append((tuple(row['display']), base))
+    drawn = False
+    for y in range(min(h, body_top + body_height)):
+        line = lines[y] if y < len(lines) else None
+        if y == 1:
+            signature = ('rule', width)
+        elif line is None:
+            # below the last row
+            signature = None
+        else:
+            signature = (line, widths, width)
+        if state.lines.get(y) == signature:
+            continue
+        state.lines[y] = signature
+        drawn = True
+        if y == 1:
+            stdscr.addnstr(1, 0, '─' * width, width)
+        elif line is None:
+            stdscr.move(y, 0)
+            stdscr.clrtoeol()
+        else:
+            _draw_row(stdscr, y, line[0], widths, line[1], color, width)
+    if drawn:
+        stdscr.refresh()
+
+
+def _wait_for_key(state, timeout):
+    """the next key press, or -1 when woken up otherwise or after `timeout`
+    seconds (None: no timeout)"""
+    stdscr = state.stdscr
+    stdscr.timeout(0)
+    # curses may have read ahead more than one key
+    ch = stdscr.getch()
+    if ch != -1:
+        return ch
+    readable, _, _ = select.select([sys.stdin.fileno(), state.wake_r], [], [],
+                                   timeout)
+    if state.wake_r in readable:
+        try:
+            while os.read(state.wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+    return stdscr.getch()
+
+
+def _check_resize(state, curses):
+    """let curses pick up a new terminal size after a SIGWINCH"""
+    if not state.resized:
+        return
+    state.resized = False
+    try:
+        cols, lines = os.get_terminal_size(sys.__stdout__.fileno())
+    except OSError:
+        return
+    curses.resizeterm(lines, cols)
+    state.redraw = True
+
 
 def _draw_row(stdscr, y, cells, widths, base_attr, color, width):
     """draw one table row of (text, color-name) cells at line `y`.
@@ -530,7 +935,7 @@ def _draw_row(stdscr, y, cells, widths, base_attr, color, width):
 
 
 def _ui_main(stdscr, rows, keys, colors=None, run_fg_prompt_threshold=5,
-             documentation=None):
+             documentation=None, engine=None, watch=True, discover=None):
     import curses
     curses.curs_set(0)
     # use the terminal's default background (transparent) instead of black
@@ -543,57 +948,48 @@ def _ui_main(stdscr, rows, keys, colors=None, run_fg_prompt_threshold=5,
         pass
     color = _ColorScheme(colors or {}, curses)
     keymap = _build_keymap(keys, curses)
-    header = ["repository", "status"]
-    state = _UIState(stdscr, rows, run_fg_prompt_threshold, documentation)
+    state = _UIState(stdscr, rows, run_fg_prompt_threshold, documentation,
+                     engine)
+    state.discover = discover or (lambda: discover_repositories(update=True))
+    # curses only notices a resize while waiting in getch(), but the loop
+    # waits in select(): take SIGWINCH over to wake it up
+    state.resized = False
+
+    def on_resize(signum, frame):
+        state.resized = True
+        state.wake()
+
+    previous = signal.signal(signal.SIGWINCH, on_resize)
+    _queue_revalidation(state, [row for row in rows if row.get('stale')])
+    if watch:
+        _start_watching(state)
+    try:
+        _main_loop(state, keymap, color, curses)
+    finally:
+        signal.signal(signal.SIGWINCH,
+                      signal.SIG_DFL if previous is None else previous)
+        if state.watcher is not None:
+            state.watcher.close()
+        state.close()
+
+
+def _main_loop(state, keymap, color, curses):
     while state.running:
-        _reap_background(rows)
+        _reap_background(state)
         _reap_detection(state)
-        h, w = stdscr.getmaxyx()
-        width = max(1, w - 1)
-        display = [_display_cells(row, state.tick) for row in rows]
-        # determine the column widths from the header and every cell text
-        widths = [len(c) for c in header]
-        for cells in display:
-            for i, (text, _name) in enumerate(cells):
-                if i < len(widths):
-                    widths[i] = max(widths[i], len(text))
-        body_top = 2
-        body_height = max(1, h - body_top)
-        # keep the selected row within the visible window
-        if state.sel < state.top:
-            state.top = state.sel
-        elif state.sel >= state.top + body_height:
-            state.top = state.sel - body_height + 1
-        stdscr.erase()
-        # fixed table head (no per-column colors, so a plain (text, None) row)
-        header_cells = [(h, None) for h in header]
-        _draw_row(stdscr, 0, header_cells, widths,
-                  color.get('header', curses.A_BOLD), color, width)
-        stdscr.addnstr(1, 0, '─' * width, width)
-        # scrollable body
-        for idx in range(body_height):
-            ri = state.top + idx
-            if ri >= len(rows):
-                break
-            if ri == state.sel:
-                base = color.get('selected', curses.A_REVERSE)
-            elif rows[ri].get('detected'):
-                # detected (not yet managed) repositories are shown shaded
-                base = color.get('detected', curses.A_DIM)
-            else:
-                base = curses.A_NORMAL
-            _draw_row(stdscr, body_top + idx, display[ri], widths,
-                      base, color, width)
-        stdscr.refresh()
-        # while background commands run, poll so the display keeps updating;
-        # otherwise block until the next key press
-        busy = any(row['bg'] is not None and not row['bg']['finished']
-                   for row in rows) \
-            or (state.detect is not None and not state.detect['finished'])
-        stdscr.timeout(200 if busy else -1)
-        ch = stdscr.getch()
+        _reap_changes(state)
+        _reap_revalidation(state)
+        _check_resize(state, curses)
+        _draw_screen(state, color, curses)
+        # while background commands run, wake up now and then to turn their
+        # spinners; otherwise sleep until a key press or a worker's wake-up
+        spinning = any(not row['bg']['finished']
+                       for row in state.background.values()
+                       if row['bg'] is not None)
+        ch = _wait_for_key(state, 0.2 if spinning else None)
         if ch == -1:
-            state.tick += 1
+            if spinning:
+                state.tick += 1
             continue
         binding = keymap.get(ch)
         if binding is None:
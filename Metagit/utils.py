@@ -4,7 +4,6 @@ table/status formatting used by both the CLI and the ncurses UI.
 import os
 import re
 import sys
-import subprocess
 
 
 class UserMessage(Exception):
@@ -29,6 +28,13 @@ def warning(*args):
     print(' '.join(list(args)), file=sys.stderr)
 
 
+def cache_dir():
+    """the directory metagit keeps its caches in"""
+    home = os.environ['HOME']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(home, '.cache'))
+    return os.path.join(cache_home, 'metagit')
+
+
 def ask(question, default = None):
     prompt = ' [{}/{}]'.format(
         ('Y' if default == True else 'y'),
@@ -41,7 +47,7 @@ def ask(question, default = None):
 
 
 def countshow(cnt, suffix = None, suffix1 = None):
-    if cnt == 0:
+    if cnt is None or cnt == 0:
         return ""
     elif cnt == 1:
         return str(cnt) + ('' if suffix1 is None else ' ' + suffix1)
@@ -49,64 +55,125 @@ def countshow(cnt, suffix = None, suffix1 = None):
         return str(cnt) + ('' if suffix is None else ' ' + suffix)
 
 
+def _table_rules(widths):
+    """the (top, middle) rules of a table with the column `widths`"""
+    width = sum(widths) + len(widths) - 1
+    return "━" * width, "─" * width
+
+
+def _table_row_lines(row, widths):
+    """the lines of the table row `row` (a list of cells, a cell being a text
+    of one or more lines) with the column `widths`; lines longer than their
+    column are cut"""
+    cells = []
+    for c, w in zip(row, widths):
+        lines = []
+        for line in str(c).split('\n'):
+            if len(line) > w:
+                line = line[:max(w - 1, 0)] + '…'
+            lines.append(line)
+        cells.append(lines)
+    height = max([len(lines) for lines in cells] + [1])
+    out = []
+    for cell_line in range(height):
+        parts = []
+        for lines, w in zip(cells, widths):
+            if w <= 0:
+                continue
+            cur_line = lines[cell_line] if cell_line < len(lines) else ""
+            parts.append(cur_line.ljust(w))
+        out.append(' '.join(parts))
+    return out
+
+
 def pretty_print_table(rows):
     """pretty print a table, given as a list of lists
     The first row is interpreted as the header
     """
-    # determine column widths and row heights
+    # determine column widths
     widths = []
-    heights = []
     for r in rows:
-        row_height = 1
         for idx,c in enumerate(r):
             while len(widths) <= idx:
                 widths += [ 0 ]
             cell_lines = str(c).split('\n')
             widths[idx] = max(widths[idx], max([ len(l) for l in cell_lines]) )
-            row_height = max(row_height, len(cell_lines))
-        heights += [ row_height ]
-    outbuf = ""
-    toprule = "━" * widths[0]
-    midrule = "─" * widths[0]
-    for w in widths[1:]:
-        toprule += "━"
-        toprule += "━" * w
-        midrule += "─"
-        midrule += "─" * w
-    outbuf += toprule + "\n"
+    toprule, midrule = _table_rules(widths)
+    lines = [toprule]
     for r_idx,r in enumerate(rows):
-        for cell_line in range(heights[r_idx]):
-            is_first_column = True
-            for idx,c in enumerate(r):
-                if widths[idx] <= 0:
-                    continue
-                if is_first_column:
-                    is_first_column = False
-                else:
-                    outbuf += ' '
-                formatstring = '{:' + str(widths[idx]) + 's}'
-                cell_content = str(c).split('\n')
-                cur_line = ""
-                if cell_line < len(cell_content):
-                    cur_line = cell_content[cell_line]
-                outbuf += formatstring.format(cur_line)
-            outbuf += '\n'
+        lines += _table_row_lines(r, widths)
         if r_idx == 0:
-            outbuf += midrule + "\n"
-    outbuf += toprule + "\n"
-    print(outbuf)
+            lines.append(midrule)
+    lines.append(toprule)
+    print('\n'.join(lines) + '\n')
+
+
+class StreamingTable:
+    """a table like pretty_print_table()'s, printed row by row.
+
+    The column `widths` are fixed up front (longer cell lines are cut), so
+    every row can be written as soon as it is known: begin() prints the
+    `header` row, add() a row and end() the closing rule. On a terminal a
+    footer line below the rows shows the progress() (e.g. '12/5000
+    repositories'); it is redrawn after every row and removed by end().
+    """
+
+    def __init__(self, header, widths, file=None):
+        self.header = header
+        self.widths = widths
+        self.file = sys.stdout if file is None else file
+        self.footer = ''
+        try:
+            self.live = self.file.isatty()
+        except (AttributeError, ValueError):
+            self.live = False
+
+    def _write(self, text):
+        if self.live and self.footer:
+            # overwrite the footer, it is redrawn below the new text
+            text = '\r\033[K' + text + self.footer
+        self.file.write(text)
+        self.file.flush()
+
+    def begin(self):
+        toprule, midrule = _table_rules(self.widths)
+        lines = [toprule] + _table_row_lines(self.header, self.widths) \
+            + [midrule]
+        self._write('\n'.join(lines) + '\n')
+
+    def add(self, row):
+        self._write('\n'.join(_table_row_lines(row, self.widths)) + '\n')
+
+    def progress(self, text):
+        """show `text` in the footer (on a terminal only)"""
+        if not self.live or text == self.footer:
+            return
+        self.file.write('\r\033[K' + text)
+        self.file.flush()
+        self.footer = text
+
+    def end(self):
+        if self.live and self.footer:
+            self.file.write('\r\033[K')
+            self.footer = ''
+        self._write(_table_rules(self.widths)[0] + '\n\n')
 
 
 # return the absolute path of the git root for the current working directory
 # without trailing slashes, or None, if cwd does not live in a git repository
 def detect_git(cwd='.'):
+    import subprocess
+    from . import trace
     cmd = ['git', 'rev-parse', '--show-toplevel']
+    started = trace.clock()
     proc = subprocess.Popen(cmd,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
                             cwd=cwd)
     stdout, stderr = proc.communicate()
     status = proc.wait()
+    trace.record(' '.join(cmd), started, status, stdout, stderr,
+                 os.path.abspath(cwd))
     if status == 0 and stderr.decode() == '':
         return re.sub('[/\r\n]*$', '', stdout.decode())
     else:
@@ -124,6 +191,17 @@ def tilde_encode(cwd = '.'):
         return abspath
 
 
+# how deep a status is evaluated (see GitRepository.status_at), from the
+# cheapest to the complete one; here rather than in Repository.py, so the
+# command line parser gets them without importing the repository classes
+STATUS_LEVELS = ('exists', 'dirty', 'ahead-behind', 'full')
+
+# the width of the status column of 'st --stream', fixed before any status is
+# known; the lines of status_summary() are shorter unless a count has more
+# than five digits
+STATUS_WIDTH = 30
+
+
 def status_summary(rs, separator='\n'):
     """summarize a RepoStatus as a single (text, color-name) status.
 
@@ -132,34 +210,67 @@ Every kind of pending work is folded into one human readable phrase (e.g.
 its parts joined by `separator`. The color name is that of the most
 significant pending state (a missing checkout first, then local changes, then
 commits to push, then commits to merge), or None when the repository is clean.
+A status evaluated below the 'full' level (see GitRepository.status_at) only
+knows whether there are uncommitted changes, which is shown without a count;
+what it did not look at is listed as unchecked, with the color 'unchecked'
+when nothing else is pending, so a partial status never passes for a clean
+one.
 """
     if not rs.exists:
         return "not present", 'not-present'
-    parts = filter(lambda x: x != '', [
+    unknown = []
+    if rs.uncommited_changes is None and rs.dirty is None:
+        unknown.append("changes")
+    elif rs.untracked_files is None:
+        unknown.append("untracked")
+    if rs.unpushed_commits is None:
+        unknown.append("commits")
+    parts = list(filter(lambda x: x != '', [
         countshow(rs.untracked_files, "new files", "new file"),
         countshow(rs.uncommited_changes, "uncommitted changes",
                   "uncommitted change"),
+        "uncommitted changes" if rs.dirty else "",
         countshow(rs.unpushed_commits, "commits need push", "commit needs push"),
         countshow(rs.unmerged_commits, "commits behind upstream",
                   "commit behind upstream"),
-    ])
-    if rs.untracked_files or rs.uncommited_changes:
+    ]))
+    if unknown:
+        parts.append("unchecked: " + ", ".join(unknown))
+    if rs.untracked_files or rs.uncommited_changes or rs.dirty:
         color = 'uncommited'
     elif rs.unpushed_commits:
         color = 'push-needed'
     elif rs.unmerged_commits:
         color = 'merge-needed'
+    elif unknown:
+        color = 'unchecked'
     else:
         color = None
     return separator.join(parts), color
 
 
-def repo_status_cells(r, separator='\n'):
+def repo_status_record(r, rs, seconds=None):
+    """the JSON serializable record of the RepoStatus `rs` of the repository
+    `r`, as printed by 'st --format=jsonl': the RepoStatus fields, the main
+    branch and its upstream, and the `seconds` the evaluation took (None when
+    not evaluated here)"""
+    record = {'path': r.tilde_path, 'name': r.name}
+    record.update(rs.to_dict())
+    record['main_branch'] = r.main_branch()
+    record['upstream_branch'] = r.upstream_name() if rs.exists else None
+    record['seconds'] = None if seconds is None else round(seconds, 6)
+    return record
+
+
+def repo_status_cells(r, separator='\n', rs=None):
     """compute the (text, color-name) status cells for a single repository.
 
 The columns match the header used by the 'st' command: the repository name and
 a single combined status column (see status_summary). The name cell has no
 color (None); pass separator='\\n' for a stacked multi-line status cell or e.g.
-', ' for a one-line one.
+', ' for a one-line one. Pass an already computed RepoStatus as `rs` (e.g. one
+evaluated by the StatusEngine) to skip calling r.status().
 """
-    return [(r.name, None), status_summary(r.status(), separator)]
+    if rs is None:
+        rs = r.status()
+    return [(r.name, None), status_summary(rs, separator)]
@@ -0,0 +1,237 @@
+"""Watching the git metadata of repositories for changes (Linux inotify).
+
+A RepoWatcher notices when HEAD, the index, the config or any branch or
+remote-tracking ref of a watched repository changes, i.e. when its status may
+have changed because of a commit, checkout, 'git add', fetch and so on. The
+events are collected in a background thread and reported in batches, once
+they stopped coming for a moment (or, during a steady stream of them such as a
+long rebase, now and then), so a git command touching many files leads to a
+single notification.
+
+inotify is called through ctypes. Where it is not available (other platforms,
+or a libc without it) creating a RepoWatcher raises OSError and the caller
+goes without watching.
+"""
+import os
+import errno
+import select
+import struct
+import threading
+import time
+
+from .gitdir import find_git_dir, common_dir
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# git replaces files by renaming a '<name>.lock' over them, so moves and
+# creations catch almost everything; the rest is for tools writing in place
+_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE \
+    | IN_DELETE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+
+def _libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+        if not hasattr(libc, name):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+class Inotify:
+    """a thin wrapper of an inotify file descriptor"""
+
+    def __init__(self):
+        self._libc = _libc()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        import ctypes
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def fileno(self):
+        return self.fd
+
+    def add(self, path, mask=_MASK):
+        """watch the directory `path`; returns the watch descriptor"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def read(self):
+        """the pending events as (wd, mask, name) triples (name as str)"""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class RepoWatcher:
+    """report which of the watched repositories changed.
+
+    watch() registers a repository under a key; on_change(keys) is called
+    from the watcher's thread with the set of keys whose git metadata
+    changed, `debounce` seconds after the last event of a burst, but at most
+    `max_delay` seconds after its first event. Call close() to stop watching.
+    """
+
+    # the files in the git directory (and the common one, for worktrees)
+    # the status depends on; anything below refs/heads and refs/remotes counts
+    _GIT_DIR_FILES = frozenset(('HEAD', 'index', 'config', 'packed-refs'))
+    # the directories in refs/ watched as a whole, once they exist
+    _REF_TREES = frozenset(('heads', 'remotes'))
+
+    def __init__(self, on_change, debounce=0.25, max_delay=1.0):
+        self.on_change = on_change
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._inotify = Inotify()
+        # watch descriptor -> [(key, path, names)], names being the file
+        # names of interest in the directory or None for any
+        self._watches = {}
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='metagit-watch')
+        self._thread.start()
+
+    def watch(self, key, path):
+        """watch the repository with the working tree `path`.
+
+        Returns False if it has no git directory (e.g. it is not cloned yet)
+        or can not be watched, e.g. because the inotify watch limit is reached.
+        """
+        git_dir = find_git_dir(path)
+        if git_dir is None:
+            return False
+        common = common_dir(git_dir)
+        try:
+            with self._lock:
+                self._add(key, git_dir, self._GIT_DIR_FILES)
+                if common != git_dir:
+                    self._add(key, common, self._GIT_DIR_FILES)
+                # refs/remotes appears with the first fetch of a fresh
+                # clone, so refs itself is watched for it
+                self._add(key, os.path.join(common, 'refs'), self._REF_TREES)
+                for refs in self._REF_TREES:
+                    self._add_tree(key, os.path.join(common, 'refs', refs))
+                self._keys.add(key)
+        except OSError:
+            return False
+        return True
+
+    def _add(self, key, path, names=None):
+        wd = self._inotify.add(path)
+        self._watches.setdefault(wd, []).append((key, path, names))
+
+    def _add_tree(self, key, top):
+        """watch `top` and every directory below it"""
+        for dirpath, _dirnames, _filenames in os.walk(top):
+            try:
+                self._add(key, dirpath)
+            except FileNotFoundError:
+                # removed while walking
+                pass
+
+    def _run(self):
+        changed = set()
+        # when the pending batch is reported, and at the latest
+        deadline = None
+        latest = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._inotify, self._wake_r],
+                                           [], [], timeout)
+            if self._closed:
+                return
+            if self._inotify in readable:
+                with self._lock:
+                    keys = self._handle(self._inotify.read())
+                if keys:
+                    now = time.monotonic()
+                    changed |= keys
+                    if latest is None:
+                        latest = now + self.max_delay
+                    deadline = min(now + self.debounce, latest)
+            if deadline is not None and time.monotonic() >= deadline:
+                deadline = latest = None
+                keys, changed = changed, set()
+                self.on_change(keys)
+
+    def _handle(self, events):
+        """the keys affected by `events`, keeping the watches up to date"""
+        keys = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so anything may have changed
+                keys |= self._keys
+                continue
+            watches = self._watches.get(wd, [])
+            if mask & IN_IGNORED:
+                # the directory is gone (e.g. a remote was removed)
+                self._watches.pop(wd, None)
+            for key, path, names in watches:
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) \
+                        and (names is None or name in names):
+                    # a new directory of refs, e.g. for a new remote, or
+                    # refs/remotes itself
+                    try:
+                        self._add_tree(key, os.path.join(path, name))
+                    except OSError:
+                        pass
+                if name.endswith('.lock'):
+                    continue
+                if names is not None and name not in names:
+                    continue
+                keys.add(key)
+        return keys
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        os.write(self._wake_w, b'x')
+        self._thread.join()
+        self._inotify.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
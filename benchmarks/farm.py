@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Generate a synthetic farm of repositories for benchmarking metagit.
+
+The farm is a self-contained home directory: `ROOT/home` holds the working
+trees below `~/repos`, `ROOT/upstream` their bare upstreams (referred to by
+file:// urls) and `ROOT/home/.config/metagit/config.yaml` a config listing
+all of them. Point $HOME (and the XDG_* variables, see farm_environment()) at
+it to run metagit on the farm:
+
+    python3 benchmarks/farm.py ROOT --repos 1000
+
+The repositories are in the following states, assigned round-robin according
+to their weights (see --mix):
+
+  clean      a fresh clone of its upstream
+  dirty      a modified tracked file and a new file
+  untracked  many untracked files in a few directories
+  ahead      a local commit not pushed yet
+  behind     one commit behind its remote-tracking branch
+  missing    only in the config, not cloned
+  git-svn    configured with type 'git-svn', with a refs/remotes/git-svn ref
+             standing in for the svn remote (there is no svn server, so
+             fetching it fails)
+
+Only one template repository per state is made with git; the farm's
+repositories are copies of the templates, which keeps building 10000 of them
+feasible. The copies' indexes are refreshed afterwards, so their stat data
+is as git left it.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+# bump when the farm layout changes, so stale farms are rebuilt
+FARM_VERSION = 1
+
+STATES = ('clean', 'dirty', 'untracked', 'ahead', 'behind', 'missing',
+          'git-svn')
+
+# the share of every state in the default farm
+DEFAULT_MIX = {
+    'clean': 4,
+    'dirty': 1,
+    'untracked': 1,
+    'ahead': 1,
+    'behind': 1,
+    'missing': 1,
+    'git-svn': 1,
+}
+
+# the number of untracked files of an 'untracked' repository
+UNTRACKED_FILES = 100
+
+# the repositories are spread over directories of this many
+_PER_DIRECTORY = 100
+
+_IDENTITY = {
+    'GIT_AUTHOR_NAME': 'metagit benchmark',
+    'GIT_AUTHOR_EMAIL': 'bench@example.org',
+    'GIT_COMMITTER_NAME': 'metagit benchmark',
+    'GIT_COMMITTER_EMAIL': 'bench@example.org',
+}
+
+
+def farm_environment(root):
+    """the environment variables making metagit (and git) use the farm at
+    `root` instead of the user's home"""
+    home = os.path.join(os.path.abspath(root), 'home')
+    return {
+        'HOME': home,
+        'XDG_CONFIG_HOME': os.path.join(home, '.config'),
+        'XDG_CACHE_HOME': os.path.join(home, '.cache'),
+        # keep the user's and the system's git config out of the farm
+        'GIT_CONFIG_NOSYSTEM': '1',
+        'GIT_CONFIG_GLOBAL': os.path.join(home, '.gitconfig'),
+    }
+
+
+def _git(env, *args, cwd=None):
+    subprocess.run(('git',) + args, cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _commit(env, path, name, content):
+    with open(os.path.join(path, name), 'w') as filehandle:
+        filehandle.write(content)
+    _git(env, 'add', name, cwd=path)
+    _git(env, 'commit', '-q', '-m', 'Change ' + name, cwd=path)
+
+
+def _make_templates(root, env):
+    """create an upstream and a template working tree per state; returns
+    {state: (template path or None, settings)}"""
+    upstream_dir = os.path.join(root, 'upstream')
+    template_dir = os.path.join(root, 'templates')
+    # no hook samples: they would be copied into every repository
+    empty = os.path.join(root, 'empty-template')
+    os.makedirs(empty, exist_ok=True)
+    templates = {}
+    for state in STATES:
+        branch = 'master' if state == 'git-svn' else 'main'
+        seed = os.path.join(template_dir, state + '.seed')
+        _git(env, 'init', '-q', '--template=' + empty, '-b', branch, seed)
+        for number in range(1, 3):
+            _commit(env, seed, 'file{}.txt'.format(number),
+                    'line {}\n'.format(number) * 20)
+        upstream = os.path.join(upstream_dir, state + '.git')
+        _git(env, 'clone', '-q', '--bare', '--template=' + empty, seed,
+             upstream)
+        shutil.rmtree(seed)
+        url = 'file://' + upstream
+        settings = {'url': url}
+        if state == 'missing':
+            templates[state] = (None, settings)
+            continue
+        template = os.path.join(template_dir, state)
+        _git(env, 'clone', '-q', '--template=' + empty, url, template)
+        if state == 'dirty':
+            with open(os.path.join(template, 'file1.txt'), 'a') as filehandle:
+                filehandle.write('modified\n')
+            open(os.path.join(template, 'new.txt'), 'w').close()
+        elif state == 'untracked':
+            for number in range(UNTRACKED_FILES):
+                directory = os.path.join(template, 'build',
+                                         'd{}'.format(number % 10))
+                os.makedirs(directory, exist_ok=True)
+                with open(os.path.join(directory, 'f{}.o'.format(number)),
+                          'w') as filehandle:
+                    filehandle.write('object {}\n'.format(number))
+        elif state == 'ahead':
+            _commit(env, template, 'local.txt', 'not pushed\n')
+        elif state == 'behind':
+            _git(env, 'reset', '-q', '--hard', 'HEAD~1', cwd=template)
+        elif state == 'git-svn':
+            _git(env, 'update-ref', 'refs/remotes/git-svn', 'HEAD',
+                 cwd=template)
+            settings = {'url': url, 'type': 'git-svn', 'branch': 'master'}
+        templates[state] = (template, settings)
+    return templates
+
+
+def assign_states(count, mix=None):
+    """the state of each of the `count` repositories, round-robin by the
+    weights in `mix` (default: DEFAULT_MIX)"""
+    mix = DEFAULT_MIX if mix is None else mix
+    pattern = [state for state in STATES for _ in range(mix.get(state, 0))]
+    if not pattern:
+        raise ValueError('the mix does not contain any repository')
+    return [pattern[i % len(pattern)] for i in range(count)]
+
+
+def build_farm(root, count, mix=None, jobs=None):
+    """(re)create the farm of `count` repositories at `root`; returns the
+    description written to ROOT/farm.json"""
+    root = os.path.abspath(root)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    env = dict(os.environ, **farm_environment(root), **_IDENTITY)
+    home = env['HOME']
+    os.makedirs(os.path.join(home, '.config', 'metagit'))
+    open(env['GIT_CONFIG_GLOBAL'], 'w').close()
+    templates = _make_templates(root, env)
+    repositories = {}
+    copies = []
+    states = assign_states(count, mix)
+    for number, state in enumerate(states):
+        tilde_path = '~/repos/{:03d}/{}-{}'.format(number // _PER_DIRECTORY,
+                                                   state, number)
+        template, settings = templates[state]
+        repositories[tilde_path] = settings if len(settings) > 1 \
+            else settings['url']
+        if template is not None:
+            copies.append((template, os.path.join(home, tilde_path[2:])))
+
+    def copy(job):
+        template, path = job
+        shutil.copytree(template, path, symlinks=True)
+        # the copies have new inodes and ctimes: let git record them
+        subprocess.run(['git', 'update-index', '-q', '--refresh'], cwd=path,
+                       env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for _ in pool.map(copy, copies):
+            pass
+    config = {
+        'repositories': repositories,
+        # 'detect' and 'clone' must not crawl outside of the farm
+        'detect-roots': [home],
+        'watch': False,
+    }
+    with open(os.path.join(home, '.config', 'metagit', 'config.yaml'),
+              'w') as filehandle:
+        json.dump(config, filehandle, indent=1)  # JSON is valid YAML
+    description = {
+        'version': FARM_VERSION,
+        'repos': count,
+        'mix': dict(mix or DEFAULT_MIX),
+        'states': {state: states.count(state) for state in STATES},
+    }
+    with open(os.path.join(root, 'farm.json'), 'w') as filehandle:
+        json.dump(description, filehandle, indent=1)
+    return description
+
+
+def load_farm(root):
+    """the description of the farm at `root`, or None if there is none"""
+    try:
+        with open(os.path.join(root, 'farm.json')) as filehandle:
+            return json.load(filehandle)
+    except (OSError, ValueError):
+        return None
+
+
+def ensure_farm(root, count, mix=None, jobs=None):
+    """the farm of `count` repositories at `root`, built unless an identical
+    one is there already"""
+    description = load_farm(root)
+    if description is not None \
+            and description.get('version') == FARM_VERSION \
+            and description.get('repos') == count \
+            and description.get('mix') == dict(mix or DEFAULT_MIX):
+        return description
+    return build_farm(root, count, mix, jobs)
+
+
+def parse_mix(text):
+    """parse 'clean=4,dirty=1,...' into a mix dict"""
+    mix = {}
+    for item in text.split(','):
+        state, _, weight = item.partition('=')
+        if state not in STATES or not weight.isdigit():
+            raise argparse.ArgumentTypeError(
+                'expected STATE=WEIGHT with a state out of {}, got {!r}'
+                .format(', '.join(STATES), item))
+        mix[state] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', 1)[0],
+        epilog=__doc__.split('\n', 2)[2],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help='the directory to create the farm in '
+                                     '(replaced if it exists)')
+    parser.add_argument('--repos', type=int, default=100, metavar='N',
+                        help='the number of repositories (default: 100)')
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='the weights of the states, e.g. '
+                             'clean=4,dirty=1 (default: {})'.format(
+                                 ','.join('{}={}'.format(s, w) for s, w
+                                          in DEFAULT_MIX.items())))
+    argv = parser.parse_args()
+    description = build_farm(argv.root, argv.repos, argv.mix)
+    print(json.dumps(description['states']))
+    for name, value in farm_environment(argv.root).items():
+        print('export {}={}'.format(name, value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Check the startup time of the metagit command line against a budget.
+
+Runs metagit with arguments that do no real work (by default '--help', as a
+shell completion or prompt would) a number of times and reports the median
+wall-clock time, next to that of a bare 'python3 -c pass' for reference.
+'python3 -X importtime' then tells which imports the time went into, so a
+module that crept into the startup path is easy to spot.
+
+The budget is the time metagit may take on top of the bare interpreter, so
+the check does not depend on how fast the machine starts Python. 'metagit
+--help' takes about 25 ms on top of it, most of that importing argparse and
+formatting the help; the default budget of 40 ms leaves room for noise, yet
+catches an eager import of yaml, asyncio or concurrent.futures (each 20 ms or
+more). The Metagit package is byte-compiled first, as an installed one would
+be, so the check also holds with $PYTHONDONTWRITEBYTECODE set. Exits with 1
+when the median exceeds the baseline plus the budget:
+
+    python3 benchmarks/startup.py [--budget MS] [--runs N] [-- ARGS...]
+"""
+import os
+import sys
+import time
+import argparse
+import compileall
+import statistics
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+METAGIT = os.path.join(ROOT, 'metagit.py')
+
+
+def median_ms(cmd, runs):
+    """the median wall-clock time of running `cmd`, in milliseconds"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def slowest_imports(cmd, count):
+    """the `count` top-level imports of `cmd` with the highest cumulative
+    import time, as (microseconds, module) pairs"""
+    proc = subprocess.run([cmd[0], '-X', 'importtime'] + cmd[1:],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        # 'import time: self [us] | cumulative | imported package', nested
+        # imports being indented
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        if name.startswith('  '):
+            continue
+        imports.append((int(fields[1]), name.strip()))
+    imports.sort(reverse=True)
+    return imports[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budget', type=float, default=40, metavar='MS',
+                        help='the allowed median startup time on top of that '
+                             'of \'python3 -c pass\' (default: 40)')
+    parser.add_argument('--runs', type=int, default=20, metavar='N',
+                        help='the number of runs to take the median of')
+    parser.add_argument('--top', type=int, default=8, metavar='N',
+                        help='the number of slowest imports to list')
+    parser.add_argument('args', nargs='*', default=['--help'],
+                        help='the metagit arguments (default: --help)')
+    argv = parser.parse_args()
+    compileall.compile_dir(os.path.join(ROOT, 'Metagit'), quiet=1)
+    cmd = [sys.executable, METAGIT] + argv.args
+    baseline = median_ms([sys.executable, '-c', 'pass'], argv.runs)
+    total = median_ms(cmd, argv.runs)
+    limit = baseline + argv.budget
+    print('python3 -c pass:  {:6.1f} ms'.format(baseline))
+    print('metagit {}: {:6.1f} ms (budget {:.1f} ms = {:.1f} + {:.0f})'.format(
+        ' '.join(argv.args), total, limit, baseline, argv.budget))
+    print('slowest imports (cumulative):')
+    for micros, name in slowest_imports(cmd, argv.top):
+        print('  {:6.1f} ms  {}'.format(micros / 1000, name))
+    if total > limit:
+        print('over budget by {:.1f} ms'.format(total - limit))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""Benchmark metagit on synthetic repository farms.
+
+For every farm size a farm is generated (see farm.py; an identical farm left
+by a previous run is reused) and the following are timed:
+
+  status-cold    'metagit st --no-cache'
+  status-warm    'metagit st', answered from the status cache
+  status-quick   'metagit st --level=ahead-behind'
+  fetch          'metagit fetch' from the file:// upstreams
+  clone          'metagit clone --yes' of every repository into a new
+                 directory (the farm itself is left alone)
+  crawl-cold     discovery by crawling the farm, without the index
+  crawl-indexed  discovery by crawling the farm with an up-to-date index
+  locate         locate_git_repositories() on a database of the farm (only
+                 where updatedb and locate are installed)
+  table          pretty_print_table() of the status table
+  ui-render      the interactive UI's first frame: building the rows from
+                 the status cache and one pass of run_ui() (in a pty)
+
+The commands run in-process through metagit.Main, so the interpreter's
+startup is not part of the timings (see startup.py for that). Each benchmark
+runs --repeat times; the results, with the commit and the machine they were
+taken on, are written as JSON:
+
+    python3 benchmarks/suite.py --sizes 10,100,1000 -o results.json
+    python3 benchmarks/suite.py --compare before.json -o after.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import contextlib
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import farm  # noqa: E402
+
+RESULTS_VERSION = 1
+
+BENCHMARKS = ('status-cold', 'status-warm', 'status-quick', 'fetch', 'clone',
+              'crawl-cold', 'crawl-indexed', 'locate', 'table', 'ui-render')
+
+
+class Skipped(Exception):
+    """raised by a benchmark that can not run here"""
+
+
+@contextlib.contextmanager
+def farm_environment(root):
+    """run metagit (and git) on the farm at `root` within the block"""
+    saved = dict(os.environ)
+    os.environ.update(farm.farm_environment(root))
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+@contextlib.contextmanager
+def discarded_output():
+    """discard the output within the block, including that of the git
+    processes started meanwhile"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            yield
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+
+def run_main(*args):
+    """run the metagit command line with `args` in-process; returns its exit
+    code, its output is discarded"""
+    import metagit
+    from Metagit import Repository
+    # every run searches the file system afresh, like a new process would
+    if hasattr(Repository.repositories_in_filesystem, 'dict'):
+        del Repository.repositories_in_filesystem.dict
+    saved = sys.argv
+    sys.argv = ['metagit'] + list(args)
+    try:
+        with discarded_output():
+            metagit.Main()
+    except SystemExit as e:
+        return e.code or 0
+    finally:
+        sys.argv = saved
+    return 0
+
+
+def jobs_args(jobs):
+    return ['-j', str(jobs)] if jobs is not None else []
+
+
+def bench_status_cold(root, jobs):
+    run_main('st', '--no-cache', *jobs_args(jobs))
+
+
+def bench_status_warm(root, jobs):
+    run_main('st', *jobs_args(jobs))
+
+
+def bench_status_quick(root, jobs):
+    run_main('st', '--level=ahead-behind', *jobs_args(jobs))
+
+
+def bench_fetch(root, jobs):
+    run_main('fetch', *jobs_args(jobs))
+
+
+def prepare_clone(root):
+    """switch to a config listing every repository of the farm below
+    ~/clones, which does not exist yet; returns a function undoing it"""
+    from Metagit.Config import load_yaml, dump_yaml
+    home = os.environ['HOME']
+    config_dir = os.path.join(root, 'clone-config', 'metagit')
+    with open(os.path.join(home, '.config', 'metagit', 'config.yaml')) \
+            as filehandle:
+        config = load_yaml(filehandle)
+    # the svn "upstreams" can't be cloned
+    config['repositories'] = {
+        path.replace('~/repos/', '~/clones/', 1): entry
+        for path, entry in config['repositories'].items()
+        if not isinstance(entry, dict) or entry.get('type') != 'git-svn'}
+    # nothing to move from: every repository is cloned
+    config['detect-roots'] = [os.path.join(root, 'clone-config')]
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, 'config.yaml'), 'w') as filehandle:
+        dump_yaml(config, filehandle)
+    os.environ['XDG_CONFIG_HOME'] = os.path.dirname(config_dir)
+    shutil.rmtree(os.path.join(home, 'clones'), ignore_errors=True)
+
+    def undo():
+        shutil.rmtree(os.path.join(home, 'clones'), ignore_errors=True)
+        os.environ['XDG_CONFIG_HOME'] = os.path.join(home, '.config')
+    return undo
+
+
+def bench_clone(root, jobs):
+    undo = prepare_clone(root)
+    try:
+        start = time.perf_counter()
+        run_main('clone', '--yes', *jobs_args(jobs))
+        return time.perf_counter() - start
+    finally:
+        undo()
+
+
+def bench_crawl_cold(root, jobs):
+    from Metagit.discovery import crawl
+    for _ in crawl([os.environ['HOME']], jobs=jobs):
+        pass
+
+
+def bench_crawl_indexed(root, jobs):
+    from Metagit.discovery import DiscoveryIndex, crawl
+    index_path = os.path.join(root, 'discovery.json')
+    if not os.path.exists(index_path):
+        for _ in crawl([os.environ['HOME']], jobs=jobs,
+                       index=DiscoveryIndex(index_path)):
+            pass
+    start = time.perf_counter()
+    for _ in crawl([os.environ['HOME']], jobs=jobs,
+                   index=DiscoveryIndex(index_path)):
+        pass
+    return time.perf_counter() - start
+
+
+def bench_locate(root, jobs):
+    from Metagit.Repository import locate_git_repositories
+    if shutil.which('locate') is None or shutil.which('updatedb') is None:
+        raise Skipped('locate/updatedb not installed')
+    database = os.path.join(root, 'locatedb')
+    if not os.path.exists(database):
+        subprocess.run(['updatedb', '--localpaths=' + os.environ['HOME'],
+                        '--output=' + database], check=True,
+                       stderr=subprocess.DEVNULL)
+    os.environ['LOCATE_PATH'] = database
+    try:
+        start = time.perf_counter()
+        locate_git_repositories()
+        return time.perf_counter() - start
+    finally:
+        del os.environ['LOCATE_PATH']
+
+
+def bench_table(root, jobs):
+    from Metagit.Config import Config
+    from Metagit.cache import StatusCache
+    from Metagit.Repository import RepoStatus
+    from Metagit.utils import pretty_print_table, repo_status_cells
+    config = Config()
+    config.reload()
+    cache = StatusCache().load()
+    statuses = []
+    for r in config.repo_objects.values():
+        rs = cache.snapshot(r) if r.exists() else RepoStatus.nonExistent()
+        statuses.append((r, rs or RepoStatus()))
+    start = time.perf_counter()
+    table = [['repository\nname', 'status']]
+    for r, rs in statuses:
+        table.append([text for text, _color in repo_status_cells(r, rs=rs)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        pretty_print_table(table)
+    return time.perf_counter() - start
+
+
+def _ui_render():
+    """in the pty child: the time of run_ui() building the rows, drawing the
+    first frame and handling the 'q' waiting in the input"""
+    from Metagit import ui
+    from Metagit.Config import Config
+    from Metagit.cache import StatusCache
+    from Metagit.engine import StatusEngine
+    config = Config()
+    config.reload()
+    repos = config.repo_objects
+    start = time.perf_counter()
+    engine = StatusEngine(cache=StatusCache().load())
+    with contextlib.redirect_stderr(io.StringIO()):
+        ui.run_ui(repos, {'q': 'quit'}, engine=engine, watch=False)
+    return time.perf_counter() - start
+
+
+def bench_ui_render(root, jobs):
+    import pty
+    import select
+    result_r, result_w = os.pipe()
+    pid, fd = pty.fork()
+    if pid == 0:
+        try:
+            os.close(result_r)
+            os.environ.update(TERM='xterm', LINES='50', COLUMNS='120')
+            os.write(result_w, json.dumps(_ui_render()).encode())
+        finally:
+            os._exit(0)
+    os.close(result_w)
+    # read by the UI once the first frame is drawn
+    os.write(fd, b'q')
+    while True:
+        readable, _, _ = select.select([fd], [], [], 60)
+        if not readable:
+            os.kill(pid, 9)
+            break
+        try:
+            if not os.read(fd, 65536):
+                break
+        except OSError:
+            # the child is gone
+            break
+    os.waitpid(pid, 0)
+    os.close(fd)
+    with os.fdopen(result_r) as filehandle:
+        data = filehandle.read()
+    if not data:
+        raise Skipped('the UI did not start')
+    return json.loads(data)
+
+
+def run_benchmark(name, root, jobs, repeat):
+    """the timings of `repeat` runs of the benchmark `name` on the farm"""
+    func = globals()['bench_' + name.replace('-', '_')]
+    if name == 'status-warm':
+        # fill the status cache first
+        run_main('st', *jobs_args(jobs))
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        elapsed = func(root, jobs)
+        if elapsed is None:
+            elapsed = time.perf_counter() - start
+        runs.append(elapsed)
+    return {'min': min(runs), 'median': statistics.median(runs),
+            'runs': runs}
+
+
+def git_revision():
+    """the commit of the tree being benchmarked, and whether it has changes"""
+    def git(*args):
+        return subprocess.run(('git',) + args, cwd=os.path.dirname(HERE),
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    return git('rev-parse', 'HEAD') or None, bool(git('status', '--porcelain',
+                                                      '--untracked-files=no'))
+
+
+def compare(old, new):
+    """print the median timings of `new` next to those of `old`"""
+    print('{:>6} {:<14} {:>10} {:>10} {:>7}'.format(
+        'repos', 'benchmark', 'old (s)', 'new (s)', 'ratio'))
+    for size, results in new['sizes'].items():
+        for name, timing in results.items():
+            before = old.get('sizes', {}).get(size, {}).get(name)
+            if 'median' not in timing or not before \
+                    or 'median' not in before:
+                continue
+            ratio = timing['median'] / before['median'] \
+                if before['median'] else float('inf')
+            print('{:>6} {:<14} {:>10.4f} {:>10.4f} {:>6.2f}x'.format(
+                size, name, before['median'], timing['median'], ratio))
+
+
+def parse_list(text, choices=None):
+    items = [item for item in text.split(',') if item]
+    if choices is not None:
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(
+                    '{!r} is not one of {}'.format(item, ', '.join(choices)))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n', 1)[0],
+        epilog=__doc__.split('\n', 2)[2],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000',
+                        type=lambda text: [int(s) for s in parse_list(text)],
+                        help='the farm sizes (default: 10,100,1000; add '
+                             '10000 for the full run, which takes a while)')
+    parser.add_argument('--only', default=list(BENCHMARKS),
+                        type=lambda text: parse_list(text, BENCHMARKS),
+                        help='the benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='runs per benchmark (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                        help='passed on to metagit (default: its default)')
+    parser.add_argument('--root', default=os.path.join(
+                            os.environ.get('TMPDIR', '/tmp'),
+                            'metagit-benchmark'),
+                        help='where the farms are kept between runs')
+    parser.add_argument('--mix', type=farm.parse_mix, default=None,
+                        help='the weights of the repository states (see '
+                             'farm.py)')
+    parser.add_argument('-o', '--output', default=None, metavar='FILE',
+                        help='write the results to FILE (default: stdout)')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='print the change against the results in FILE')
+    argv = parser.parse_args()
+    commit, modified = git_revision()
+    results = {
+        'version': RESULTS_VERSION,
+        'commit': commit,
+        'modified': modified,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'jobs': argv.jobs,
+        'repeat': argv.repeat,
+        'farms': {},
+        'sizes': {},
+    }
+    for size in argv.sizes:
+        root = os.path.join(argv.root, str(size))
+        print('Preparing a farm of {} repositories in {}'.format(size, root),
+              file=sys.stderr)
+        results['farms'][str(size)] = farm.ensure_farm(root, size, argv.mix,
+                                                       argv.jobs)['states']
+        timings = results['sizes'][str(size)] = {}
+        with farm_environment(root):
+            for name in argv.only:
+                try:
+                    timing = run_benchmark(name, root, argv.jobs, argv.repeat)
+                except Skipped as e:
+                    timing = {'skipped': str(e)}
+                    print('{:>6} {:<14} skipped: {}'.format(size, name, e),
+                          file=sys.stderr)
+                else:
+                    print('{:>6} {:<14} {:10.4f} s'.format(
+                        size, name, timing['median']), file=sys.stderr)
+                timings[name] = timing
+    if argv.output is None:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        with open(argv.output, 'w') as filehandle:
+            json.dump(results, filehandle, indent=1)
+    if argv.compare is not None:
+        with open(argv.compare) as filehandle:
+            compare(json.load(filehandle), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
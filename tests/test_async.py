@@ -0,0 +1,148 @@
+"""Check that the asyncio methods of GitRepository agree with the blocking
+ones.
+
+astatus() runs the same steps as status_at() with acall() instead of call(),
+so both must give the same RepoStatus at every level, whether the counts come
+from 'git status', the commit-graph or 'git rev-list'. afetch() and aclone()
+are run against a bare file:// upstream.
+"""
+import os
+import sys
+import shutil
+import asyncio
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.utils import STATUS_LEVELS  # noqa: E402
+from Metagit.cache import StatusCache  # noqa: E402
+from Metagit.engine import StatusEngine  # noqa: E402
+from Metagit.Repository import GitRepository, GitSvnRepository  # noqa: E402
+
+
+def git(cwd, *args):
+    """run git in `cwd` with a fixed identity and no user config"""
+    env = dict(os.environ,
+               HOME=cwd, XDG_CONFIG_HOME=cwd, GIT_CONFIG_NOSYSTEM='1',
+               GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@example.com',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@example.com')
+    return subprocess.run(('git',) + args, cwd=cwd, env=env, check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL).stdout.decode()
+
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='metagit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.url = 'file://' + os.path.join(self.root, 'upstream.git')
+        git(self.root, 'init', '-q', '--bare', '-b', 'main', 'upstream.git')
+        self.work = self.clone('work')
+        self.commit(self.work, 'first')
+        git(self.work, 'push', '-q', 'origin', 'main')
+        self.path = self.clone('repo')
+        self.repo = GitRepository(self.path, {'url': self.url})
+
+    def clone(self, name):
+        git(self.root, 'clone', '-q', self.url, name)
+        return os.path.join(self.root, name)
+
+    def commit(self, cwd, name):
+        with open(os.path.join(cwd, name), 'w') as filehandle:
+            filehandle.write(name + '\n')
+        git(cwd, 'add', name)
+        git(cwd, 'commit', '-q', '-m', name)
+
+    def blocking_call(self, *args, **kwargs):
+        raise AssertionError('{} run with call()'.format(args))
+
+    def assert_same_status(self, repo):
+        for level in STATUS_LEVELS:
+            expected = repo.status_at(level).to_dict()
+            # a fresh object each time, so no detected branch is reused
+            fresh = type(repo)(repo.tilde_path, repo.config)
+            fresh.call = self.blocking_call
+            self.assertEqual(asyncio.run(fresh.astatus(level)).to_dict(),
+                             expected, level)
+        return expected
+
+    def test_clean(self):
+        rs = self.assert_same_status(self.repo)
+        self.assertEqual(rs['unpushed_commits'], 0)
+
+    def test_dirty_ahead_behind(self):
+        self.commit(self.work, 'second')
+        git(self.work, 'push', '-q', 'origin', 'main')
+        git(self.path, 'fetch', '-q')
+        self.commit(self.path, 'mine')
+        with open(os.path.join(self.path, 'first'), 'a') as filehandle:
+            filehandle.write('changed\n')
+        rs = self.assert_same_status(self.repo)
+        self.assertEqual((rs['unpushed_commits'], rs['unmerged_commits']),
+                         (1, 1))
+        self.assertEqual(rs['uncommited_changes'], 1)
+
+    def test_other_branch(self):
+        # the counts of the main branch while another one (tracking the same
+        # upstream) is checked out come from 'git rev-list'
+        self.commit(self.path, 'mine')
+        git(self.path, 'checkout', '-q', '-b', 'topic', 'origin/main')
+        rs = self.assert_same_status(self.repo)
+        self.assertEqual(rs['unpushed_commits'], 1)
+        configured = GitRepository(self.path, {'url': self.url,
+                                               'branch': 'main'})
+        rs = self.assert_same_status(configured)
+        self.assertEqual(rs['unpushed_commits'], 1)
+
+    def test_missing(self):
+        missing = GitRepository(os.path.join(self.root, 'missing'),
+                                {'url': self.url})
+        self.assertFalse(asyncio.run(missing.astatus()).exists)
+
+    def test_fetch(self):
+        self.commit(self.work, 'second')
+        git(self.work, 'push', '-q', 'origin', 'main')
+        asyncio.run(self.repo.afetch(quiet=True))
+        self.assertEqual(git(self.path, 'rev-parse', 'origin/main'),
+                         git(self.work, 'rev-parse', 'main'))
+
+    def test_clone(self):
+        repo = GitRepository(os.path.join(self.root, 'cloned'),
+                             {'url': self.url})
+
+        async def clone_twice():
+            await repo.aclone(quiet=True)
+            # nothing to do once it exists
+            await repo.aclone(quiet=True)
+        asyncio.run(clone_twice())
+        self.assertEqual(git(repo.path, 'rev-parse', 'HEAD'),
+                         git(self.work, 'rev-parse', 'HEAD'))
+
+    def test_svn_fetch(self):
+        svn = GitSvnRepository(self.path, {'url': self.url,
+                                           'branch': 'master'})
+        self.assertEqual(svn.fetch_args(), ['svn', 'fetch'])
+        self.assertEqual(svn.clone_args()[:2], ['svn', 'clone'])
+
+    def test_engine(self):
+        cache = StatusCache(os.path.join(self.root, 'status.json'))
+        engine = StatusEngine(jobs=2, cache=cache)
+        repos = [self.repo, GitRepository(self.work, {'url': self.url})]
+
+        async def evaluate():
+            return await asyncio.gather(*map(engine.astatus, repos))
+        first = asyncio.run(evaluate())
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual([rs.to_dict() for rs in first],
+                         [engine.status(repo).to_dict() for repo in repos])
+        # the repositories did not change, so the cache answers
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual([rs.to_dict() for rs in asyncio.run(evaluate())],
+                         [rs.to_dict() for rs in first])
+        self.assertEqual(cache.hits, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
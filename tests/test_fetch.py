@@ -0,0 +1,140 @@
+"""Check 'fetch --skip-unchanged' against a bare file:// upstream.
+
+Every test clones a bare upstream, changes the upstream (or not) and checks
+that fetch_needed() agrees with what 'git fetch' would do, and that
+'metagit fetch --skip-unchanged' fetches (FETCH_HEAD is written) or skips the
+repository accordingly.
+"""
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.gitdir import parse_ls_remote  # noqa: E402
+from Metagit.Repository import GitRepository  # noqa: E402
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='metagit-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.env = {
+            'HOME': self.root,
+            'XDG_CONFIG_HOME': os.path.join(self.root, '.config'),
+            'XDG_CACHE_HOME': os.path.join(self.root, '.cache'),
+            'GIT_CONFIG_NOSYSTEM': '1',
+            'GIT_AUTHOR_NAME': 'a', 'GIT_AUTHOR_EMAIL': 'a@example.com',
+            'GIT_COMMITTER_NAME': 'a', 'GIT_COMMITTER_EMAIL': 'a@example.com',
+        }
+        saved = dict(os.environ)
+        self.addCleanup(os.environ.update, saved)
+        self.addCleanup(os.environ.clear)
+        os.environ.update(self.env)
+        self.upstream = os.path.join(self.root, 'upstream.git')
+        self.url = 'file://' + self.upstream
+        self.work = os.path.join(self.root, 'work')
+        self.git(self.root, 'init', '-q', '--bare', '-b', 'main',
+                 self.upstream)
+        self.git(self.root, 'clone', '-q', self.url, self.work)
+        self.commit('first')
+        self.git(self.work, 'branch', 'topic')
+        self.git(self.work, 'push', '-q', 'origin', 'main', 'topic')
+        self.path = os.path.join(self.root, 'repo')
+        self.git(self.root, 'clone', '-q', self.url, self.path)
+        self.repo = GitRepository(self.path, {'url': self.url})
+
+    def git(self, cwd, *args):
+        return subprocess.run(('git',) + args, cwd=cwd, check=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout.decode()
+
+    def commit(self, name):
+        with open(os.path.join(self.work, name), 'w') as filehandle:
+            filehandle.write(name + '\n')
+        self.git(self.work, 'add', name)
+        self.git(self.work, 'commit', '-q', '-m', name)
+
+    def fetched(self, *args):
+        """run 'metagit fetch --skip-unchanged' on the repository; whether it
+        fetched"""
+        import metagit
+        config = os.path.join(self.env['XDG_CONFIG_HOME'], 'metagit',
+                              'config.yaml')
+        os.makedirs(os.path.dirname(config), exist_ok=True)
+        with open(config, 'w') as filehandle:
+            filehandle.write('repositories:\n  {}: {}\n'.format(
+                self.path, self.url))
+        fetch_head = os.path.join(self.path, '.git', 'FETCH_HEAD')
+        if os.path.exists(fetch_head):
+            os.unlink(fetch_head)
+        saved = sys.argv
+        sys.argv = ['metagit', 'fetch', '--skip-unchanged', '-j', '1'] \
+            + list(args)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                metagit.Main()
+        except SystemExit as e:
+            self.assertFalse(e.code)
+        finally:
+            sys.argv = saved
+        return os.path.exists(fetch_head)
+
+    def remote_ref(self, name):
+        return self.git(self.path, 'rev-parse',
+                        'refs/remotes/origin/' + name).strip()
+
+    def test_parse_ls_remote(self):
+        out = self.git(self.path, 'ls-remote', 'origin')
+        refs = parse_ls_remote(out)
+        self.assertEqual(set(refs), {'HEAD', 'refs/heads/main',
+                                     'refs/heads/topic'})
+        self.assertEqual(refs['refs/heads/main'], self.remote_ref('main'))
+
+    def test_unchanged(self):
+        self.assertFalse(self.repo.fetch_needed())
+        self.assertFalse(self.fetched())
+
+    def test_advanced(self):
+        self.commit('second')
+        self.git(self.work, 'push', '-q', 'origin', 'main')
+        self.assertTrue(self.repo.fetch_needed())
+        self.assertTrue(self.fetched())
+        self.assertEqual(self.remote_ref('main'),
+                         self.git(self.work, 'rev-parse', 'main').strip())
+        # fetched, so there is nothing left to fetch
+        self.assertFalse(self.repo.fetch_needed())
+
+    def test_new_branch(self):
+        self.git(self.work, 'push', '-q', 'origin', 'main:refs/heads/new')
+        self.assertTrue(self.repo.fetch_needed())
+        self.assertTrue(self.fetched())
+        self.assertEqual(self.remote_ref('new'), self.remote_ref('main'))
+
+    def test_new_tag(self):
+        self.git(self.work, 'tag', 'v1')
+        self.git(self.work, 'push', '-q', 'origin', 'v1')
+        self.assertTrue(self.repo.fetch_needed())
+        self.assertTrue(self.fetched())
+
+    def test_deleted_branch(self):
+        self.git(self.work, 'push', '-q', 'origin', ':topic')
+        # without pruning, 'git fetch' would not change any ref
+        self.assertFalse(self.repo.fetch_needed())
+        self.assertFalse(self.fetched())
+        # with pruning it would delete origin/topic, which can not be told
+        # from the advertised refs
+        self.git(self.path, 'config', 'fetch.prune', 'true')
+        self.assertTrue(self.repo.fetch_needed())
+        self.assertTrue(self.fetched())
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.remote_ref('topic')
+
+
+if __name__ == '__main__':
+    unittest.main()
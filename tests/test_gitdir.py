@@ -0,0 +1,124 @@
+"""Check the in-process commit-graph reader against git itself.
+
+Every test builds a small repository with branches, merges and an octopus
+merge, writes its commit-graph (a single file or a split chain) and compares
+ahead_behind() with 'git rev-list --left-right --count' and commit_tree()
+with 'git rev-parse <commit>^{tree}'.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import itertools
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.gitdir import CommitGraph, ahead_behind, commit_tree  # noqa: E402
+
+
+def git(cwd, *args):
+    """run git in `cwd` with a fixed identity and no user config"""
+    env = dict(os.environ,
+               HOME=cwd, XDG_CONFIG_HOME=cwd, GIT_CONFIG_NOSYSTEM='1',
+               GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@example.com',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@example.com')
+    return subprocess.run(('git',) + args, cwd=cwd, env=env, check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL).stdout.decode().strip()
+
+
+def commit(repo, name):
+    """commit a new file `name`, returning the commit's object id"""
+    with open(os.path.join(repo, name), 'w') as filehandle:
+        filehandle.write(name + '\n')
+    git(repo, 'add', name)
+    git(repo, 'commit', '-q', '-m', name)
+    return git(repo, 'rev-parse', 'HEAD')
+
+
+def build_history(repo):
+    """a history with diverging branches, a merge and an octopus merge;
+    returns the object ids of interesting commits"""
+    git(repo, 'init', '-q', '-b', 'main')
+    commits = [commit(repo, 'base')]
+    for branch in ('a', 'b', 'c'):
+        git(repo, 'checkout', '-q', '-b', branch, 'main')
+        commits += [commit(repo, '{}{}'.format(branch, i)) for i in range(3)]
+    git(repo, 'checkout', '-q', 'main')
+    commits.append(commit(repo, 'main1'))
+    git(repo, 'merge', '-q', '--no-edit', 'a')
+    commits.append(git(repo, 'rev-parse', 'HEAD'))
+    commits.append(commit(repo, 'main2'))
+    # three parents: the third is listed in the EDGE chunk
+    git(repo, 'checkout', '-q', '-b', 'octopus', 'main')
+    git(repo, 'merge', '-q', '--no-edit', 'b', 'c')
+    commits.append(git(repo, 'rev-parse', 'HEAD'))
+    git(repo, 'checkout', '-q', 'main')
+    return commits
+
+
+class CommitGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='metagit-test-')
+        self.addCleanup(shutil.rmtree, self.repo)
+        self.commits = build_history(self.repo)
+        self.git_dir = os.path.join(self.repo, '.git')
+
+    def assert_matches_git(self, commits):
+        graph = CommitGraph.load(self.git_dir)
+        self.assertIsNotNone(graph)
+        for left, right in itertools.product(commits, repeat=2):
+            expected = git(self.repo, 'rev-list', '--left-right', '--count',
+                           '{}...{}'.format(left, right))
+            self.assertEqual(
+                ahead_behind(graph, left, right),
+                tuple(int(n) for n in expected.split()),
+                '{}...{}'.format(left, right))
+        for oid in commits:
+            self.assertEqual(commit_tree(self.git_dir, oid, graph),
+                             git(self.repo, 'rev-parse', oid + '^{tree}'))
+
+    def test_single_file(self):
+        git(self.repo, 'commit-graph', 'write', '--reachable')
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.git_dir, 'objects', 'info', 'commit-graph')))
+        self.assert_matches_git(self.commits)
+
+    def test_split_chain(self):
+        git(self.repo, 'commit-graph', 'write', '--reachable',
+            '--split=no-merge')
+        # more commits on top, written as a second layer
+        git(self.repo, 'checkout', '-q', '-b', 'd', self.commits[2])
+        later = [commit(self.repo, 'd{}'.format(i)) for i in range(3)]
+        git(self.repo, 'checkout', '-q', 'main')
+        git(self.repo, 'merge', '-q', '--no-edit', 'd')
+        later.append(git(self.repo, 'rev-parse', 'HEAD'))
+        git(self.repo, 'commit-graph', 'write', '--reachable',
+            '--split=no-merge')
+        chain = os.path.join(self.git_dir, 'objects', 'info',
+                             'commit-graphs', 'commit-graph-chain')
+        with open(chain) as filehandle:
+            self.assertEqual(len(filehandle.read().split()), 2)
+        self.assert_matches_git(self.commits + later)
+
+    def test_commit_not_in_graph(self):
+        git(self.repo, 'commit-graph', 'write', '--reachable')
+        newer = commit(self.repo, 'newer')
+        graph = CommitGraph.load(self.git_dir)
+        self.assertIsNone(ahead_behind(graph, newer, self.commits[0]))
+        # the loose object still tells the tree
+        self.assertEqual(commit_tree(self.git_dir, newer, graph),
+                         git(self.repo, 'rev-parse', 'HEAD^{tree}'))
+
+    def test_no_graph(self):
+        self.assertIsNone(CommitGraph.load(self.git_dir))
+        self.assertEqual(ahead_behind(None, self.commits[0],
+                                      self.commits[0]), (0, 0))
+        self.assertIsNone(ahead_behind(None, self.commits[0],
+                                       self.commits[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
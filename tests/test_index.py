@@ -0,0 +1,147 @@
+"""Check the in-process index reader and quick_dirty() against git itself.
+
+The repositories' indexes are written in versions 2, 3 (with an extended
+flag, as git falls back to version 2 without one) and 4 (with prefix
+compressed paths). read_index() is compared with 'git ls-files --stage' and
+quick_dirty() with 'git diff --quiet' and 'git diff --cached --quiet';
+quick_dirty() may answer None, but never contradict git.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.index import quick_dirty, read_index  # noqa: E402
+
+
+def git(cwd, *args, check=True):
+    """run git in `cwd` with a fixed identity and no user config"""
+    env = dict(os.environ,
+               HOME=cwd, XDG_CONFIG_HOME=cwd, GIT_CONFIG_NOSYSTEM='1',
+               GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@example.com',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@example.com')
+    return subprocess.run(('git',) + args, cwd=cwd, env=env, check=check,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+FILES = ('README', 'src/main.c', 'src/main.h', 'src/util/strings.c',
+         'src/util/strings.h', 'docs/manual.txt', 'link')
+
+
+class IndexTest(unittest.TestCase):
+    # the index version written by the test; the subclasses pick the others
+    version = 2
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='metagit-test-')
+        self.addCleanup(shutil.rmtree, self.repo)
+        self.git_dir = os.path.join(self.repo, '.git')
+        git(self.repo, 'init', '-q', '-b', 'main')
+        for name in FILES:
+            if name == 'link':
+                os.symlink('README', os.path.join(self.repo, name))
+                continue
+            path = os.path.join(self.repo, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as filehandle:
+                filehandle.write(name + '\n')
+        git(self.repo, 'add', '.')
+        git(self.repo, 'commit', '-q', '-m', 'initial')
+        git(self.repo, 'update-index', '--index-version', str(self.version))
+        if self.version == 3:
+            # an extended flag keeps git from writing version 2
+            git(self.repo, 'update-index', '--skip-worktree',
+                'docs/manual.txt')
+            # which invalidates the cached tree: write it again
+            git(self.repo, 'write-tree')
+        self.settle()
+
+    def settle(self):
+        """move the files' mtimes into the past and let git refresh the
+        index, so no entry is 'racily clean'"""
+        for name in FILES:
+            os.utime(os.path.join(self.repo, name), (1000000000, 1000000000),
+                     follow_symlinks=False)
+        git(self.repo, 'update-index', '-q', '--refresh', check=False)
+
+    def git_dirty(self):
+        """whether git sees uncommitted changes of the tracked files"""
+        unstaged = git(self.repo, 'diff', '--quiet', check=False).returncode
+        staged = git(self.repo, 'diff', '--cached', '--quiet',
+                     check=False).returncode
+        return bool(unstaged or staged)
+
+    def assert_agrees(self, expected):
+        self.assertEqual(self.git_dirty(), expected)
+        dirty = quick_dirty(self.repo, self.git_dir)
+        self.assertIn(dirty, (None, expected))
+        return dirty
+
+    def test_entries(self):
+        index = read_index(self.git_dir)
+        self.assertEqual(index.version, self.version)
+        listed = git(self.repo, 'ls-files', '--stage', '-z').stdout
+        expected = []
+        for line in listed.split(b'\0'):
+            if line:
+                info, _, path = line.partition(b'\t')
+                mode, oid, stage = info.split()
+                expected.append((path, int(mode, 8), oid.decode(),
+                                 int(stage)))
+        self.assertEqual([(e.path, e.mode, e.oid.hex(), e.stage)
+                          for e in index.entries], expected)
+        self.assertEqual(index.root_tree,
+                         git(self.repo, 'rev-parse', 'HEAD^{tree}')
+                         .stdout.decode().strip())
+        self.assertEqual([e.path for e in index.entries if e.skip_worktree],
+                         [b'docs/manual.txt'] if self.version == 3 else [])
+
+    def test_clean(self):
+        self.assertIs(self.assert_agrees(False), False)
+
+    def test_modified(self):
+        with open(os.path.join(self.repo, 'src/main.c'), 'a') as filehandle:
+            filehandle.write('more\n')
+        self.assertIs(self.assert_agrees(True), True)
+
+    def test_deleted(self):
+        os.unlink(os.path.join(self.repo, 'src/util/strings.h'))
+        self.assertIs(self.assert_agrees(True), True)
+
+    def test_staged(self):
+        with open(os.path.join(self.repo, 'README'), 'a') as filehandle:
+            filehandle.write('more\n')
+        git(self.repo, 'add', 'README')
+        self.settle()
+        # adding invalidated the cached tree, so staged changes can not be
+        # ruled out
+        self.assertIsNone(self.assert_agrees(True))
+        # with the cached tree written, it differs from HEAD's tree
+        git(self.repo, 'write-tree')
+        self.assertIs(self.assert_agrees(True), True)
+
+    def test_touched(self):
+        # new stat data, same content: only git can tell it is unchanged
+        os.utime(os.path.join(self.repo, 'src/main.h'))
+        self.assert_agrees(False)
+
+    def test_untracked(self):
+        with open(os.path.join(self.repo, 'new'), 'w') as filehandle:
+            filehandle.write('new\n')
+        self.assertIs(self.assert_agrees(False), False)
+
+
+class IndexVersion3Test(IndexTest):
+    version = 3
+
+
+class IndexVersion4Test(IndexTest):
+    version = 4
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""Check which urls ssh_destination() multiplexes and how it parses them."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.ssh import ssh_destination  # noqa: E402
+
+
+class SshDestinationTest(unittest.TestCase):
+    def test_ssh_scheme(self):
+        self.assertEqual(ssh_destination('ssh://example.org/x.git'),
+                         (None, 'example.org', None))
+        self.assertEqual(ssh_destination('ssh://git@example.org:2222/x.git'),
+                         ('git', 'example.org', '2222'))
+        self.assertEqual(ssh_destination('git+ssh://git@example.org/x'),
+                         ('git', 'example.org', None))
+        self.assertEqual(ssh_destination('SSH://example.org/x'),
+                         (None, 'example.org', None))
+        # an empty port is ssh's default one
+        self.assertEqual(ssh_destination('ssh://example.org:/x'),
+                         (None, 'example.org', None))
+
+    def test_scp_like(self):
+        self.assertEqual(ssh_destination('git@github.com:t-wissmann/metagit'),
+                         ('git', 'github.com', None))
+        self.assertEqual(ssh_destination('example.org:x.git'),
+                         (None, 'example.org', None))
+
+    def test_ipv6(self):
+        self.assertEqual(ssh_destination('ssh://git@[::1]:2222/x.git'),
+                         ('git', '::1', '2222'))
+        self.assertEqual(ssh_destination('git@[::1]:x.git'),
+                         ('git', '::1', None))
+        self.assertEqual(ssh_destination('[::1]:x.git'), (None, '::1', None))
+
+    def test_not_ssh(self):
+        for url in ('https://github.com/t-wissmann/metagit',
+                    'git://example.org/x', 'file:///srv/git/x.git',
+                    '/srv/git/x.git', './x.git', 'x.git', 'ssh:///x', '',
+                    None):
+            self.assertIsNone(ssh_destination(url), url)
+
+
+if __name__ == '__main__':
+    unittest.main()
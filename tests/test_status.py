@@ -0,0 +1,49 @@
+"""Check how a RepoStatus of every status level is described."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.Repository import RepoStatus  # noqa: E402
+
+
+def status(level, **fields):
+    """a RepoStatus evaluated at `level`, as status_at() leaves it"""
+    rs = RepoStatus()
+    rs.level = level
+    if level != 'full':
+        rs.untracked_files = None
+        rs.uncommited_changes = None
+        rs.unpushed_commits = None
+        rs.unmerged_commits = None
+    for name, value in fields.items():
+        setattr(rs, name, value)
+    return rs
+
+
+class RepoStatusTest(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(str(status('exists')),
+                         'changes unchecked commits unchecked')
+        self.assertEqual(str(status('dirty', dirty=True)),
+                         'uncommited commits unchecked')
+        self.assertEqual(str(status('ahead-behind', dirty=False,
+                                    unpushed_commits=2, unmerged_commits=0)),
+                         'clean unpushed ')
+        self.assertEqual(str(status('full', uncommited_changes=1)),
+                         'uncommited fully published')
+
+    def test_missing(self):
+        self.assertEqual(str(RepoStatus.nonExistent()), 'does not exist')
+
+    def test_round_trip(self):
+        rs = status('dirty', dirty=False)
+        self.assertEqual(RepoStatus.from_dict(rs.to_dict()).to_dict(),
+                         rs.to_dict())
+        self.assertEqual(str(RepoStatus.from_dict(rs.to_dict())),
+                         'clean commits unchecked')
+
+
+if __name__ == '__main__':
+    unittest.main()
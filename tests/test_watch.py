@@ -0,0 +1,65 @@
+"""Check that the RepoWatcher notices ref changes and reports in time."""
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Metagit.watch import RepoWatcher  # noqa: E402
+
+
+class RepoWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp(prefix='metagit-test-')
+        self.addCleanup(shutil.rmtree, self.repo)
+        subprocess.run(('git', 'init', '-q', self.repo), check=True)
+        self.refs = os.path.join(self.repo, '.git', 'refs')
+        # a fresh clone's refs/remotes only appears with its first fetch
+        shutil.rmtree(os.path.join(self.refs, 'remotes'), ignore_errors=True)
+        self.reports = queue.Queue()
+        try:
+            self.watcher = RepoWatcher(self.reports.put, debounce=0.2,
+                                       max_delay=0.6)
+        except OSError:
+            self.skipTest('inotify is not available')
+        self.addCleanup(self.watcher.close)
+        self.assertTrue(self.watcher.watch('repo', self.repo))
+
+    def write_ref(self, name):
+        path = os.path.join(self.refs, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as filehandle:
+            filehandle.write('0' * 40 + '\n')
+
+    def test_new_remotes_directory(self):
+        self.write_ref('remotes/origin/main')
+        self.assertEqual(self.reports.get(timeout=5), {'repo'})
+        # the files in the new directories are watched from now on
+        time.sleep(0.1)
+        self.write_ref('remotes/origin/other')
+        self.assertEqual(self.reports.get(timeout=5), {'repo'})
+
+    def test_steady_stream(self):
+        # events every 0.1 s never leave a quiet `debounce` period, yet the
+        # batch is reported after `max_delay`
+        started = time.monotonic()
+        while self.reports.empty() and time.monotonic() - started < 3:
+            self.write_ref('heads/main')
+            time.sleep(0.1)
+        self.assertEqual(self.reports.get(timeout=0), {'repo'})
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_unrelated_names(self):
+        # a tag is not part of the status
+        self.write_ref('tags/v1')
+        with self.assertRaises(queue.Empty):
+            self.reports.get(timeout=0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()